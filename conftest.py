@@ -0,0 +1,20 @@
+import os
+import pathlib
+import tempfile
+import pytest
+
+
+@pytest.fixture(scope='session', autouse=True)
+def cache_dir():
+    """ keeps the caches of csvsql generated by the tests away from the user's ones, in a folder
+        removed once the tests end """
+    previous = os.environ.get('CSVSQL_CACHE_DIR')
+    with tempfile.TemporaryDirectory(prefix='csvsql_cache_') as folder:
+        os.environ['CSVSQL_CACHE_DIR'] = folder
+        try:
+            yield pathlib.Path(folder)
+        finally:
+            if previous is None:
+                del os.environ['CSVSQL_CACHE_DIR']
+            else:
+                os.environ['CSVSQL_CACHE_DIR'] = previous
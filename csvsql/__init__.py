@@ -1,6 +1,14 @@
-import sys
-import os
-current_path = os.path.dirname(os.path.abspath(__file__))
-sys.path.append(current_path)
+"""
+    csvsql allows the execution of SQL statements on csv files.
+
+    The contents of the module csvsql.csvsql are available from the package
+    (e.g. csvsql.import_csv), but they are not loaded until first used, so
+    the commands csvsqlcli and csvsqlbatch start fast.
+"""
+import importlib
+
 name = "csvsql"
 
+
+def __getattr__(attribute):
+    return getattr(importlib.import_module(__name__ + '.csvsql'), attribute)
@@ -3,15 +3,211 @@
     statements
 """
 import os
+import io
+import re
 import itertools
+import collections
 import csv
+import hashlib
 import pathlib
+import sqlite3
+import tempfile
+import json
+import mmap
+import array
+import bisect
+import operator
+import threading
+import time
+import contextlib
+import codecs
 
 _DEFAULT_COLUMN_NAME = '__COL'
 
+# Table keeping track of the csv files imported incrementally
+_IMPORTS_TABLE = '__csvsql_imports'
+
+# Table keeping track of the shards imported into each table
+_SHARDS_TABLE = '__csvsql_shards'
+
+# Name of the cache of statistics of the imported csv files
+_STATS_CACHE = 'stats'
+
+# Name of the cache of the formats detected on the csv files
+_FORMATS_CACHE = 'formats'
+
+# Bytes read from the start of a csv file to detect its format
+_SNIFF_BYTES = 64 * 1024
+
+# Bytes out of ascii, telling apart the encodings of the files
+_NON_ASCII = re.compile(b'[\x80-\xff]')
+
+# Delimiters considered when detecting the format of a csv file
+_SNIFF_DELIMITERS = ',;\t|'
+
+# Rows of the sample of a csv file considered to detect whether it has a header
+_SNIFF_HEADER_ROWS = 100
+
+# Statements selecting from a single table, with an optional where clause
+_SIMPLE_SELECT = re.compile(r'^\s*select\s.*?\sfrom\s+(\w+)\s*'
+                            r'(?:where\s+(.*?))?\s*(?:\b(?:group|order)\s+by\b.*|\blimit\b.*)?;?\s*$',
+                            re.IGNORECASE | re.DOTALL)
+
+# Comparisons of a column with a text literal in a where clause
+_RANGE_PREDICATE = re.compile(r"(?:\w+\.)?(\w+)\s*(?:(==|=|<=|>=|<|>)\s*('(?:[^']|'')*')|"
+                              r"\s+between\s+('(?:[^']|'')*')\s+and\s+('(?:[^']|'')*'))",
+                              re.IGNORECASE)
+
+# Where clauses made just of comparisons of a column with a text literal (or with a number, which
+# are ignored) joined by and
+_RANGE_TERM = r"(?:%s|(?:\w+\.)?\w+\s*(?:==|=|<=|>=|<|>|<>|!=)\s*-?\d+(?:\.\d+)?)" % _RANGE_PREDICATE.pattern
+_RANGE_CONDITION = re.compile(r"^\s*%s(?:\s+and\s+%s)*\s*$" % (_RANGE_TERM, _RANGE_TERM), re.IGNORECASE | re.DOTALL)
+
+# Aggregates that can be answered from the statistics of a csv file
+_STATS_AGGREGATE = re.compile(r'\s*(count\s*\(\s*\*\s*\)|(?:min|max)\s*\(\s*(\w+)\s*\))(?:\s+as\s+(\w+))?\s*$',
+                              re.IGNORECASE)
+
+# Statements selecting just aggregates that can be answered from statistics
+_STATS_QUERY = re.compile(r'^\s*select\s+((?:[^,]+?)(?:,[^,]+?)*)\s+from\s+(\w+)\s*;?\s*$', re.IGNORECASE | re.DOTALL)
+
+# Temporary table where ChangeTracker registers the modified tables
+_CHANGES_TABLE = '__csvsql_changes'
+
+# Estimated bytes sqlite3 takes for each row apart from its fields
+_ROW_OVERHEAD = 8
+
+# Estimated factor of page space sqlite3 takes over the size of the records
+_PAGE_OVERHEAD = 1.2
+
+# Prepared statements cached by the connection of a CsvDatabase
+_STATEMENT_CACHE_SIZE = 256
+
+# Words in a statement that can refer to a table
+_IDENTIFIER = re.compile(r'[a-z_][a-z0-9_]*')
+
+# Size of the blocks read when computing checksums
+_BLOCK_SIZE = 1 << 20
+
+# Steps of query plans that usually make a statement slow, and their description
+_PLAN_WARNINGS = ((re.compile(r'^SCAN (\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX \w+)?$'), 'full scan'),
+                  (re.compile(r'AUTOMATIC (?:PARTIAL )?(?:COVERING )?INDEX'), 'automatic index'),
+                  (re.compile(r'^USE TEMP B-TREE'), 'temporary b-tree'))
+
+# Columns of the automatic indexes in query plans
+_AUTOMATIC_INDEX = re.compile(r'^SEARCH (\w+) USING AUTOMATIC (?:PARTIAL )?(?:COVERING )?INDEX \((.*)\)')
+
+# Tables (and their aliases) in the FROM clauses of a statement
+_FROM_TABLE = re.compile(r'(?:\bfrom\b|\bjoin\b|,)\s*(\w+)(?:\s+(?:as\s+)?(?!(?:where|on|using|join|inner|left|'
+                         r'right|full|cross|natural|group|order|limit|union|except|intersect|window)\b)(\w+))?',
+                         re.IGNORECASE)
+
+# Maximum number of indexes tried for each table when suggesting indexes
+_MAX_INDEX_CANDIDATES = 16
+
+# Virtual machine instructions between two checks of a StatementBudget
+_PROGRESS_STEPS = 1000
+
+# Maximum number of columns of each side table of a wide table
+_WIDE_PARTITION_COLUMNS = 1000
+
+# Names of the side tables of the wide and dictionary encoded tables, after the name of the table
+_SIDE_TABLE = re.compile(r'^(\w+)__(?:\d+|encoded|values_\d+)$')
+
+# Rows read before choosing the columns of a dictionary encoded table
+_DICTIONARY_SAMPLE_ROWS = 10000
+
+# Maximum number of distinct values in the sample of a dictionary encoded column
+_DICTIONARY_MAX_VALUES = 1000
+
+# Minimum number of rows of the sample per distinct value of a dictionary encoded column
+_DICTIONARY_MIN_REPEATS = 4
+
+# Minimum average length of the values in the sample of a dictionary encoded column
+_DICTIONARY_MIN_LENGTH = 3
+
+# Folder of the cache keeping the row offsets of the csv files read by MappedCsv
+_INDEX_CACHE = 'index'
+
+# Digests kept in memory by RowCleaner before spilling them to a temporary table
+_DEDUPE_DIGESTS = 1 << 18
+
+# Temporary table where RowCleaner spills the digests of the rows already seen
+_DIGESTS_TABLE = '__csvsql_digests'
+
+# Statements inserting rows into a keyed table for each policy on duplicated keys
+_DUPLICATE_POLICIES = { 'error': 'insert', 'first': 'insert or ignore', 'last': 'insert or replace' }
+
+# Temporary table where the rows out of order of a keyed table are sorted
+_STAGING_TABLE = '__csvsql_staging'
+
+# Rows fetched at once by execute_columnar()
+_COLUMNAR_CHUNK_ROWS = 4096
+
+# Kinds of the columns of execute_columnar(), from the narrowest to the widest,
+# with their numpy dtype and array typecode (None for a list)
+_COLUMN_KINDS = (('int', 'int64', 'q'), ('float', 'float64', 'd'), ('object', 'object', None))
+
+# Largest integer a float keeps exactly
+_MAX_EXACT_INTEGER = 2 ** 53
+
+# Statements query_csv() computes: a select from a single table with optional
+# where and group by clauses, whose contents are checked further
+_COLUMNAR_QUERY = re.compile(r'^\s*select\s+(.+?)\s+from\s+(\w+)\s*(?:\bwhere\s+(.+?))?\s*'
+                             r'(?:\bgroup\s+by\s+(\w+(?:\s*,\s*\w+)*))?\s*;?\s*$', re.IGNORECASE | re.DOTALL)
+
+# Items of the statements of query_csv(): *, a column or an aggregate, with an optional alias
+_COLUMNAR_ITEM = re.compile(r'\s*((\*)|(\w+)|(count|sum|avg|total|min|max)\s*\(\s*(\*|\w+)\s*\))'
+                            r'(?:\s+as\s+(\w+))?\s*$', re.IGNORECASE)
+
+# Conditions of the statements of query_csv(): comparisons of a column with a text literal joined by and
+_COLUMNAR_PREDICATE = re.compile(r"\s*(?:(?<=\s)(and)\s+)?(\w+)\s*(==|=|!=|<>|<=|>=|<|>)\s*'((?:[^']|'')*)'\s*",
+                                 re.IGNORECASE)
+
+# Comparison operators of the conditions of query_csv()
+_COLUMNAR_OPERATORS = { '=': operator.eq, '==': operator.eq, '!=': operator.ne, '<>': operator.ne,
+                        '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge }
+
+# Text values sqlite3 considers integers and the numeric prefix it takes from any other text
+_SQLITE_INTEGER = re.compile(r'[ \t\n\v\f\r]*[+-]?[0-9]+[ \t\n\v\f\r]*')
+_SQLITE_NUMBER = re.compile(r'[ \t\n\v\f\r]*[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?')
+
+# Since sqlite3 3.43, sums of real values are compensated, so they can't be reproduced adding them in order
+_SEQUENTIAL_REAL_SUMS = sqlite3.sqlite_version_info < (3, 43)
+
+# Table keeping the definitions of the materialized aggregates. The tables
+# keeping their results are named after it and the name of each aggregate
+_MATERIALIZED_TABLE = '__csvsql_materialized'
+
+# Definitions of materialized aggregates that can be maintained from the appended rows
+_MATERIALIZED_QUERY = re.compile(r'^\s*select\s+(.+?)\s+from\s+(\w+)(?:\s+where\s+(.+?))?'
+                                 r'(?:\s+group\s+by\s+(.+?))?\s*;?\s*$', re.IGNORECASE | re.DOTALL)
+
+# Clauses preventing the maintenance of a materialized aggregate from the appended rows
+_NOT_DISTRIBUTIVE = re.compile(r'\b(?:select|having|order|limit|join|union|intersect|except|over|distinct|'
+                               r'random|group_concat)\b', re.IGNORECASE)
+
+# Aggregates of a materialized aggregate, with an optional alias (with or without as)
+_MATERIALIZED_AGGREGATE = re.compile(r'^\s*(sum|count|min|max|avg|total)\s*\((.*)\)\s*(?:(?:\bas\s+)?\b\w+)?\s*$',
+                                     re.IGNORECASE | re.DOTALL)
+
+# Expression merging the stored value of an aggregate (%(stored)s) with the one of the appended rows
+_MERGED_AGGREGATES = {
+        'sum': 'case when %(new)s is null then %(stored)s when %(stored)s is null then %(new)s '
+               'else %(stored)s + %(new)s end',
+        'count': '%(stored)s + %(new)s',
+        'total': '%(stored)s + %(new)s',
+        'min': 'case when %(new)s is null then %(stored)s when %(stored)s is null then %(new)s '
+               'else min(%(stored)s, %(new)s) end',
+        'max': 'case when %(new)s is null then %(stored)s when %(stored)s is null then %(new)s '
+               'else max(%(stored)s, %(new)s) end' }
+
+# Rows imported between calls to the monitor of an import
+_MONITOR_ROWS = 10000
+
 
 def import_csv(db, contents_fileobject, table_name,
-               dialect=csv.excel, header=None):
+               dialect=csv.excel, header=None, stats=None, cleaner=None,
+               key=None, duplicates='error', dictionary=False, monitor=None):
     """ Imports the contents into a table named table_name in db
 
         db: a connection to the database
@@ -23,9 +219,40 @@ def import_csv(db, contents_fileobject, table_name,
         table_name: the name of the table where to store the contents. If the
                     table already exists, its former contents will be
                     overwritten
+
+        stats: when a dict, it gets the statistics of the imported rows as
+               described in new_stats()
+
+        cleaner: when not None, the RowCleaner filtering the rows while they
+                 are read
+
+        key: when not None, the list of names of the columns that form the
+             primary key of the table, which is then created WITHOUT ROWID.
+             Rows already sorted by the key are inserted as they come, while
+             the rest are sorted before being inserted
+
+        duplicates: what to do with the rows with an already imported key:
+                    'error' raises sqlite3.IntegrityError, 'first' keeps the
+                    first row with the key and 'last' keeps the last one
+
+        dictionary: when True, the columns with few distinct values, long
+                    enough to be worth it, are dictionary encoded as
+                    described in _create_encoded_table(). Ignored with key
+                    and on wide tables
+
+        monitor: when not None, a function called with db every _MONITOR_ROWS
+                 rows read. An exception raised by it stops the import
     """
 
-    reader = csv.reader(contents_fileobject, dialect)
+    _import_rows(db, csv.reader(contents_fileobject, dialect), table_name, header, stats, cleaner,
+                 key, duplicates, dictionary, monitor)
+
+
+def _import_rows(db, reader, table_name, header=None, stats=None, cleaner=None, key=None, duplicates='error',
+                 dictionary=False, monitor=None):
+    """ imports the rows of the csv reader into a table named table_name in db,
+        as described in import_csv(). The former table is replaced within a
+        transaction, so it remains when the import fails """
     source_headers = next(reader, None) if header is None else header.split(',')
     column_counter = 0
     default_column_name = _DEFAULT_COLUMN_NAME + "%d"
@@ -42,43 +269,2228 @@ def import_csv(db, contents_fileobject, table_name,
         column_counter += 1
         return source_column_name if source_column_name else default_column_name % column_counter
 
-    colstr = ','.join(normalize_column_name(col) for col in source_headers)
-    db.execute('drop table if exists %s;' % table_name)
-    db.execute('create table %s (%s);' % (table_name, colstr))
-    for row in reader:
-        while len(row) > column_counter:
-            new_column = normalize_column_name()
-            db.execute('alter table %s add column %s' % (table_name,
-                                                         new_column))
-        values = row + [''] * (column_counter - len(row))
-        params = ','.join('?' for i in range(column_counter))
-        sql = 'insert into %s values (%s);' % (table_name, params)
-        db.execute(sql, values)
+    columns = [ normalize_column_name(col) for col in source_headers ]
+    began = not db.in_transaction
+    if began:
+        db.execute('begin immediate')   # so that on errors the former table remains
+    try:
+        _drop_table(db, table_name)
+        if monitor is not None:
+            reader = _monitored(db, reader, monitor)
+        if cleaner is not None:
+            reader = cleaner.clean(db, reader, columns if header != '' else None)
+        if key:
+            unknown = [ name for name in key if name not in columns ]
+            if unknown:
+                raise ValueError('unknown key column %s' % ', '.join(unknown))
+            if len(columns) >= db.getlimit(sqlite3.SQLITE_LIMIT_COLUMN):
+                raise ValueError('a key is not supported on a table with %d columns' % len(columns))
+            db.execute('create table %s (%s, primary key (%s)) without rowid;' % (table_name, ','.join(columns),
+                                                                                 ','.join(key)))
+            _insert_keyed_rows(db, table_name, reader, columns, key, duplicates, stats)
+        elif dictionary and len(columns) < db.getlimit(sqlite3.SQLITE_LIMIT_COLUMN):
+            sample = list(itertools.islice(reader, _DICTIONARY_SAMPLE_ROWS))
+            _create_encoded_table(db, table_name, columns, _choose_dictionary_columns(sample, len(columns)))
+            _insert_encoded_rows(db, table_name, itertools.chain(sample, reader), stats)
+        elif len(columns) < db.getlimit(sqlite3.SQLITE_LIMIT_COLUMN):
+            db.execute('create table %s (%s);' % (table_name, ','.join(columns)))
+            _insert_rows(db, table_name, reader, column_counter, stats)
+        else:
+            _create_wide_table(db, table_name, columns)
+            _insert_wide_rows(db, table_name, reader, stats=stats)
+        if stats is not None:
+            stats['columns'] = get_column_names(db, table_name)
+    except BaseException:
+        if began:
+            db.rollback()
+        raise
+    db.commit()
+
+
+def _monitored(db, rows, monitor):
+    """ generator of the rows calling monitor(db) every _MONITOR_ROWS of them """
+    for number, row in enumerate(rows, 1):
+        if number % _MONITOR_ROWS == 0:
+            monitor(db)
+        yield row
+
+
+def append_csv(db, contents_fileobject, table_name, dialect=csv.excel):
+    """ Appends the contents to the already existing table named table_name in db
+
+        db: a connection to the database
+
+        contents_fileobject: a file object containing the csv contents, without headers
+
+        table_name: the name of the table where to append the contents. When a row
+                    contains more columns than the table, the missing ones are added
+                    as in import_csv()
+    """
+    rows = csv.reader(contents_fileobject, dialect)
+    if _is_wide_table(db, table_name):
+        first_row = db.execute('select max(__row) from %s__1' % table_name).fetchone()[0] or 0
+        _insert_wide_rows(db, table_name, rows, first_row + 1)
+    elif _is_encoded_table(db, table_name):
+        _insert_encoded_rows(db, table_name, rows)
+    else:
+        column_count = len(db.execute('pragma table_info(%s)' % table_name).fetchall())
+        _insert_rows(db, table_name, rows, column_count)
+    db.commit()
+
+
+def _insert_rows(db, table_name, rows, column_count, stats=None, verb='insert'):
+    """ inserts the rows into the table with column_count columns, adding
+        columns named after _DEFAULT_COLUMN_NAME and their position when a row
+        is longer than the table, and filling shorter rows with ''.
+        When stats is a dict, it is updated with the inserted values.
+        verb is the insert statement to use (e.g. 'insert or ignore').
+        It returns the final number of columns of the table """
+    if stats is not None:
+        stats.update(new_stats())
+        rows = _counting_stats(rows, stats, column_count)
+    sql = _get_insert_statement(table_name, column_count, verb)
+    for row in rows:
+        if len(row) > column_count:
+            while len(row) > column_count:
+                column_count += 1
+                db.execute('alter table %s add column %s' % (table_name,
+                                                             _DEFAULT_COLUMN_NAME + str(column_count)))
+            sql = _get_insert_statement(table_name, column_count, verb)
+        if len(row) < column_count:
+            row = row + [''] * (column_count - len(row))
+        db.execute(sql, row)
+    return column_count
+
+
+def _get_insert_statement(table_name, column_count, verb='insert'):
+    """ returns the statement inserting a row of column_count values into the table """
+    return '%s into %s values (%s);' % (verb, table_name, ','.join('?' * column_count))
+
+
+def _insert_keyed_rows(db, table_name, rows, columns, key, duplicates='error', stats=None):
+    """ inserts the rows as _insert_rows() does into the table with the
+        columns and the primary key formed by the columns named in key.
+        Duplicated keys are handled according to duplicates, as described in
+        import_csv().
+        While the rows come sorted by the key, they are inserted as they come,
+        since each one is just appended to the b-tree of the table. The rows
+        from the first one out of order are staged in a temporary table and
+        inserted at the end, sorted by the key and then by their position """
+    verb = _DUPLICATE_POLICIES[duplicates]
+    rows = iter(rows)
+    if stats is not None:
+        stats.update(new_stats())
+        rows = _counting_stats(rows, stats, len(columns))
+    indexes = [ columns.index(name) for name in key ]
+    unsorted = []
+
+    def sorted_rows():
+        last = None
+        for row in rows:
+            current = [ row[index] if index < len(row) else '' for index in indexes ]
+            if last is not None and current < last:
+                unsorted.append(row)
+                return
+            last = current
+            yield row
+
+    column_count = _insert_rows(db, table_name, sorted_rows(), len(columns), verb=verb)
+    if not unsorted:
+        return
+    db.execute('drop table if exists temp.%s' % _STAGING_TABLE)
+    db.execute('create temp table %s as select * from main.%s where 0' % (_STAGING_TABLE, table_name))
+    staged_count = _insert_rows(db, 'temp.' + _STAGING_TABLE, itertools.chain(unsorted, rows), column_count)
+    for position in range(column_count + 1, staged_count + 1):
+        db.execute('alter table %s add column %s' % (table_name, _DEFAULT_COLUMN_NAME + str(position)))
+    db.execute('%s into %s select * from temp.%s order by %s, rowid' % (verb, table_name, _STAGING_TABLE,
+                                                                        ','.join(key)))
+    db.execute('drop table temp.%s' % _STAGING_TABLE)
+
+
+def _create_wide_table(db, table_name, columns):
+    """ creates a wide table named table_name with the columns. A wide table
+        keeps its columns in side tables named table_name__1, table_name__2,
+        ... of up to _WIDE_PARTITION_COLUMNS columns each plus the row number
+        __row, and a view named table_name joins them back. Since a view can't
+        have more columns than a table, the view gets as many of them as
+        sqlite3 allows, and the rest are split in views named
+        table_name__columns_2, table_name__columns_3, ... with the row number
+        __row followed by the next columns """
+    size = min(_WIDE_PARTITION_COLUMNS, db.getlimit(sqlite3.SQLITE_LIMIT_COLUMN) - 1)
+    for number, start in enumerate(range(0, len(columns), size), 1):
+        db.execute('create table %s__%d (__row integer primary key, %s)' % (table_name, number,
+                                                                            ','.join(columns[start:start + size])))
+    _create_wide_view(db, table_name)
+
+
+def _create_wide_view(db, table_name):
+    """ (re)creates the views joining the side tables of the wide table. They
+        start from the first side table, the only one with all the rows """
+    partitions = _get_partitions(db, table_name)
+    limit = db.getlimit(sqlite3.SQLITE_LIMIT_COLUMN)
+    columns = [ (name, column) for name, names in partitions for column in names ]
+    db.execute('drop view if exists %s' % table_name)
+    for name in _get_wide_views(db, table_name):
+        db.execute('drop view %s' % name)
+    views = [ (table_name, columns[:limit]) ]
+    views.extend(('%s__columns_%d' % (table_name, number),
+                  [ (partitions[0][0], '__row') ] + columns[start:start + limit - 1])
+                 for number, start in enumerate(range(limit, len(columns), limit - 1), 2))
+    for view, view_columns in views:
+        names = list(dict.fromkeys([ partitions[0][0] ] + [ name for name, column in view_columns ]))
+        joins = ' '.join('left join %s using (__row)' % name for name in names[1:])
+        db.execute('create view %s as select %s from %s %s' % (view, ','.join('%s.%s' % pair for pair in view_columns),
+                                                                 names[0], joins))
+
+
+def _insert_wide_rows(db, table_name, rows, first_row=1, stats=None):
+    """ inserts the rows into the side tables of the wide table, numbering
+        them from first_row. Longer rows get new columns as in _insert_rows() """
+    partitions = _get_partitions(db, table_name)
+    size = min(_WIDE_PARTITION_COLUMNS, db.getlimit(sqlite3.SQLITE_LIMIT_COLUMN) - 1)
+    column_count = sum(len(names) for name, names in partitions)
+    if stats is not None:
+        stats.update(new_stats())
+        rows = _counting_stats(rows, stats, column_count)
+    statements = [ _get_insert_statement(name, len(names) + 1) for name, names in partitions ]
+    grown = False
+    for number, row in enumerate(rows, first_row):
+        if len(row) > column_count:
+            while len(row) > column_count:
+                column_count += 1
+                column = _DEFAULT_COLUMN_NAME + str(column_count)
+                name, names = partitions[-1]
+                if len(names) < size:
+                    db.execute('alter table %s add column %s' % (name, column))
+                    names.append(column)
+                else:
+                    name = '%s__%d' % (table_name, len(partitions) + 1)
+                    db.execute('create table %s (__row integer primary key, %s)' % (name, column))
+                    partitions.append((name, [ column ]))
+            statements = [ _get_insert_statement(name, len(names) + 1) for name, names in partitions ]
+            grown = True
+        start = 0
+        for (name, names), statement in zip(partitions, statements):
+            values = row[start:start + len(names)]
+            if len(values) < len(names):
+                values += [''] * (len(names) - len(values))
+            db.execute(statement, [ number ] + values)
+            start += len(names)
+    if grown:
+        _create_wide_view(db, table_name)
+
+
+def _get_wide_views(db, table_name):
+    """ returns the names of the views with the columns of the wide table
+        table_name beyond the ones of its main view """
+    pattern = re.compile(re.escape(table_name) + r'__columns_(\d+)$')
+    return [ row[0] for row in db.execute("select name from sqlite_master where type = 'view' and name glob ?",
+                                          (table_name + '__columns_[0-9]*',)) if pattern.match(row[0]) ]
+
+
+def _is_wide_table(db, table_name):
+    """ returns True when table_name is a wide table (see _create_wide_table()) """
+    return db.execute("select 1 from sqlite_master where type = 'view' and name = ?",
+                      (table_name,)).fetchone() is not None and bool(_get_partitions(db, table_name))
+
+
+def _get_partitions(db, table_name):
+    """ returns the list of pairs (name, list of column names) of the side
+        tables of the wide table table_name, in order """
+    pattern = re.compile(re.escape(table_name) + r'__(\d+)$')
+    names = [ row[0] for row in db.execute("select name from sqlite_master where type = 'table' and name glob ?",
+                                           (table_name + '__[0-9]*',)) if pattern.match(row[0]) ]
+    names.sort(key=lambda name: int(pattern.match(name).group(1)))
+    return [ (name, [ row[1] for row in db.execute('pragma table_info(%s)' % name) ][1:]) for name in names ]
+
+
+def _create_encoded_table(db, table_name, columns, positions):
+    """ creates a dictionary encoded table named table_name with the columns.
+        Its rows are kept in the table table_name__encoded, where the columns
+        at positions (zero based) get integer codes instead of their values.
+        The values of each of them are kept in a dictionary table
+        table_name__values_N (N being the one based position of the column)
+        with the columns code and value, and a view named table_name joins
+        them back. Text repeated on many rows is so stored just once """
+    db.execute('create table %s__encoded (%s)' % (table_name, ','.join(columns)))
+    for position in positions:
+        db.execute('create table %s__values_%d (code integer primary key, value)' % (table_name, position + 1))
+    _create_encoded_view(db, table_name)
+
+
+def _create_encoded_view(db, table_name):
+    """ (re)creates the view joining the dictionaries of the encoded table """
+    dictionaries = _get_dictionaries(db, table_name)
+    columns, joins = [], []
+    for position, column in enumerate(get_column_names(db, table_name + '__encoded')):
+        if position in dictionaries:
+            columns.append('d%d.value as %s' % (position + 1, column))
+            joins.append('left join %s d%d on d%d.code = e.%s' % (dictionaries[position], position + 1,
+                                                                 position + 1, column))
+        else:
+            columns.append('e.%s' % column)
+    db.execute('drop view if exists %s' % table_name)
+    db.execute('create view %s as select %s from %s__encoded e %s' % (table_name, ','.join(columns), table_name,
+                                                                      ' '.join(joins)))
+
+
+def _choose_dictionary_columns(rows, column_count):
+    """ returns the positions of the columns, out of the first column_count,
+        worth encoding according to the values they get on rows: few distinct
+        values, repeated on many rows and long enough for an integer code to
+        take less space """
+    positions = []
+    for position in range(column_count):
+        values = [ row[position] if position < len(row) else '' for row in rows ]
+        distinct = len(set(values))
+        if (distinct <= _DICTIONARY_MAX_VALUES and distinct * _DICTIONARY_MIN_REPEATS <= len(values)
+                and sum(len(value) for value in values) >= _DICTIONARY_MIN_LENGTH * len(values)):
+            positions.append(position)
+    return positions
+
+
+def _insert_encoded_rows(db, table_name, rows, stats=None):
+    """ inserts the rows into the dictionary encoded table, adding the new
+        values to the dictionaries. Longer rows get new columns, not encoded,
+        as in _insert_rows() """
+    column_count = len(get_column_names(db, table_name + '__encoded'))
+    dictionaries = {}
+    for position, name in _get_dictionaries(db, table_name).items():
+        dictionaries[position] = (name, { value: code for code, value in db.execute('select code, value from %s' %
+                                                                                    name) })
+    if stats is not None:
+        stats.update(new_stats())
+        rows = _counting_stats(rows, stats, column_count)
+
+    def encoded_rows():
+        for row in rows:
+            row = row + [''] * (column_count - len(row))
+            for position, (name, codes) in dictionaries.items():
+                code = codes.get(row[position])
+                if code is None:
+                    code = codes[row[position]] = len(codes) + 1
+                    db.execute('insert into %s values (?, ?)' % name, (code, row[position]))
+                row[position] = code
+            yield row
+
+    if _insert_rows(db, table_name + '__encoded', encoded_rows(), column_count) > column_count:
+        _create_encoded_view(db, table_name)
+
+
+def _is_encoded_table(db, table_name):
+    """ returns True when table_name is a dictionary encoded table (see _create_encoded_table()) """
+    return db.execute("select count(*) from sqlite_master where (type = 'view' and name = ?) or "
+                      "(type = 'table' and name = ?)", (table_name, table_name + '__encoded')).fetchone()[0] == 2
+
+
+def _get_dictionaries(db, table_name):
+    """ returns a dict {position of the column (zero based): name of its
+        dictionary table} with the encoded columns of the table table_name """
+    pattern = re.compile(re.escape(table_name) + r'__values_(\d+)$')
+    names = [ row[0] for row in db.execute("select name from sqlite_master where type = 'table' and name glob ?",
+                                           (table_name + '__values_[0-9]*',)) if pattern.match(row[0]) ]
+    return { int(pattern.match(name).group(1)) - 1: name for name in names }
+
+
+def _drop_table(db, table_name):
+    """ drops the table named table_name, including the side tables when it
+        is a wide table or a dictionary encoded one """
+    if _is_wide_table(db, table_name):
+        db.execute('drop view %s' % table_name)
+        for name in _get_wide_views(db, table_name):
+            db.execute('drop view %s' % name)
+        for name, names in _get_partitions(db, table_name):
+            db.execute('drop table %s' % name)
+    elif _is_encoded_table(db, table_name):
+        db.execute('drop view %s' % table_name)
+        db.execute('drop table %s__encoded' % table_name)
+        for name in _get_dictionaries(db, table_name).values():
+            db.execute('drop table %s' % name)
+    else:
+        row = db.execute("select type from sqlite_master where type in ('table', 'view') and name = ?",
+                         (table_name,)).fetchone()
+        if row is not None:
+            db.execute('drop %s %s' % (row[0], table_name))
+
+
+def get_column_names(db, table_name):
+    """ returns the list of the names of the columns of the table, including
+        the ones kept just on the side tables of a wide table """
+    if _is_wide_table(db, table_name):
+        return [ column for name, names in _get_partitions(db, table_name) for column in names ]
+    return [ row[1] for row in db.execute('pragma table_info(%s)' % table_name) ]
+
+
+class RowCleaner:
+    """ Filters the rows of a csv file while they are imported, so that the
+        dirty rows never reach the database.
+
+        dedupe: when True, just the first occurrence of each row is kept. The
+                rows are compared by their blake2b digest. Once max_digests
+                digests are kept in memory, they are moved to a temporary
+                table of the database, so memory remains bounded
+
+        required: names of the columns that must have a value. Rows with an
+                  empty value (or just spaces) on any of them are discarded.
+                  Unheaded columns are named as in import_csv() (__COL1...)
+
+        headed_only: when True, the values beyond the headed columns are
+                     discarded instead of adding columns to the table
+
+        strict: when True, a row with a number of values different to the
+                number of columns (or to the first row, when unheaded) raises
+                csv.Error
+
+        After the import, duplicates and incomplete have the number of rows
+        discarded for each reason.
+    """
+
+    def __init__(self, dedupe=False, required=(), headed_only=False, strict=False,
+                 max_digests=_DEDUPE_DIGESTS):
+        self.dedupe = dedupe
+        self.required = list(required)
+        self.headed_only = headed_only
+        self.strict = strict
+        self.max_digests = max_digests
+        self.duplicates = 0
+        self.incomplete = 0
+
+    def clean(self, db, rows, columns=None):
+        """ generator of the rows that pass the filters. columns are the names
+            of the columns of the table, or None when the rows are unheaded.
+            Raises ValueError when a required column is unknown """
+        width = len(columns) if columns is not None else None
+        indexes = [ self._get_column_index(columns, name) for name in self.required ]
+        digests = set()
+        spilled = False
+        for number, row in enumerate(rows, 1):
+            if width is None:
+                width = len(row)
+            if self.strict and len(row) != width:
+                raise csv.Error('row %d has %d values instead of %d' % (number, len(row), width))
+            if self.headed_only and columns is not None:
+                row = row[:width]
+            if not all(index < len(row) and row[index].strip() for index in indexes):
+                self.incomplete += 1
+                continue
+            if self.dedupe:
+                padded = row + [''] * (width - len(row)) if len(row) < width else row     # as it is stored
+                digest = hashlib.blake2b(repr(padded).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+                if digest in digests or (spilled and db.execute('select 1 from temp.%s where digest = ?'
+                                                                % _DIGESTS_TABLE, (digest,)).fetchone()):
+                    self.duplicates += 1
+                    continue
+                digests.add(digest)
+                if len(digests) >= self.max_digests:
+                    if not spilled:
+                        db.execute('drop table if exists temp.%s' % _DIGESTS_TABLE)
+                        db.execute('create temp table %s (digest blob primary key) without rowid' % _DIGESTS_TABLE)
+                        spilled = True
+                    db.executemany('insert into temp.%s values (?)' % _DIGESTS_TABLE,
+                                   ((digest,) for digest in digests))
+                    digests.clear()
+            yield row
+        if spilled:
+            db.execute('drop table temp.%s' % _DIGESTS_TABLE)
+
+    @staticmethod
+    def _get_column_index(columns, name):
+        """ returns the position of the column named name """
+        if columns is not None and name in columns:
+            return columns.index(name)
+        match = re.fullmatch(re.escape(_DEFAULT_COLUMN_NAME) + r'([1-9][0-9]*)', name)
+        if columns is None and match:
+            return int(match.group(1)) - 1
+        raise ValueError('unknown column %s' % name)
+
+
+def new_stats():
+    """ returns the statistics of an empty table. Statistics are a dict with:
+        - 'rows': the number of rows
+        - 'columns': the names of the columns
+        - 'min', 'max' and 'empty': lists with, for each column, the minimum and
+          maximum values (None when no value) and the number of empty values
+        - 'nulls': list with, for each column, the number of rows that got
+          NULL because the column was added after them
+        Values are compared as sqlite3 compares text values """
+    return { 'rows': 0, 'columns': [], 'min': [], 'max': [], 'empty': [], 'nulls': [] }
+
+
+def _counting_stats(rows, stats, column_count):
+    """ generator of the rows updating stats, for a table with initially
+        column_count columns, with each of them """
+    minimums, maximums, empties, nulls = stats['min'], stats['max'], stats['empty'], stats['nulls']
+
+    def add_columns(count):
+        # the columns are added to the table, so the previous rows get NULL
+        while len(minimums) < count:
+            minimums.append(None)
+            maximums.append(None)
+            empties.append(0)
+            nulls.append(stats['rows'])
+
+    add_columns(column_count)
+    for row in rows:
+        add_columns(len(row))
+        stats['rows'] += 1
+        for position, value in enumerate(row):
+            if not value:
+                empties[position] += 1
+            if minimums[position] is None or value < minimums[position]:
+                minimums[position] = value
+            if maximums[position] is None or value > maximums[position]:
+                maximums[position] = value
+        for position in range(len(row), len(minimums)):
+            # shorter rows are filled with ''
+            empties[position] += 1
+            minimums[position] = ''
+            if maximums[position] is None:
+                maximums[position] = ''
+        yield row
+
+
+def get_csv_stats(path, header=None, dialect=csv.excel):
+    """ returns the statistics recorded on the last import of the csv file
+        at path, read with header and dialect as in import_csv(), as
+        described in new_stats(), or None when there are no statistics for
+        its current contents read that way """
+    entry = load_cache(_STATS_CACHE).get(_get_stats_key(path, header, dialect))
+    if entry is None or entry[0] != _get_fingerprint(path) or 'nulls' not in entry[1]:
+        return None
+    return entry[1]
+
+
+def save_csv_stats(records):
+    """ records the statistics of the csv files in records, a list of tuples
+        (path, stats, header, dialect), for their current contents read with
+        header and dialect """
+    if not records:
+        return
+    cache = load_cache(_STATS_CACHE)
+    for path, stats, header, dialect in records:
+        cache[_get_stats_key(path, header, dialect)] = [ _get_fingerprint(path), stats ]
+    save_cache(_STATS_CACHE, cache)
+
+
+def _get_stats_key(path, header, dialect):
+    """ returns the key of the statistics of the file at path read with header and dialect """
+    return json.dumps([ str(path.resolve()), header, list(_get_dialect_key(dialect)) ])
+
+
+def _get_fingerprint(path):
+    """ returns a str identifying the current contents of the file at path """
+    stat = path.stat()
+    return '%d:%d' % (stat.st_size, stat.st_mtime_ns)
+
+
+def get_range_predicates(statement, table_name):
+    """ returns the list of predicates of statement that any row of
+        table_name must satisfy to be part of the results, as tuples
+        (column, operator, value) where operator is one of =, <, <=, > or >=
+        and value is a text literal.
+
+        Just statements selecting from table_name alone with a where clause
+        consisting of predicates joined by and are considered. For the rest,
+        it returns None, meaning any row could be part of the results.
+    """
+    match = _SIMPLE_SELECT.match(statement)
+    if match is None or match.group(1).lower() != table_name.lower():
+        return None
+    if re.search(r'\bselect\b', match.group(0)[1:], re.IGNORECASE) or ';' in statement.strip()[:-1]:
+        return None
+    where = match.group(2)
+    if not where:
+        return []
+    if not _RANGE_CONDITION.match(where):
+        return None
+    predicates = []
+    for column, operator, value, low, high in _RANGE_PREDICATE.findall(where):
+        if low or high:
+            predicates.extend([ (column, '>=', low[1:-1].replace("''", "'")),
+                                (column, '<=', high[1:-1].replace("''", "'")) ])
+        else:
+            predicates.append((column, '=' if operator == '==' else operator, value[1:-1].replace("''", "'")))
+    return predicates
+
+
+def may_match(stats, predicates):
+    """ returns False when, according to stats, no row of the table can
+        satisfy all the predicates, as returned by get_range_predicates() """
+    for column, operator, value in predicates or []:
+        if column not in stats['columns']:
+            continue
+        position = stats['columns'].index(column)
+        minimum, maximum = stats['min'][position], stats['max'][position]
+        if minimum is None:
+            return False
+        if ((operator == '=' and not minimum <= value <= maximum) or
+                (operator == '<' and not minimum < value) or
+                (operator == '<=' and not minimum <= value) or
+                (operator == '>' and not maximum > value) or
+                (operator == '>=' and not maximum >= value)):
+            return False
+    return True
+
+
+def prune_shards(paths, statements, table_name, dialect=csv.excel):
+    """ returns the paths of the shards of table_name that could contribute to
+        the results of any of the statements according to their recorded
+        statistics, read with dialect. Shards without statistics are always
+        kept """
+    predicate_lists = [ get_range_predicates(statement, table_name) for statement in statements
+                        if re.search(r'\b%s\b' % re.escape(table_name), statement, re.IGNORECASE) ]
+    kept = []
+    for path in paths:
+        stats = get_csv_stats(path, dialect=dialect)
+        if stats is None or any(may_match(stats, predicates) for predicates in predicate_lists):
+            kept.append(path)
+    return kept
+
+
+def import_csv_incrementally(db, path, table_name, dialect=csv.excel, header=None, encoding=None,
+                             dictionary=False):
+    """ Imports the contents of the csv file at path into a table named
+        table_name in db as import_csv() does, but avoiding to read again the
+        contents already imported. The file is decoded with encoding (by
+        default, the preferred one of the system). The appended rows of a
+        dictionary encoded table are encoded with its dictionaries.
+
+        For each table, db keeps the size of the file at the last import and a
+        checksum of its contents. When the file has just grown since then, only
+        the appended rows are read and inserted. When it hasn't changed, nothing
+        is done. Otherwise, the table is imported again from scratch.
+
+        Note: the rows of the table that were modified after the last import
+        keep their modifications
+    """
+    _create_imports_table(db)
+    source = str(path.resolve())
+    mode = '' if header is None else header
+    record = db.execute('select path, header, offset, checksum from %s where table_name = ?' % _IMPORTS_TABLE,
+                        (table_name,)).fetchone()
+    table_exists = (db.execute("select 1 from sqlite_master where type = 'table' and name = ?",
+                               (table_name,)).fetchone() is not None or _is_encoded_table(db, table_name)
+                    or _is_wide_table(db, table_name))
+    with path.open('rb') as fb:
+        size = os.fstat(fb.fileno()).st_size
+        checksum = hashlib.sha1()
+        offset = 0
+        if table_exists and record is not None and record[:2] == (source, mode) and record[2] <= size:
+            last_byte = _update_checksum(checksum, fb, record[2])
+            if checksum.hexdigest() == record[3] and last_byte in (b'', b'\n'):
+                offset = record[2]
+            else:
+                checksum = hashlib.sha1()
+                fb.seek(0)
+        if offset == size and offset > 0:
+            return
+        if offset > 0 and encoding == 'utf-8-sig':
+            encoding = 'utf-8'          # the byte order mark is just at the start of the file
+        contents = io.TextIOWrapper(io.BufferedReader(_ChecksumReader(fb, size - offset, checksum)), encoding=encoding)
+        if offset == 0:
+            import_csv(db, contents, table_name, dialect=dialect, header=header, dictionary=dictionary)
+        else:
+            append_csv(db, contents, table_name, dialect=dialect)
+    db.execute('insert or replace into %s values (?, ?, ?, ?, ?)' % _IMPORTS_TABLE,
+               (table_name, source, mode, size, checksum.hexdigest()))
     db.commit()
 
 
-def import_csv_list(db, pairs_type_path):
+def _create_imports_table(db):
+    """ creates, when missing, the table keeping track of the incremental imports """
+    db.execute('create table if not exists %s (table_name primary key, path, header, offset, checksum)' % _IMPORTS_TABLE)
+
+
+def _update_checksum(checksum, fb, size):
+    """ updates checksum with the next size bytes of fb and returns the last of them """
+    last = b''
+    while size > 0:
+        block = fb.read(min(size, _BLOCK_SIZE))
+        if not block:
+            break
+        checksum.update(block)
+        size -= len(block)
+        last = block[-1:]
+    return last
+
+
+class _ChecksumReader(io.RawIOBase):
+    """ Raw binary stream reading at most limit bytes from fb and updating
+        checksum with them """
+
+    def __init__(self, fb, limit, checksum):
+        super().__init__()
+        self._fb = fb
+        self._limit = limit
+        self._checksum = checksum
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._fb.read(min(len(buffer), self._limit))
+        self._limit -= len(data)
+        self._checksum.update(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def import_csv_mapped(db, path, table_name, dialect=csv.excel, header=None, stats=None, cleaner=None,
+                      key=None, duplicates='error', dictionary=False, monitor=None):
+    """ Imports the contents of the csv file at path into a table named
+        table_name in db as import_csv() does, but reading the file with
+        MappedCsv """
+    with MappedCsv(path, dialect) as contents:
+        _import_rows(db, iter(contents), table_name, header, stats, cleaner, key, duplicates, dictionary, monitor)
+
+
+class MappedCsv:
+    """ Read only access to the rows of a csv file mapped in memory.
+
+        On the first access to a file, its contents are scanned once to build
+        an index with the offset of each row (considering line breaks within
+        quoted fields). The index is kept in the cache folder of csvsql, so
+        that the next times the file is read with the same contents, counting
+        its rows or accessing any of them doesn't require to scan it again.
+
+        The file is expected to be utf-8 encoded, with rows ended by '\\n' or
+        '\\r\\n'. Dialects with escapechar or without doublequote are not
+        supported.
+
+        Example:
+            with MappedCsv(path) as rows:
+                print(len(rows), rows[0], rows[len(rows) - 1])
+    """
+
+    def __init__(self, path, dialect=csv.excel):
+        if (dialect.escapechar is not None or not dialect.doublequote or dialect.quoting == csv.QUOTE_NONE
+                or len(dialect.delimiter.encode()) != 1 or len(dialect.quotechar.encode()) != 1):
+            raise ValueError("dialect not supported by MappedCsv")
+        self.path = pathlib.Path(path)
+        self.dialect = dialect
+        self._delimiter = dialect.delimiter
+        self._quote = dialect.quotechar.encode()
+        with self.path.open('rb') as fb:
+            size = os.fstat(fb.fileno()).st_size
+            self._buffer = mmap.mmap(fb.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.offsets = self._load_index()
+        if self.offsets is None:
+            self.offsets = self._build_index()
+            self._save_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return self._parse(self.offsets[index], self.offsets[index + 1])
+
+    def __iter__(self):
+        return self.rows()
+
+    def rows(self, start=0, stop=None):
+        """ returns an iterator over the rows from start to stop (not
+            included, by default the end of the file) """
+        return itertools.chain.from_iterable(self._read_blocks(start, stop))
+
+    def _read_blocks(self, start, stop):
+        """ yields the rows of each block of about _BLOCK_SIZE bytes of the
+            rows from start to stop. Since the index tells where each row
+            ends, the rows of blocks without quotes are just split on the
+            delimiter, and only blocks with quotes are read with csv.reader """
+        offsets = self.offsets
+        buffer = self._buffer
+        stop = len(self) if stop is None else min(stop, len(self))
+        while start < stop:
+            block_stop = bisect.bisect_left(offsets, offsets[start] + _BLOCK_SIZE, start + 1, stop)
+            text = buffer[offsets[start]:offsets[block_stop]].decode('utf-8')
+            if self.dialect.skipinitialspace or self.dialect.quotechar in text:
+                yield csv.reader(io.StringIO(text, newline=''), self.dialect)
+            else:
+                if '\r' in text:
+                    text = text.replace('\r\n', '\n')
+                if text.endswith('\n'):
+                    text = text[:-1]
+                yield [ line.split(self._delimiter) if line else [] for line in text.split('\n') ]
+            start = block_stop
+
+    def close(self):
+        """ releases the mapping of the file """
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+    def _parse(self, start, end):
+        """ returns the list of fields of the row between the offsets start and end """
+        buffer = self._buffer
+        if buffer.find(self._quote, start, end) >= 0 or self.dialect.skipinitialspace:
+            return next(csv.reader(io.StringIO(buffer[start:end].decode('utf-8'), newline=''), self.dialect), [])
+        text = buffer[start:end].decode('utf-8').rstrip('\r\n')
+        return text.split(self._delimiter) if text else []
+
+    def _build_index(self):
+        """ returns the array of offsets where each row starts, plus the size
+            of the file. The rows of blocks without quotes are found by
+            splitting the lines; rows with quotes are scanned to skip the
+            quoted line breaks """
+        buffer = self._buffer
+        size = len(buffer)
+        offsets = array.array('Q')
+        position = 0
+        while position < size:
+            end = buffer.rfind(b'\n', position, position + _BLOCK_SIZE) + 1
+            quote_at = buffer.find(self._quote, position, end)
+            if quote_at >= 0:
+                end = buffer.rfind(b'\n', position, quote_at) + 1
+            if end > position:
+                lengths = map(operator.add, map(len, buffer[position:end].split(b'\n')), itertools.repeat(1))
+                offsets.extend(itertools.accumulate(lengths, initial=position))
+                offsets.pop()
+                offsets.pop()
+                position = end
+            else:
+                position = self._scan_quoted(position, offsets)
+        offsets.append(size)
+        return offsets
+
+    def _scan_quoted(self, start, offsets):
+        """ appends to offsets the start of the rows from the offset start on,
+            which contain quotes, for about _BLOCK_SIZE bytes, and returns the
+            offset following them. The rows are found by csv.reader, which
+            takes the next line of the buffer just while a row is not
+            complete """
+        buffer = self._buffer
+        size = len(buffer)
+        first = consumed = start
+
+        def lines():
+            nonlocal consumed
+            while consumed < size:
+                position, consumed = consumed, (buffer.find(b'\n', consumed) + 1) or size
+                yield buffer[position:consumed].decode('utf-8')
+
+        for _ in csv.reader(lines(), self.dialect):
+            offsets.append(start)
+            start = consumed
+            if start - first >= _BLOCK_SIZE:
+                break
+        return start
+
+    def _get_index_path(self):
+        """ returns the path of the cached index of the file """
+        key = hashlib.sha1(('%s\0%r' % (self.path.resolve(), _get_dialect_key(self.dialect))).encode())
+        return get_cache_dir() / _INDEX_CACHE / key.hexdigest()
+
+    def _load_index(self):
+        """ returns the cached index when it corresponds to the current
+            contents of the file, or None otherwise """
+        try:
+            with self._get_index_path().open('rb') as fb:
+                if fb.readline().decode().strip() != _get_fingerprint(self.path):
+                    return None
+                offsets = array.array('Q')
+                offsets.frombytes(fb.read())
+        except (OSError, ValueError):
+            return None
+        if not offsets or offsets[-1] != len(self._buffer):
+            return None
+        return offsets
+
+    def _save_index(self):
+        """ keeps the index in the cache. Failures are ignored, since the
+            index can be built again """
+        index_path = self._get_index_path()
+        try:
+            index_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=str(index_path.parent), prefix='.', suffix='.tmp')
+            with open(fd, 'wb') as fb:
+                fb.write((_get_fingerprint(self.path) + '\n').encode())
+                self.offsets.tofile(fb)
+            os.replace(tmp_name, str(index_path))
+        except OSError:
+            pass
+
+
+def _get_dialect_key(dialect):
+    """ returns a tuple with the attributes of dialect affecting the rows found by MappedCsv """
+    return (dialect.delimiter, dialect.quotechar, dialect.skipinitialspace)
+
+
+def get_cache_dir():
+    """ returns the folder where csvsql keeps the information cached between
+        executions. It is taken from the environment variable CSVSQL_CACHE_DIR
+        or, when missing, the folder csvsql in the user's cache folder """
+    if os.environ.get('CSVSQL_CACHE_DIR'):
+        return pathlib.Path(os.environ['CSVSQL_CACHE_DIR'])
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return pathlib.Path(cache_home) / 'csvsql'
+
+
+def load_cache(name):
+    """ returns the dict stored in the cache named name, or an empty dict when
+        it doesn't exist or can't be read """
+    try:
+        contents = json.loads((get_cache_dir() / (name + '.json')).read_text())
+    except (OSError, ValueError):
+        return {}
+    return contents if isinstance(contents, dict) else {}
+
+
+def save_cache(name, contents):
+    """ stores the dict contents as the cache named name. Failures are ignored,
+        since caches are just an optimization """
+    folder = get_cache_dir()
+    try:
+        folder.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=str(folder), prefix='.%s.' % name, suffix='.tmp')
+        with open(fd, 'w') as fo:
+            json.dump(contents, fo)
+        os.replace(tmp_name, str(folder / (name + '.json')))
+    except OSError:
+        pass
+
+
+def sniff_csv(path, sample_bytes=_SNIFF_BYTES):
+    """ returns the format of the csv file at path, detected from its first
+        sample_bytes bytes, as a dict with:
+        - encoding: 'utf-8-sig' when the file starts with the utf-8 byte order
+          mark, 'utf-8' when the sample is valid utf-8, and otherwise 'cp1252'
+          or, when not even valid cp1252, 'latin-1'. An ascii sample doesn't
+          tell them apart, so then the encoding is detected the same way from
+          the first non ascii bytes of the rest of the file, if any
+        - delimiter, quotechar and skipinitialspace, as in csv.Dialect
+        - header: False when the first row looks like data instead of names
+        The format is kept in the cache of csvsql, so that it is not detected
+        again while the file doesn't change """
+    cache = load_cache(_FORMATS_CACHE)
+    source = str(path.resolve())
+    fingerprint = _get_fingerprint(path)
+    entry = cache.get(source)
+    if entry is not None and entry[0] == fingerprint:
+        return entry[1]
+    late_encoding = None
+    with path.open('rb') as fb:
+        sample = fb.read(sample_bytes + 1)
+        if len(sample) > sample_bytes and sample.isascii():
+            late_encoding = _detect_late_encoding(fb, sample_bytes)
+    if len(sample) > sample_bytes:
+        sample = sample[:sample_bytes]
+        sample = sample[:sample.rfind(b'\n') + 1] or sample
+    csv_format = _sniff_sample(sample)
+    if late_encoding is not None:
+        csv_format['encoding'] = late_encoding
+    cache[source] = [ fingerprint, csv_format ]
+    save_cache(_FORMATS_CACHE, cache)
+    return csv_format
+
+
+def _sniff_sample(sample):
+    """ returns the format of the csv contents starting with the bytes of
+        sample, as described in sniff_csv() """
+    encoding, text = _detect_encoding(sample)
+    csv_format = { 'encoding': encoding, 'delimiter': ',', 'quotechar': '"', 'skipinitialspace': False,
+                   'header': True }
+    if not text.strip():
+        return csv_format
+    try:
+        dialect = csv.Sniffer().sniff(text, _SNIFF_DELIMITERS)
+        csv_format.update(delimiter=dialect.delimiter, quotechar=dialect.quotechar or '"',
+                          skipinitialspace=dialect.skipinitialspace)
+    except csv.Error:
+        pass
+    rows = list(itertools.islice(csv.reader(io.StringIO(text), get_csv_dialect(csv_format)), _SNIFF_HEADER_ROWS))
+    csv_format['header'] = _looks_like_header(rows)
+    return csv_format
+
+
+def _detect_encoding(sample):
+    """ returns the pair (encoding, text) of the bytes of sample, as described
+        in sniff_csv(). A character cut at the end of sample is ignored """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig', codecs.getincrementaldecoder('utf-8')('replace').decode(sample[len(codecs.BOM_UTF8):])
+    try:
+        return 'utf-8', codecs.getincrementaldecoder('utf-8')().decode(sample)
+    except UnicodeDecodeError:
+        pass
+    try:
+        return 'cp1252', sample.decode('cp1252')
+    except UnicodeDecodeError:
+        return 'latin-1', sample.decode('latin-1')
+
+
+def _detect_late_encoding(fb, block_bytes):
+    """ returns the encoding of the rest of the binary file fb, read by blocks
+        of block_bytes bytes: the one detected by _detect_encoding() from its
+        first non ascii byte on, or 'utf-8' when all of it is ascii """
+    while True:
+        block = fb.read(block_bytes)
+        if not block:
+            return 'utf-8'
+        first = _NON_ASCII.search(block)
+        if first is not None:
+            return _detect_encoding(block[first.start():] + fb.read(block_bytes))[0]
+
+
+def _looks_like_header(rows):
+    """ returns False when the first of the rows looks like data. Each column
+        with numbers on all the other rows votes for a header when its first
+        value is not a number, and against it otherwise. The same way, each
+        column with values of the same length on all the other rows votes for
+        a header when its first value has a different length. Without votes,
+        the first row is taken as a header """
+    votes = 0
+    for position, first in enumerate(rows[0] if len(rows) > 1 else []):
+        values = [ row[position] for row in rows[1:] if len(row) > position ]
+        if not values:
+            continue
+        if all(_is_number(value) for value in values):
+            votes += -1 if _is_number(first) else 1
+        elif len({ len(value) for value in values }) == 1:
+            votes += -1 if len(first) == len(values[0]) else 1
+    return votes >= 0
+
+
+def _is_number(value):
+    """ returns True when the str value represents a number """
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def get_csv_dialect(csv_format):
+    """ returns a csv.Dialect with the delimiter, quotechar and
+        skipinitialspace in the dict csv_format (see sniff_csv()), and the
+        rest of attributes as csv.excel """
+    return _SniffedDialect(csv_format['delimiter'], csv_format['quotechar'], csv_format['skipinitialspace'])
+
+
+class _SniffedDialect(csv.excel):
+    """ csv.excel with other delimiter, quotechar and skipinitialspace. Its
+        instances can be sent to other processes """
+
+    def __init__(self, delimiter, quotechar, skipinitialspace):
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        self.skipinitialspace = skipinitialspace
+        super().__init__()
+
+
+def get_csv_format(path, sniff=False, delimiter=None, encoding=None):
+    """ returns the tuple (dialect, encoding, header) to read the csv file at
+        path, being header False when its first row is not a header. When
+        sniff, they are detected by sniff_csv(). Otherwise, they are csv.excel,
+        None (the preferred encoding of the system) and True. In both cases,
+        delimiter and encoding replace the detected ones when not None """
+    if not sniff:
+        dialect = csv.excel if delimiter is None else get_csv_dialect({ 'delimiter': delimiter, 'quotechar': '"',
+                                                                          'skipinitialspace': False })
+        return dialect, encoding, True
+    csv_format = dict(sniff_csv(path))
+    if delimiter is not None:
+        csv_format['delimiter'] = delimiter
+    return get_csv_dialect(csv_format), encoding or csv_format['encoding'], csv_format['header']
+
+
+def estimate_import_size(path, sample_rows=1000):
+    """ returns an estimation of the bytes required by a sqlite3 database to
+        store the contents of the csv file at path.
+
+        The estimation is computed from the size of the file and a sample of
+        its first sample_rows rows: the size each row takes in the file and in
+        a sqlite3 record (one byte of header plus the contents for each field,
+        and a few bytes of row overhead)
+    """
+    size = path.stat().st_size
+    with path.open('rb') as fb:
+        sample = list(itertools.islice(fb, sample_rows))
+    sample_bytes = sum(len(line) for line in sample)
+    if sample_bytes == 0:
+        return 0
+    rows = csv.reader(line.decode('utf-8', 'replace') for line in sample)
+    record_bytes = sum(sum(len(field) + 1 for field in row) + _ROW_OVERHEAD for row in rows)
+    return int(size * record_bytes / sample_bytes * _PAGE_OVERHEAD)
+
+
+def import_csv_list(db, pairs_type_path, incremental=False, stats=False, reader='csv', cleaner=None,
+                    keys=None, duplicates='error', sniff=False, delimiter=None, encoding=None, dictionary=False,
+                    monitor=None):
     """ imports the contents of the paths in pairs
 
         pairs_type_path: a list of tuples (option_string, path) where path is
         a pathlib expected to corresponds to a csv files, and option_string
         allows to decide whether the file contains '-i' or not '-u' a header
         row
+
+        incremental: when True, files are imported with
+        import_csv_incrementally()
+
+        stats: when True, the statistics of the files are recorded (see
+        get_csv_stats()). Files imported incrementally get no statistics
+
+        reader: 'csv' to read the files with the csv module, or 'mmap' to read
+        them with MappedCsv (ignored when incremental)
+
+        cleaner: when not None, the RowCleaner filtering the rows of each file
+        (ignored when incremental)
+
+        keys: when not None, a dict with the list of names of the key columns
+        of some tables, created and filled as in import_csv() with duplicates
+        (ignored when incremental)
+
+        sniff, delimiter, encoding: how to read each file, as in
+        get_csv_format(). When sniff, a '-i' file whose first row looks like
+        data is imported as a '-u' one. Files that are not utf-8 are read with
+        the csv module even when reader is 'mmap'
+
+        dictionary: when True, the columns with few distinct values are
+        dictionary encoded, as in import_csv()
+
+        monitor: when not None, a function called with db while the rows are
+        imported, as in import_csv() (ignored when incremental)
+
+        Statistics are not recorded when the rows are filtered by cleaner or
+        by the duplicates policy, since they wouldn't describe the file
     """
+    recorded = []
     for option_string, path in pairs_type_path:
         assert option_string in ['-i', '-u']
         table_name = path.stem
-        header = '' if option_string == '-u' else None
-        with path.open() as fo:
-            import_csv(db, fo, table_name, header=header)
+        dialect, file_encoding, headed = get_csv_format(path, sniff, delimiter, encoding)
+        header = '' if option_string == '-u' or not headed else None
+        if incremental:
+            import_csv_incrementally(db, path, table_name, dialect=dialect, header=header, encoding=file_encoding,
+                                     dictionary=dictionary)
+            continue
+        key = (keys or {}).get(table_name)
+        file_stats = {} if stats and cleaner is None and (key is None or duplicates == 'error') else None
+        if reader == 'mmap' and file_encoding in (None, 'utf-8', 'ascii'):
+            import_csv_mapped(db, path, table_name, dialect=dialect, header=header, stats=file_stats,
+                              cleaner=cleaner, key=key, duplicates=duplicates, dictionary=dictionary, monitor=monitor)
+        else:
+            with path.open(encoding=file_encoding) as fo:
+                import_csv(db, fo, table_name, dialect=dialect, header=header, stats=file_stats, cleaner=cleaner,
+                           key=key, duplicates=duplicates, dictionary=dictionary, monitor=monitor)
+        if file_stats is not None:
+            recorded.append((path, file_stats, header, dialect))
+    save_csv_stats(recorded)
+
+
+def import_csv_shards(db, table_name, paths, dialect=csv.excel,
+                      source_column=None, workers=None, incremental=False,
+                      stats=False, encoding=None):
+    """ Imports the contents of the csv files in paths (shards) into a
+        single table named table_name in db. Shards are expected to have
+        headers.
+
+        The columns of the table are the union of the columns of the shards,
+        in order of appearance. Rows of a shard lacking a column get '' on it.
+
+        source_column: when not None, the table gets an additional column
+                       with this name containing the name of the shard file
+                       of each row. Shard file names must be unique then.
+
+        workers: the shards are parsed by up to this number of processes at
+                 the same time. By default, the number of processors. Up to
+                 two shards per process are parsed ahead of their import, so
+                 the rows kept in memory don't grow with the number of shards.
+
+        incremental: when True and source_column is not None, db keeps the
+                     size and modification time of the imported shards, so
+                     that on the next import of the same table the shards
+                     that haven't changed are not read again, and the rows
+                     of the shards that disappeared are removed.
+                     Otherwise, the table is imported from scratch.
+
+        stats: when True, the statistics of the imported shards are recorded
+               (see get_csv_stats())
+
+        encoding: the encoding of the shards (by default, the preferred one of
+                  the system)
+    """
+    paths = list(paths)
+    if source_column is not None and len({ path.name for path in paths }) < len(paths):
+        raise ValueError("shards of table %s must have unique file names" % table_name)
+    headers = []
+    for path in paths:
+        with path.open(encoding=encoding) as fo:
+            headers.append(next(csv.reader(fo, dialect), []))
+    columns = []
+    for index, names in enumerate(headers):
+        for position, name in enumerate(names):
+            name = name or _DEFAULT_COLUMN_NAME + str(position + 1)
+            headers[index][position] = name
+            if name not in columns:
+                columns.append(name)
+    if source_column is not None and source_column not in columns:
+        columns.append(source_column)
+    fingerprints = { path.name: '%d:%d' % (path.stat().st_size, path.stat().st_mtime_ns) for path in paths }
+    previous = _get_shard_fingerprints(db, table_name) if incremental and source_column is not None else None
+    if previous is None:
+        db.execute('drop table if exists %s;' % table_name)
+        db.execute('create table %s (%s);' % (table_name, ','.join(columns)))
+        pending = list(range(len(paths)))
+    else:
+        current_columns = [ row[1] for row in db.execute('pragma table_info(%s)' % table_name) ]
+        for name in columns:
+            if name not in current_columns:
+                db.execute('alter table %s add column %s' % (table_name, name))
+        columns = current_columns + [ name for name in columns if name not in current_columns ]
+        stale = [ name for name, fingerprint in previous.items() if fingerprints.get(name) != fingerprint ]
+        db.executemany('delete from %s where %s = ?' % (table_name, source_column), [ (name,) for name in stale ])
+        pending = [ index for index, path in enumerate(paths) if previous.get(path.name) != fingerprints[path.name] ]
+    with _get_executor(workers, len(pending)) as executor:
+        shard_rows = _map_ahead(executor, _read_shard, [ (paths[index], dialect, encoding) for index in pending ],
+                                2 * (workers or os.cpu_count() or 1))
+        recorded = []
+        for index, rows in zip(pending, shard_rows):
+            if stats:
+                recorded.append((paths[index], new_stats(), None, dialect))
+                rows = _counting_stats(rows, recorded[-1][1], len(headers[index]))
+            positions = [ columns.index(name) for name in headers[index] ]
+            source = [ (columns.index(source_column), paths[index].name) ] if source_column is not None else []
+            for row in rows:
+                while len(row) > len(positions):
+                    name = _DEFAULT_COLUMN_NAME + str(len(positions) + 1)
+                    if name not in columns:
+                        db.execute('alter table %s add column %s' % (table_name, name))
+                        columns.append(name)
+                    positions.append(columns.index(name))
+                values = [''] * len(columns)
+                for position, value in zip(positions, row):
+                    values[position] = value
+                for position, value in source:
+                    values[position] = value
+                db.execute('insert into %s values (%s);' % (table_name, ','.join('?' * len(values))), values)
+    for path, shard_stats, _, _ in recorded:
+        names = headers[paths.index(path)]
+        shard_stats['columns'] = names + [ _DEFAULT_COLUMN_NAME + str(position + 1)
+                                           for position in range(len(names), len(shard_stats['min'])) ]
+    save_csv_stats(recorded)
+    if source_column is not None and incremental:
+        _create_shards_table(db)
+        db.execute('delete from %s where table_name = ?' % _SHARDS_TABLE, (table_name,))
+        db.executemany('insert into %s values (?, ?, ?)' % _SHARDS_TABLE,
+                       [ (table_name, name, fingerprint) for name, fingerprint in fingerprints.items() ])
+    db.commit()
+
+
+def _read_shard(path, dialect, encoding=None):
+    """ returns the list of rows, but the header, of the csv file at path """
+    with path.open(encoding=encoding) as fo:
+        reader = csv.reader(fo, dialect)
+        next(reader, None)
+        return list(reader)
+
+
+def _map_ahead(executor, function, arguments, limit):
+    """ yields function(*args) for each tuple args in arguments, in order, as
+        executor.map(), but submitting them to executor up to limit ahead of
+        the result consumed, instead of all of them at once """
+    futures = collections.deque()
+    for args in arguments:
+        if len(futures) >= limit:
+            yield futures.popleft().result()
+        futures.append(executor.submit(function, *args))
+    while futures:
+        yield futures.popleft().result()
+
+
+def _get_executor(workers, tasks):
+    """ returns an executor to run tasks tasks with up to workers processes.
+        When there's no need for more than one process, the returned executor
+        runs the tasks in the current process """
+    workers = min(workers or os.cpu_count() or 1, tasks)
+    if workers > 1:
+        import concurrent.futures   # it takes a while to load, so just when required
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    return _SerialExecutor()
+
+
+class _SerialExecutor:
+    """ Executor running the tasks in the current process when required """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def submit(self, function, *args):
+        return _SerialFuture(function(*args))
+
+
+class _SerialFuture:
+    """ Result of a task run by _SerialExecutor """
+
+    def __init__(self, value):
+        self._value = value
+
+    def result(self):
+        return self._value
+
+
+def _create_shards_table(db):
+    """ creates, when missing, the table keeping track of the imported shards """
+    db.execute('create table if not exists %s (table_name, shard, fingerprint, primary key (table_name, shard))' % _SHARDS_TABLE)
+
+
+def _get_shard_fingerprints(db, table_name):
+    """ returns a dict {shard name: fingerprint} with the shards imported into
+        table_name, or None when there's no record of them or the table
+        doesn't exist """
+    _create_shards_table(db)
+    if db.execute("select 1 from sqlite_master where type = 'table' and name = ?", (table_name,)).fetchone() is None:
+        return None
+    rows = db.execute('select shard, fingerprint from %s where table_name = ?' % _SHARDS_TABLE, (table_name,)).fetchall()
+    return dict(rows) if rows else None
+
+
+def export_table(db, table_name, path, dialect=csv.excel, header=True):
+    """ Writes the contents of the table named table_name in db to the csv file
+        at path, including the column names as first row when header is True.
+
+        The contents are streamed to a temporary file in the same folder that
+        finally replaces path, so path is never left half written.
+    """
+    results = iterate_statement(db, 'select * from "%s"' % table_name)
+    if not header:
+        next(results)
+    fd, tmp_name = tempfile.mkstemp(dir=str(path.parent), prefix='.%s.' % path.name, suffix='.tmp')
+    try:
+        with open(fd, 'w', newline='') as fo:
+            csv.writer(fo, dialect).writerows(results)
+        os.replace(tmp_name, str(path))
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def get_table_names(db):
+    """ returns the list of the names of the tables in the main database of db,
+        excluding the ones internally used by sqlite and csvsql, and the side
+        tables of the wide and dictionary encoded tables """
+    rows = db.execute("select type, name from sqlite_master where type in ('table', 'view') and "
+                      "name not like 'sqlite\\_%' escape '\\' and "
+                      "name not like '\\_\\_csvsql\\_%' escape '\\'").fetchall()
+    views = { name for kind, name in rows if kind == 'view' }
+    return [ name for kind, name in rows if kind == 'table' and not _is_side_table(name, views) ]
+
+
+def _is_side_table(name, views):
+    """ returns True when the table name is a side table of a wide or a
+        dictionary encoded table, being views the names of the views """
+    match = _SIDE_TABLE.match(name)
+    return match is not None and match.group(1) in views
+
+
+class ChangeTracker:
+    """ Keeps track of the tables in the main database of db that are
+        modified, created or removed since the creation of the tracker.
+
+        Row changes are registered by temporary triggers, so nothing is stored
+        in the database, and just the tables with actual changes are reported.
+        Schema changes (create, drop and alter table) are registered by an
+        authorizer. Only one tracker can be active on a connection.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._initial_tables = set(get_table_names(db))
+        self._schema_changes = set()
+        db.execute('create temp table if not exists %s (name primary key)' % _CHANGES_TABLE)
+        for table_name in self._initial_tables:
+            for event in ('insert', 'update', 'delete'):
+                db.execute('create temp trigger "%s_%s_%s" after %s on main."%s" begin '
+                           'insert or ignore into %s values (\'%s\'); end' %
+                           (_CHANGES_TABLE, table_name, event, event, table_name,
+                            _CHANGES_TABLE, table_name.replace("'", "''")))
+        db.set_authorizer(self._authorize)
+
+    def _authorize(self, action, arg1, arg2, database, trigger):
+        if action in (sqlite3.SQLITE_CREATE_TABLE, sqlite3.SQLITE_DROP_TABLE) and database == 'main':
+            self._schema_changes.add(arg1)
+        elif action == sqlite3.SQLITE_ALTER_TABLE and arg1 == 'main':
+            self._schema_changes.add(arg2)
+        return sqlite3.SQLITE_OK
+
+    def close(self):
+        """ stops tracking changes and returns a tuple (changed, removed) with
+            the sets of names of the tables changed or created, and of the
+            tables removed """
+        self._db.set_authorizer(None)
+        final_tables = set(get_table_names(self._db))
+        changed = { row[0] for row in self._db.execute('select name from temp.%s' % _CHANGES_TABLE) }
+        changed |= self._schema_changes | (final_tables - self._initial_tables)
+        for (trigger_name,) in self._db.execute("select name from sqlite_temp_master where type = 'trigger' and "
+                                                "name like '%s%%'" % _CHANGES_TABLE).fetchall():
+            self._db.execute('drop trigger temp."%s"' % trigger_name)
+        self._db.execute('drop table temp.%s' % _CHANGES_TABLE)
+        return changed & final_tables, self._initial_tables - final_tables
+
+
+def create_materialized(db, name, statement):
+    """ Defines the materialized aggregate name as the results of the select
+        statement, computes them and keeps them in db, where they can be
+        queried as the view name. The definition is kept in db, so later
+        connections can refresh it with refresh_materialized().
+
+        When the statement is a select from a single table (the source) with
+        distributive aggregates (sum, count, total, min and max, and avg
+        computed from a total and a count), optionally with a where clause
+        and a group by clause, the results are stored per group and refreshed
+        from just the rows appended to the source since the last refresh,
+        merging the aggregates of those rows with the stored ones. Other
+        statements are computed again from scratch on each refresh.
+
+        An existing materialized aggregate with the same name is replaced.
+    """
+    drop_materialized(db, name)
+    db.execute('create table if not exists %s (name primary key, statement, source, watermark)' %
+               _MATERIALIZED_TABLE)
+    parts = _parse_materialized(statement)
+    db.execute('insert into %s values (?, ?, ?, null)' % _MATERIALIZED_TABLE,
+               (name, statement, parts['source'] if parts else None))
+    refresh_materialized(db, name)
+
+
+def refresh_materialized(db, name=None, full=False):
+    """ Refreshes the results of the materialized aggregate name (all of them
+        when None) from the rows appended to its source since the last
+        refresh, as described in create_materialized(). They are computed
+        again from scratch when full, or when the rows already considered may
+        have changed: the source was updated or deleted from (tracked by
+        triggers on the source), or it was imported again (its triggers are
+        gone). Real sums and averages refreshed from the appended rows may
+        differ in their last digits from the ones computed from scratch.
+        It returns the number of rows of the sources considered """
+    if not _exists_table(db, _MATERIALIZED_TABLE):
+        return 0
+    query = 'select name, statement, source, watermark from %s' % _MATERIALIZED_TABLE
+    definitions = db.execute(query + ('' if name is None else ' where name = ?'),
+                             () if name is None else (name,)).fetchall()
+    considered = 0
+    for name, statement, source, watermark in definitions:
+        parts = _parse_materialized(statement)
+        if parts is None:
+            db.execute('drop table if exists %s_%s' % (_MATERIALIZED_TABLE, name))
+            db.execute('create table %s_%s as %s' % (_MATERIALIZED_TABLE, name, statement.strip().rstrip(';')))
+            db.execute('drop view if exists %s' % name)
+            db.execute('create view %s as select * from %s_%s' % (name, _MATERIALIZED_TABLE, name))
+            considered += db.execute('select count(*) from %s_%s' % (_MATERIALIZED_TABLE, name)).fetchone()[0]
+            continue
+        last = _get_last_rowid(db, source)
+        triggers = _exists_trigger(db, '%s_%s_update' % (_MATERIALIZED_TABLE, source))
+        if full or watermark is None or last is None or not triggers or last < watermark:
+            _compute_materialized(db, name, statement, parts)
+            considered += _count_rows(db, source, parts['where'])
+        elif last > watermark:
+            if _merge_materialized(db, name, parts, watermark):
+                considered += _count_rows(db, source, parts['where'], watermark)
+            else:
+                _compute_materialized(db, name, statement, parts)
+                considered += _count_rows(db, source, parts['where'])
+        if last is not None:
+            for event in ('update', 'delete'):
+                db.execute('create trigger if not exists %s_%s_%s after %s on main.%s begin '
+                           'update %s set watermark = null where source = \'%s\'; end' %
+                           (_MATERIALIZED_TABLE, source, event, event, source, _MATERIALIZED_TABLE, source))
+        db.execute('update %s set watermark = ? where name = ?' % _MATERIALIZED_TABLE, (last, name))
+    db.commit()
+    return considered
+
+
+def drop_materialized(db, name):
+    """ Removes the materialized aggregate name, if any """
+    if not _exists_table(db, _MATERIALIZED_TABLE):
+        return
+    row = db.execute('select source from %s where name = ?' % _MATERIALIZED_TABLE, (name,)).fetchone()
+    if row is None:
+        return
+    db.execute('drop view if exists %s' % name)
+    db.execute('drop table if exists %s_%s' % (_MATERIALIZED_TABLE, name))
+    db.execute('delete from %s where name = ?' % _MATERIALIZED_TABLE, (name,))
+    others = db.execute('select 1 from %s where source = ?' % _MATERIALIZED_TABLE, (row[0],)).fetchone()
+    if row[0] is not None and others is None:
+        for event in ('update', 'delete'):
+            db.execute('drop trigger if exists %s_%s_%s' % (_MATERIALIZED_TABLE, row[0], event))
+    db.commit()
+
+
+def _parse_materialized(statement):
+    """ returns the parts of the statement of a materialized aggregate that
+        can be refreshed from the appended rows, as a dict with source (the
+        table), where (the condition or None), keys (the list of group by
+        expressions) and items (a list with, for each selected item, either
+        ('key', position in keys) or (aggregate function, argument)). It
+        returns None when the statement is not supported """
+    match = _MATERIALIZED_QUERY.match(statement)
+    if match is None or _NOT_DISTRIBUTIVE.search(statement.split(None, 1)[1]):
+        return None
+    keys = _split_expressions(match.group(4)) if match.group(4) else []
+    selected = _split_expressions(match.group(1))
+    if keys is None or not selected:
+        return None
+    normalized = [ ' '.join(key.lower().split()) for key in keys ]
+    items = []
+    for item in selected:
+        aggregate = _MATERIALIZED_AGGREGATE.match(item)
+        if aggregate is not None and _split_expressions(aggregate.group(2)) is not None:
+            argument = aggregate.group(2).strip()
+            if argument == '*' and aggregate.group(1).lower() != 'count':
+                return None
+            items.append((aggregate.group(1).lower(), argument))
+            continue
+        expressions = [ ' '.join(re.sub(alias, '', item, flags=re.IGNORECASE).lower().split())
+                        for alias in (r'\s+as\s+\w+\s*$', r'\s+\w+\s*$') ]    # the alias without as
+        expression = next((expression for expression in expressions if expression in normalized), None)
+        if expression is None:
+            return None
+        items.append(('key', normalized.index(expression)))
+    return { 'source': match.group(2), 'where': match.group(3), 'keys': keys, 'items': items }
+
+
+def _split_expressions(text):
+    """ returns the list of the expressions separated by commas in text, or
+        None when its parentheses or quotes are not balanced """
+    expressions, depth, quote, start = [], 0, None, 0
+    for position, character in enumerate(text):
+        if quote:
+            quote = None if character == quote else quote
+        elif character in '\'"':
+            quote = character
+        elif character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+            if depth < 0:
+                return None
+        elif character == ',' and depth == 0:
+            expressions.append(text[start:position].strip())
+            start = position + 1
+    if depth or quote:
+        return None
+    return expressions + [ text[start:].strip() ]
+
+
+def _get_materialized_select(parts, watermark=None):
+    """ returns the select computing the stored columns of a materialized
+        aggregate from the rows of its source after the rowid watermark (all
+        of them when None) """
+    columns = list(parts['keys']) or [ '0' ]
+    for function, argument in parts['items']:
+        if function == 'avg':
+            columns.extend([ 'total(%s)' % argument, 'count(%s)' % argument ])
+        elif function != 'key':
+            columns.append('%s(%s)' % (function, argument))
+    conditions = [ '(%s)' % parts['where'] ] if parts['where'] else []
+    if watermark is not None:
+        conditions.insert(0, 'rowid > %d' % watermark)
+    return 'select %s from %s where %s%s' % (', '.join(columns), parts['source'],
+                                             ' and '.join(conditions) or 'true',
+                                             ' group by %s' % ', '.join(parts['keys']) if parts['keys'] else '')
+
+
+def _get_stored_columns(parts):
+    """ returns the pair (names of the key columns, list of (function, name)
+        of the aggregate columns) of the table storing a materialized aggregate """
+    keys = [ '__key%d' % position for position in range(1, max(1, len(parts['keys'])) + 1) ]
+    aggregates = []
+    for position, (function, _) in enumerate(parts['items'], 1):
+        if function == 'avg':
+            aggregates.extend([ ('total', '__total%d' % position), ('count', '__count%d' % position) ])
+        elif function != 'key':
+            aggregates.append((function, '__%s%d' % (function, position)))
+    return keys, aggregates
+
+
+def _compute_materialized(db, name, statement, parts):
+    """ computes from scratch the results of the materialized aggregate name,
+        creating the table storing them and the view name on them """
+    table_name = '%s_%s' % (_MATERIALIZED_TABLE, name)
+    keys, aggregates = _get_stored_columns(parts)
+    names = [ item[0] for item in db.execute('%s limit 0' % statement.strip().rstrip(';')).description ]
+    db.execute('drop table if exists %s' % table_name)
+    db.execute('create table %s (%s, unique (%s))' % (table_name, ', '.join(keys + [ column for _, column in aggregates ]),
+                                                     ', '.join(keys)))
+    db.execute('insert into %s %s' % (table_name, _get_materialized_select(parts)))
+    columns = []
+    for position, ((function, argument), column_name) in enumerate(zip(parts['items'], names), 1):
+        if function == 'key':
+            expression = keys[argument]
+        elif function == 'avg':
+            expression = 'case when __count%d > 0 then __total%d / __count%d end' % (position, position, position)
+        else:
+            expression = '__%s%d' % (function, position)
+        columns.append('%s as "%s"' % (expression, column_name.replace('"', '""')))
+    db.execute('drop view if exists %s' % name)
+    db.execute('create view %s as select %s from %s%s' % (name, ', '.join(columns), table_name,
+                                                          ' order by %s' % ', '.join(keys) if parts['keys'] else ''))
+
+
+def _merge_materialized(db, name, parts, watermark):
+    """ merges into the stored results of the materialized aggregate name the
+        aggregates of the rows of its source after the rowid watermark. It
+        returns False, without merging, when some of those rows have a null
+        group by expression, since their groups can't be matched """
+    if parts['keys']:
+        conditions = [ 'rowid > %d' % watermark, '(%s)' % ' or '.join('(%s) is null' % key for key in parts['keys']) ]
+        if parts['where']:
+            conditions.append('(%s)' % parts['where'])
+        if db.execute('select 1 from %s where %s limit 1' % (parts['source'], ' and '.join(conditions))).fetchone():
+            return False
+    keys, aggregates = _get_stored_columns(parts)
+    updates = [ '%s = %s' % (column, _MERGED_AGGREGATES[function] % { 'stored': column, 'new': 'excluded.' + column })
+                for function, column in aggregates ]
+    db.execute('insert into %s_%s %s on conflict (%s) do update set %s' %
+               (_MATERIALIZED_TABLE, name, _get_materialized_select(parts, watermark), ', '.join(keys),
+                ', '.join(updates)))
+    return True
+
+
+def _get_last_rowid(db, table_name):
+    """ returns the largest rowid of the table (0 when empty), or None when it
+        has no rowid (e.g. a view or a table without rowid) """
+    try:
+        return db.execute('select ifnull(max(rowid), 0) from main.%s' % table_name).fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+def _count_rows(db, table_name, where=None, watermark=None):
+    """ returns the number of rows of the table matching where after the rowid watermark """
+    conditions = ([ 'rowid > %d' % watermark ] if watermark is not None else []) + \
+                 ([ '(%s)' % where ] if where else [])
+    return db.execute('select count(*) from %s where %s' % (table_name, ' and '.join(conditions) or 'true')).fetchone()[0]
+
+
+def _exists_table(db, table_name):
+    """ returns True when the table exists in the main database of db """
+    return db.execute("select 1 from sqlite_master where type = 'table' and name = ?", (table_name,)).fetchone() is not None
+
+
+def _exists_trigger(db, trigger_name):
+    """ returns True when the trigger exists in the main database of db """
+    return db.execute("select 1 from sqlite_master where type = 'trigger' and name = ?",
+                      (trigger_name,)).fetchone() is not None
+
+
+def execute_statement(db, statement, budget=None):
+    """ executes an sql statement on db and returns the results.
+        When budget is a StatementBudget applied to db, the statement is
+        interrupted when exceeding it, raising BudgetExceeded """
+    return list(iterate_statement(db, statement, budget))
+
+
+def iterate_statement(db, statement, budget=None):
+    """ executes an sql statement on db and returns an iterator on the results.
+        The first item contains the column names. The rows are fetched from db as they are
+        required, so the results are never kept in memory at once.
+        When budget is a StatementBudget applied to db, the statement is
+        interrupted when exceeding it, raising BudgetExceeded """
+    if budget is not None:
+        budget.start(statement)
+    try:
+        curs = db.execute(statement)
+    except sqlite3.OperationalError as err:
+        raise _get_budget_error(budget, statement, err)
+    if not curs.description:
+        return iter([])
+    rows = itertools.chain([tuple([item[0] for item in curs.description])], curs)
+    return rows if budget is None else _iterate_within_budget(rows, budget, statement)
+
+
+def _iterate_within_budget(rows, budget, statement):
+    """ yields the rows of statement, raising BudgetExceeded when interrupted by budget """
+    try:
+        yield from rows
+    except sqlite3.OperationalError as err:
+        raise _get_budget_error(budget, statement, err)
+
+
+def _get_budget_error(budget, statement, err):
+    """ returns the exception to raise for the error err executing statement: a
+        BudgetExceeded when budget interrupted it, err otherwise """
+    if budget is None:
+        return err
+    if budget.exceeded is None and budget.token is not None and budget.token.cancelled:
+        budget.exceeded = 'cancelled'
+    if budget.exceeded is None:
+        return err
+    exceeded = BudgetExceeded(budget.exceeded, statement)
+    exceeded.__cause__ = err
+    return exceeded
 
 
-def execute_statement(db, statement):
-    """ executes an sql statement on db and returns the results """
-    curs = db.execute(statement)
-    return [
-            tuple([item[0] for item in curs.description])
-           ] + list(curs) if curs.description else []
+def execute_columnar(db, statement, dtypes=None, records=False, budget=None, chunk_rows=_COLUMNAR_CHUNK_ROWS):
+    """ executes an sql statement on db and returns its results by column: a
+        dict with an array of values for each column name.
+
+        The rows are fetched in chunks of chunk_rows and their values are
+        stored right away into an array per column, growing as required, so
+        the results are never kept as tuples at once.
+
+        With numpy installed, the arrays are numpy arrays. Otherwise, they are
+        array.array for numeric columns and lists for the rest.
+
+        dtypes: a dict with the type of some columns ('int64', 'float64' or
+                'object', or any numpy dtype when numpy is installed). The
+                type of the rest is inferred from the storage classes of their
+                values: 'int64' when all of them are integers, 'float64' when
+                they are reals, integers or nulls (nulls become NaN), and
+                'object' otherwise, with the values as sqlite3 returns them.
+                Text is never converted, so the csv values imported by csvsql
+                remain text unless the statement casts them. A column is
+                promoted to a wider type when a chunk requires it, restoring
+                the values already stored to their original values.
+
+        records: when True, the results are returned as a numpy record array.
+                 It requires numpy.
+
+        budget: as in execute_statement()
+    """
+    numpy = _get_numpy()
+    if records and numpy is None:
+        raise ImportError('records=True requires numpy')
+    rows = iterate_statement(db, statement, budget)
+    names = next(rows, ())
+    columns = [ _ColumnBuilder(numpy, (dtypes or {}).get(name)) for name in names ]
+    while True:
+        chunk = list(itertools.islice(rows, chunk_rows))
+        if not chunk:
+            break
+        for column, values in zip(columns, zip(*chunk)):
+            column.extend(values)
+    results = { name: column.finish() for name, column in zip(names, columns) }
+    if records:
+        return numpy.rec.fromarrays(list(results.values()), names=list(results))
+    return results
+
+
+def _get_numpy():
+    """ returns the numpy module, or None when it is not installed """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class _ColumnBuilder:
+    """ Array of the values of a column of execute_columnar() growing as the
+        chunks of values are extended. When the type is not forced by dtype,
+        the kind of the column follows the storage classes of its values:
+        int while all of them are integers, float once there are reals or
+        nulls (as NaN), and object once there is text or a blob, which is
+        never converted. When a chunk requires a wider kind, the values
+        already stored are restored to their original values and widened """
+
+    def __init__(self, numpy, dtype=None):
+        self._numpy = numpy
+        self._dtype = dtype
+        self._kind = None
+        self._data = None
+        self._length = 0
+        self._integers = None           # on the float kind, flags of the values that were integers
+        if dtype is not None:
+            kinds = [ kind for kind in _COLUMN_KINDS if dtype in kind[1:] ]
+            if numpy is not None:
+                self._data = numpy.empty(0, dtype)
+                self._kind = {'i': 0, 'u': 0, 'f': 1}.get(self._data.dtype.kind, 2)
+            elif kinds:
+                self._kind = _COLUMN_KINDS.index(kinds[0])
+            else:
+                raise ValueError('unknown dtype %s without numpy' % dtype)
+
+    def extend(self, values):
+        """ appends the values to the column """
+        if self._dtype is not None:
+            self._append(self._convert(values, self._kind))
+            return
+        kind = max([ self._kind or 0 ] + [ _get_value_kind(value) for value in values ])
+        if kind == 1 and (any(type(value) is int and abs(value) > _MAX_EXACT_INTEGER for value in values) or
+                          (self._kind == 0 and any(abs(value) > _MAX_EXACT_INTEGER for value in self._values()))):
+            kind = 2                    # a float can't keep them
+        if kind != self._kind:
+            self._promote(kind)
+        if kind == 1 and (self._integers is not None or any(type(value) is int for value in values)):
+            if self._integers is None:
+                self._integers = array.array('b', bytes(self._size()))
+            self._integers.extend(type(value) is int for value in values)
+        self._append(self._convert(values, kind))
+
+    def _convert(self, values, kind):
+        """ returns the values as an array of the kind """
+        name, dtype, typecode = _COLUMN_KINDS[kind]
+        if name == 'int' and self._dtype is not None:
+            values = [ value if type(value) is int else int(_check_integer(value)) for value in values ]
+        elif name == 'float':
+            values = [ float('nan') if value is None or value == '' else float(value) for value in values ]
+        if self._numpy is not None:
+            return self._numpy.array(values, dtype=self._dtype or dtype)
+        return array.array(typecode, values) if typecode else list(values)
+
+    def _promote(self, kind):
+        """ changes the kind of the values already stored to the wider kind """
+        previous, self._kind = self._kind, kind
+        if self._data is None:
+            return
+        if kind == 2:
+            values = self._values()
+            if previous == 1:
+                integers = self._integers or itertools.repeat(0)
+                values = [ None if value != value else int(value) if integer else value
+                           for value, integer in zip(values, integers) ]
+            self._integers = None
+            self._data = self._numpy.array(values, dtype=object) if self._numpy is not None else values
+        elif self._numpy is not None:
+            self._integers = array.array('b', b'\x01' * self._length)
+            self._data = self._data.astype('float64')
+        else:
+            self._integers = array.array('b', b'\x01' * len(self._data))
+            self._data = array.array('d', self._data)
+
+    def _values(self):
+        """ returns the list of the values stored """
+        if self._data is None:
+            return []
+        return self._data[:self._length].tolist() if self._numpy is not None else list(self._data)
+
+    def _size(self):
+        """ returns the number of values stored """
+        if self._numpy is not None:
+            return self._length
+        return 0 if self._data is None else len(self._data)
+
+    def _append(self, chunk):
+        """ appends the converted chunk, doubling the capacity of the numpy
+            array when required """
+        if self._numpy is None:
+            if self._data is None:
+                self._data = chunk
+            else:
+                self._data.extend(chunk)
+            return
+        if self._data is None:
+            self._data = self._numpy.empty(0, chunk.dtype)
+        length = self._length + len(chunk)
+        if length > len(self._data):
+            self._data.resize(max(length, 2 * len(self._data)), refcheck=False)
+        self._data[self._length:length] = chunk
+        self._length = length
+
+    def finish(self):
+        """ returns the values of the column """
+        if self._data is None:
+            return self._convert([], self._kind or 0)
+        if self._numpy is not None:
+            self._data.resize(self._length, refcheck=False)
+        return self._data
+
+
+def _get_value_kind(value):
+    """ returns the narrowest kind of _COLUMN_KINDS keeping the value """
+    if type(value) is int:
+        return 0
+    return 1 if value is None or type(value) is float else 2
+
+
+def _check_integer(value):
+    """ returns value when it can be converted to an integer without loss.
+        Otherwise, it raises ValueError """
+    if isinstance(value, (float, bytes)) or value is None:
+        raise ValueError('not an integer: %r' % (value,))
+    return value
+
+
+def query_csv(statement, tables, dialect=csv.excel):
+    """ computes the results of statement straight from the csv file of its
+        table, without importing it into sqlite3, when the statement is simple
+        enough. The file is read into an array per column, and the conditions
+        and the aggregates are evaluated on the whole arrays, vectorized with
+        numpy when installed.
+
+        The statement must be a select from a single table of:
+        - columns (or *), optionally with a where clause, or
+        - aggregates (count, sum, avg, total, min and max of a column, or
+          count(*)) and the columns of its group by clause, if any
+        The where clause can just compare columns with text literals (e.g.
+        day >= '2026-10-01'), joined by and.
+
+        tables: a dict {table name: (path, header)} with the csv files of the
+                tables, header as in import_csv()
+
+        It returns the results as execute_statement() would do on the imported
+        file, or None when the statement or the file are not supported (e.g.
+        rows longer than the header), so the statement must be executed by
+        sqlite3.
+    """
+    query = _parse_columnar_query(statement)
+    tables = { name.lower(): source for name, source in tables.items() }
+    if query is None or query['table'] not in tables:
+        return None
+    path, header = tables[query['table']]
+    used = { column for _, column, _ in query['items'] } | { column for column, _, _ in query['predicates'] } | \
+           set(query['group'])
+    contents = _read_csv_columns(path, header, dialect, None if '*' in used else used)
+    if contents is None:
+        return None
+    names, columns, row_count = contents
+    originals = { name.lower(): name for name in names }
+    items = [ (kind, column, name or originals.get(column, column)) for kind, column, name in query['items'] ]
+    if ('column', '*', '*') in items:
+        if len(items) > 1:
+            return None
+        items = [ ('column', name.lower(), name) for name in names ]
+    if not used - { '*' } <= set(originals):
+        return None
+    mask = None
+    for column, function, literal in query['predicates']:
+        current = map(function, columns[column], itertools.repeat(literal))
+        mask = list(current) if mask is None else list(map(operator.and_, mask, current))
+    if mask is not None:
+        columns = { column: list(itertools.compress(values, mask)) for column, values in columns.items()
+                    if column in used }
+        row_count = sum(mask)
+    if not query['group'] and all(kind == 'column' for kind, _, _ in items):
+        return [ tuple(name for _, _, name in items) ] + list(zip(*(columns[column] for _, column, _ in items)))
+    return _aggregate_columns(_get_numpy(), items, query['group'], columns, row_count)
+
+
+def _parse_columnar_query(statement):
+    """ returns the parts of statement as a dict with table (lower case name),
+        items (list of (kind, column, name) where kind is 'column' or the
+        aggregate function, column is a lower case name or '*', and name is
+        the name of the result, None for columns with no alias),
+        predicates (list of (column, comparison function, literal)) and group
+        (list of lower case column names), or None when query_csv() can't
+        compute it """
+    match = _COLUMNAR_QUERY.match(statement)
+    if match is None:
+        return None
+    items = []
+    for item in match.group(1).split(','):
+        parsed = _COLUMNAR_ITEM.match(item)
+        if parsed is None:
+            return None
+        if parsed.group(4):
+            items.append((parsed.group(4).lower(), parsed.group(5).lower(), parsed.group(6) or parsed.group(1)))
+        else:
+            items.append(('column', parsed.group(1).lower(), parsed.group(6)))
+    if any(column == '*' and kind not in ('column', 'count') for kind, column, _ in items):
+        return None
+    predicates = []
+    where = match.group(3) or ''
+    position = 0
+    while position < len(where):
+        predicate = _COLUMNAR_PREDICATE.match(where, position)
+        if predicate is None or bool(predicate.group(1)) != bool(predicates):
+            return None
+        predicates.append((predicate.group(2).lower(), _COLUMNAR_OPERATORS[predicate.group(3)],
+                           predicate.group(4).replace("''", "'")))
+        position = predicate.end()
+    group = [ column.strip().lower() for column in match.group(4).split(',') ] if match.group(4) else []
+    if group or any(kind != 'column' for kind, _, _ in items):
+        if any(kind == 'column' and column not in group for kind, column, _ in items):
+            return None
+    return { 'table': match.group(2).lower(), 'items': items, 'predicates': predicates, 'group': group }
+
+
+def _read_csv_columns(path, header, dialect, wanted=None):
+    """ reads the csv file at path, with header as in import_csv(), into a
+        list of values per column, just for the wanted columns (a set of lower
+        case names, all of them when None). It returns the tuple (column
+        names, dict {lower case column name: list of values}, number of
+        rows), or None
+        when the file wouldn't be imported as a table of text values with the
+        columns of the header (e.g. a row is longer than the header) """
+    with path.open() as fo:
+        first = next(csv.reader(fo, dialect), None)
+        if header is None:
+            source, first = first, None
+            if source is None:
+                return None
+        elif header == '':
+            source = [ '' ] * max(1, len(first or []))
+        else:
+            source = header.split(',')
+        names = [ name or _DEFAULT_COLUMN_NAME + str(position) for position, name in enumerate(source, 1) ]
+        if len({ name.lower() for name in names }) < len(names):
+            return None
+        positions = [ position for position, name in enumerate(names) if wanted is None or name.lower() in wanted ]
+        values = [ [] for _ in positions ]
+        row_count = 0
+        try:
+            blocks = _iterate_column_blocks(fo, dialect, len(names), positions)
+            if first is not None:
+                blocks = itertools.chain(_get_column_block([ first ], len(names), positions), blocks)
+            for block_rows, block in blocks:
+                row_count += block_rows
+                for column, block_values in zip(values, block):
+                    column.extend(block_values)
+        except ValueError:
+            return None
+    return names, { names[position].lower(): column for position, column in zip(positions, values) }, row_count
+
+
+def _iterate_column_blocks(fo, dialect, width, positions):
+    """ generator of the rows read from fo as blocks of columns: pairs (number
+        of rows, list with the values of the block of each of the columns at
+        positions), for rows of width values.
+        While the contents contain no quotes and the rows have exactly width
+        values, each block of _BLOCK_SIZE characters is split at once. From
+        then on, the rows are read with csv.reader. Shorter rows are filled
+        with '', and a longer row raises ValueError """
+    delimiter = dialect.delimiter
+    splittable = dialect.escapechar is None and not dialect.skipinitialspace
+    pending = ''
+    while splittable:
+        block = fo.read(_BLOCK_SIZE)
+        contents = pending + block
+        end = contents.rfind('\n') + 1 if block else len(contents)
+        lines, pending = contents[:end], contents[end:]
+        if not lines:
+            if not block:
+                return
+            continue
+        if (dialect.quotechar and dialect.quotechar in lines) or '\r' in lines.replace('\r\n', '\n'):
+            pending = lines + pending + fo.readline()
+            break
+        lines = lines.replace('\r\n', '\n')
+        lines = lines[:-1] if lines.endswith('\n') else lines
+        fields = lines.replace('\n', delimiter).split(delimiter)
+        if len(fields) != (lines.count('\n') + 1) * width:
+            pending = lines + '\n' + pending + fo.readline()
+            break
+        yield len(fields) // width, [ fields[position::width] for position in positions ]
+    rows = csv.reader(itertools.chain(io.StringIO(pending), fo), dialect)
+    while True:
+        chunk = list(itertools.islice(rows, _COLUMNAR_CHUNK_ROWS))
+        if not chunk:
+            return
+        yield from _get_column_block(chunk, width, positions)
+
+
+def _get_column_block(rows, width, positions):
+    """ returns a list with the block of columns of the rows, as described in
+        _iterate_column_blocks() """
+    if max(map(len, rows)) > width:
+        raise ValueError('row longer than %d values' % width)
+    if min(map(len, rows)) < width:
+        rows = [ row + [ '' ] * (width - len(row)) for row in rows ]
+    return [ (len(rows), [ list(map(operator.itemgetter(position), rows)) for position in positions ]) ]
+
+
+def _aggregate_columns(numpy, items, group, columns, row_count):
+    """ computes the aggregates of the items on the lists of values of the
+        columns, grouped by the columns in group, as sqlite3 does. Each row
+        gets the number of its group in the order of the keys, and the counts
+        and sums are computed from these numbers with numpy, when not None.
+        It returns the results as execute_statement() or None when they can't
+        be computed exactly """
+    if group:
+        keys = columns[group[0]] if len(group) == 1 else list(zip(*(columns[column] for column in group)))
+        ordered = sorted(dict.fromkeys(keys))
+        inverse = list(map({ key: number for number, key in enumerate(ordered) }.__getitem__, keys))
+        if len(group) == 1:
+            ordered = [ (key,) for key in ordered ]
+    else:
+        ordered, inverse = [ () ], [ 0 ] * row_count
+    group_count = len(ordered)
+    if numpy is not None:
+        inverse = numpy.array(inverse, dtype=numpy.intp)
+        counts = numpy.bincount(inverse, minlength=group_count).tolist()
+    else:
+        counts = [ 0 ] * group_count
+        for number in inverse:
+            counts[number] += 1
+    results = []
+    for kind, column, _ in items:
+        if kind == 'column':
+            results.append([ key[group.index(column)] for key in ordered ])
+        elif kind == 'count':
+            results.append(counts)
+        elif kind in ('min', 'max'):
+            results.append(_get_extremes(numpy, kind, columns[column], inverse, group_count))
+        else:
+            sums = _get_sums(numpy, columns[column], inverse, group_count)
+            if sums is None:
+                return None
+            reals, integers = sums
+            if kind == 'total':
+                results.append(reals)
+            elif kind == 'avg':
+                results.append([ real / count if count else None for real, count in zip(reals, counts) ])
+            else:
+                results.append([ (real if integer is None else integer) if count else None
+                                 for real, integer, count in zip(reals, integers, counts) ])
+    return [ tuple(name for _, _, name in items) ] + list(zip(*results))
+
+
+def _get_extremes(numpy, kind, values, inverse, group_count):
+    """ returns the list with the minimum (kind 'min') or maximum (kind 'max')
+        text value of each group, None for empty groups """
+    if numpy is not None:
+        ordered = sorted(set(values))
+        ranks = numpy.array(list(map({ value: rank for rank, value in enumerate(ordered) }.__getitem__, values)),
+                            dtype=numpy.intp)
+        if kind == 'min':
+            extremes = numpy.full(group_count, len(ordered), dtype=numpy.intp)
+            numpy.minimum.at(extremes, inverse, ranks)
+        else:
+            extremes = numpy.full(group_count, -1, dtype=numpy.intp)
+            numpy.maximum.at(extremes, inverse, ranks)
+        return [ ordered[rank] if 0 <= rank < len(ordered) else None for rank in extremes.tolist() ]
+    extremes = [ None ] * group_count
+    better = operator.lt if kind == 'min' else operator.gt
+    for number, value in zip(inverse, values):
+        extreme = extremes[number]
+        if extreme is None or better(value, extreme):
+            extremes[number] = value
+    return extremes
+
+
+def _get_sums(numpy, values, inverse, group_count):
+    """ returns the pair of lists (sum of the values as reals, sum of the
+        values as integers) of each group, with the values converted to
+        numbers as sqlite3 does. The integer sum of a group is None when any
+        of its values is real. It returns None when the sums of sqlite3 can't
+        be reproduced exactly """
+    converted = { value: _get_sqlite_number(value) for value in set(values) }
+    real_values = { value for value, number in converted.items() if type(number) is float }
+    if real_values and not _SEQUENTIAL_REAL_SUMS:
+        return None
+    numbers = list(map(converted.__getitem__, values))
+    largest = max((abs(number) for number in converted.values() if type(number) is int), default=0)
+    if largest * len(numbers) >= 1 << 53:
+        if sum(abs(number) for number in numbers if type(number) is int) >= 1 << 53:
+            return None
+    if numpy is not None:
+        flags = numpy.array(list(map(real_values.__contains__, values)), dtype=float)
+        reals = numpy.bincount(inverse, weights=numpy.array(numbers, dtype=float), minlength=group_count)
+        has_reals = (numpy.bincount(inverse, weights=flags, minlength=group_count) > 0).tolist()
+        reals = reals.tolist()
+    else:
+        reals, has_reals = [ 0.0 ] * group_count, [ False ] * group_count
+        for number, value in zip(inverse, numbers):
+            reals[number] += value
+            has_reals[number] = has_reals[number] or type(value) is float
+    return reals, [ None if has_real else int(real) for real, has_real in zip(reals, has_reals) ]
+
+
+def _get_sqlite_number(value):
+    """ returns the number sqlite3 gets from the text value on sums: an int
+        for integers within 64 bits, and otherwise the float of its numeric
+        prefix (0.0 when none) """
+    if _SQLITE_INTEGER.fullmatch(value):
+        number = int(value)
+        if -(1 << 63) <= number < (1 << 63):
+            return number
+    prefix = _SQLITE_NUMBER.match(value)
+    return float(prefix.group(0)) if prefix else 0.0
+
+
+def get_query_plan(db, statement):
+    """ returns the query plan of statement as a list of pairs (depth, detail),
+        where depth is the level of the step in the plan tree """
+    depths = {}
+    plan = []
+    for step_id, parent, _, detail in db.execute('explain query plan %s' % statement):
+        depths[step_id] = depths.get(parent, -1) + 1
+        plan.append((depths[step_id], detail))
+    return plan
+
+
+def get_plan_warnings(detail):
+    """ returns the list of descriptions of the reasons that make the step of a
+        query plan usually slow: full scans of tables, automatic indexes and
+        temporary b-trees """
+    return [ warning for pattern, warning in _PLAN_WARNINGS if pattern.search(detail) ]
+
+
+def suggest_indexes(db, statement):
+    """ returns a list of 'create index' statements that would avoid steps of
+        the query plan of statement with warnings (see get_plan_warnings()).
+
+        The candidates are the automatic indexes of the plan and single column
+        indexes on the columns referred to by the statement of the tables
+        fully scanned. Each one is tried on an empty copy of the schema of db,
+        with its statistics, so that trying them neither reads the tables nor
+        runs anything on db, and just the ones reducing the warnings of the
+        plan are returned """
+    copy = _copy_schema(db)
+    try:
+        return _suggest_indexes(copy, statement)
+    finally:
+        copy.close()
+
+
+def _copy_schema(db):
+    """ returns an in memory connection with empty copies of the tables, views
+        and indexes of db (but the attached databases), and the contents of its
+        sqlite_stat1 table, so that it gets the same query plans as db """
+    copy = sqlite3.connect(':memory:')
+    for master in ('sqlite_master', 'sqlite_temp_master'):
+        for sql, in db.execute("select sql from %s where type in ('table', 'view', 'index') and sql is not null "
+                               "and name not like 'sqlite_%%' order by rowid" % master):
+            copy.execute(sql)
+    if db.execute("select 1 from sqlite_master where name = 'sqlite_stat1'").fetchone():
+        copy.execute('analyze')
+        copy.execute('delete from sqlite_stat1')
+        copy.executemany('insert into sqlite_stat1 values (?, ?, ?)', db.execute('select * from sqlite_stat1'))
+        copy.execute('analyze sqlite_master')       # loads the statistics
+    copy.commit()
+    return copy
+
+
+def _suggest_indexes(db, statement):
+    """ returns the indexes of suggest_indexes() trying them on db """
+    plan = get_query_plan(db, statement)
+    warnings = sum(len(get_plan_warnings(detail)) for _, detail in plan)
+    aliases = { (match.group(2) or match.group(1)).lower(): match.group(1)
+                for match in _FROM_TABLE.finditer(statement) }
+    words = set(_IDENTIFIER.findall(statement.lower()))
+    candidates = []
+    for _, detail in plan:
+        automatic = _AUTOMATIC_INDEX.match(detail)
+        if automatic:
+            columns = tuple(re.findall(r'(\w+)[=<>]', automatic.group(2)))
+            candidates.append((aliases.get(automatic.group(1).lower(), automatic.group(1)), columns))
+        scan = _PLAN_WARNINGS[0][0].match(detail)
+        if scan:
+            table_name = aliases.get(scan.group(1).lower(), scan.group(1))
+            try:
+                columns = get_column_names(db, table_name)
+            except sqlite3.Error:
+                continue
+            candidates.extend([ (table_name, (column,)) for column in columns
+                                if column.lower() in words ][:_MAX_INDEX_CANDIDATES])
+    suggestions = []
+    for table_name, columns in candidates:
+        index = 'create index %s_%s_idx on %s (%s)' % (table_name, '_'.join(columns), table_name, ', '.join(columns))
+        if not columns or index in suggestions:
+            continue
+        db.execute('savepoint __csvsql_suggestion')
+        try:
+            db.execute(index)
+            improved = sum(len(get_plan_warnings(detail)) for _, detail in get_query_plan(db, statement)) < warnings
+        except sqlite3.Error:
+            improved = False
+        finally:
+            db.execute('rollback to __csvsql_suggestion')
+            db.execute('release __csvsql_suggestion')
+        if improved:
+            suggestions.append(index)
+    return suggestions
 
 
 def execute_statements(db, statements):
@@ -87,3 +2499,273 @@ def execute_statements(db, statements):
     results = [execute_statement(db, statement) for statement in statements]
     db.commit()
     return results
+
+
+class BudgetExceeded(sqlite3.OperationalError):
+    """ Raised when a statement is interrupted for exceeding a StatementBudget
+        or being cancelled. reason describes the exceeded limit """
+
+    def __init__(self, reason, statement):
+        super().__init__('%s: %s' % (reason, statement))
+        self.reason = reason
+        self.statement = statement
+
+
+class CancelToken:
+    """ Allows any thread to cancel the statements running under the
+        StatementBudget objects created with this token. Once cancelled, it
+        remains cancelled. """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """ cancels the statements, interrupting the ones being executed """
+        self._event.set()
+        with self._lock:
+            for db in self._connections:
+                db.interrupt()
+
+    def _attach(self, db):
+        with self._lock:
+            self._connections.append(db)
+
+    def _detach(self, db):
+        with self._lock:
+            self._connections.remove(db)
+
+
+class StatementBudget:
+    """ Limits to the statements executed on a connection, enforced through its
+        progress handler every _PROGRESS_STEPS virtual machine instructions:
+
+        statement_timeout: seconds each statement can last, fetching of its
+                           rows included
+        run_timeout: seconds all the statements can last together
+        max_steps: virtual machine instructions each statement can execute
+        token: a CancelToken allowing other threads to cancel the statements
+
+        The budget is applied to a connection with applied(), and it is
+        enforced on the statements executed with execute_statement() or
+        iterate_statement() receiving it, which raise BudgetExceeded when
+        interrupted:
+
+            budget = csvsql.StatementBudget(statement_timeout=60)
+            with budget.applied(db):
+                results = csvsql.execute_statement(db, statement, budget)
+
+        Once exceeded, the following statements are interrupted too. timings
+        keeps the list of pairs (statement, seconds) of the statements
+        executed, including the interrupted one.
+    """
+
+    def __init__(self, statement_timeout=None, run_timeout=None, max_steps=None, token=None, clock=time.monotonic):
+        self.statement_timeout = statement_timeout
+        self.run_timeout = run_timeout
+        self.max_steps = max_steps
+        self.token = token
+        self.timings = []
+        self.exceeded = None
+        self._clock = clock
+        self._run_start = None
+        self._statement = None
+        self._statement_start = None
+        self._steps = 0
+
+    @contextlib.contextmanager
+    def applied(self, db):
+        """ returns a context manager enforcing the budget on db while active.
+            The run timeout counts from its start """
+        self._run_start = self._clock()
+        db.set_progress_handler(self._check, _PROGRESS_STEPS)
+        if self.token is not None:
+            self.token._attach(db)
+        try:
+            yield self
+        finally:
+            self._finish_statement()
+            db.set_progress_handler(None, 0)
+            if self.token is not None:
+                self.token._detach(db)
+
+    def start(self, statement):
+        """ starts counting the time and steps of statement """
+        self._finish_statement()
+        self._statement = statement
+        self._statement_start = self._clock()
+        self._steps = 0
+
+    def _finish_statement(self):
+        if self._statement is not None:
+            self.timings.append((self._statement, self._clock() - self._statement_start))
+            self._statement = None
+
+    def _check(self):
+        """ progress handler: returns 1, so sqlite3 interrupts the statement, when exceeding the budget """
+        self._steps += _PROGRESS_STEPS
+        now = self._clock()
+        if self.token is not None and self.token.cancelled:
+            self.exceeded = 'cancelled'
+        elif self.max_steps is not None and self._steps > self.max_steps:
+            self.exceeded = 'exceeded %d steps' % self.max_steps
+        elif (self.statement_timeout is not None and self._statement is not None
+                and now - self._statement_start > self.statement_timeout):
+            self.exceeded = 'exceeded %g seconds per statement' % self.statement_timeout
+        elif self.run_timeout is not None and now - self._run_start > self.run_timeout:
+            self.exceeded = 'exceeded %g seconds' % self.run_timeout
+        return 0 if self.exceeded is None else 1
+
+
+class CsvDatabase:
+    """ A sqlite3 database whose tables can be csv files.
+
+        Csv files are registered as tables with add_csv(), and they are not
+        imported until a statement refers to them. From then on, they are
+        imported again only when the file changes.
+        All the statements are executed on the same connection, that keeps
+        a cache of statement_cache_size prepared statements.
+
+        It can be used as a context manager that commits and closes the
+        connection on exit:
+
+            with csvsql.CsvDatabase() as db:
+                db.add_csv(pathlib.Path('scores.csv'))
+                for row in db.iterate('select * from scores'):
+                    ...
+
+        database: the sqlite3 database to use. By default, in memory.
+
+        stats: when True, the statistics of the imported files are recorded
+               (see get_csv_stats()), and statements just counting the rows
+               or getting the minimum or maximum of columns of a table not
+               imported yet are answered from the recorded statistics, if any,
+               without importing it.
+
+        columnar: when True, the statements on a table not imported yet that
+                  query_csv() supports are computed by it straight from the
+                  csv file, without importing it.
+
+        Note: importing a table commits the pending changes.
+    """
+
+    def __init__(self, database=':memory:', statement_cache_size=_STATEMENT_CACHE_SIZE, stats=False,
+                 columnar=False):
+        self.connection = sqlite3.connect(str(database), cached_statements=statement_cache_size)
+        self._stats = stats
+        self._columnar = columnar
+        self.connection.execute('pragma temp_store=memory')
+        if str(database) != ':memory:':
+            self.connection.execute('pragma journal_mode=wal')
+            self.connection.execute('pragma synchronous=normal')
+        self._tables = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.commit()
+        self.close()
+
+    def add_csv(self, path, table_name=None, header=None, dialect=csv.excel):
+        """ registers the csv file at path as the table table_name (by
+            default, the name of the file without extension). header and
+            dialect are as in import_csv(). It returns the name of the table.
+            In case table_name was already registered, it is replaced """
+        table_name = table_name or path.stem
+        self._tables[table_name.lower()] = [ table_name, path, header, dialect, None ]
+        return table_name
+
+    def load(self, table_name):
+        """ imports the csv file registered as table_name when it has not been
+            imported yet or it has changed since """
+        table_name, path, header, dialect, signature = self._tables[table_name.lower()]
+        stat = path.stat()
+        current = (stat.st_mtime_ns, stat.st_size)
+        if current == signature:
+            return
+        file_stats = {} if self._stats else None
+        with path.open() as fo:
+            import_csv(self.connection, fo, table_name, dialect=dialect, header=header, stats=file_stats)
+        if self._stats:
+            save_csv_stats([ (path, file_stats, header, dialect) ])
+        self._tables[table_name.lower()][-1] = current
+
+    def execute(self, statement, parameters=()):
+        """ executes statement once the tables it refers to are imported, and
+            returns the cursor """
+        for word in set(_IDENTIFIER.findall(statement.lower())) & set(self._tables):
+            self.load(word)
+        return self.connection.execute(statement, parameters)
+
+    def iterate(self, statement, parameters=()):
+        """ executes statement and returns an iterator on the results as
+            iterate_statement() does """
+        results = self._answer_from_stats(statement) if self._stats and not parameters else None
+        if results is None and self._columnar and not parameters:
+            results = self._answer_from_csv(statement)
+        if results is not None:
+            return iter(results)
+        curs = self.execute(statement, parameters)
+        if not curs.description:
+            return iter([])
+        return itertools.chain([tuple([item[0] for item in curs.description])], curs)
+
+    def _answer_from_stats(self, statement):
+        """ returns the results of statement computed from the statistics of
+            the file of a table not imported yet, or None when it is not
+            possible """
+        match = _STATS_QUERY.match(statement)
+        if match is None or match.group(2).lower() not in self._tables:
+            return None
+        table_name, path, header, dialect, signature = self._tables[match.group(2).lower()]
+        stats = get_csv_stats(path, header, dialect) if signature is None else None
+        if stats is None:
+            return None
+        columns = [ name.lower() for name in stats['columns'] ]
+        names, values = [], []
+        for item in match.group(1).split(','):
+            aggregate = _STATS_AGGREGATE.match(item)
+            if aggregate is None:
+                return None
+            function = aggregate.group(1).lower()
+            if function.startswith('count'):
+                value = stats['rows']
+            elif aggregate.group(2).lower() in columns:
+                position = columns.index(aggregate.group(2).lower())
+                value = stats[function[:3]][position] if stats['rows'] else None
+            else:
+                return None
+            names.append(aggregate.group(3) or item[:aggregate.end(1)].strip())
+            values.append(value)
+        return [ tuple(names), tuple(values) ]
+
+    def _answer_from_csv(self, statement):
+        """ returns the results of statement computed by query_csv() on the
+            file of a table not imported yet, or None when it is not possible """
+        match = _COLUMNAR_QUERY.match(statement)
+        if match is None or match.group(2).lower() not in self._tables:
+            return None
+        table_name, path, header, dialect, signature = self._tables[match.group(2).lower()]
+        if signature is not None:
+            return None
+        return query_csv(statement, { table_name: (path, header) }, dialect)
+
+    def query(self, statement, parameters=()):
+        """ executes statement and returns the results as execute_statement()
+            does """
+        return list(self.iterate(statement, parameters))
+
+    def commit(self):
+        """ commits the pending changes """
+        self.connection.commit()
+
+    def close(self):
+        """ closes the connection. Pending changes are discarded """
+        self.connection.close()
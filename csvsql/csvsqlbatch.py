@@ -0,0 +1,383 @@
+#! /usr/bin/env python3
+
+"""
+    csvsqlbatch is a command line program that runs a batch of csvsqlcli jobs described in a manifest.
+
+    Licensed under the GNU General Public License version 3.
+
+    Description:
+
+    Each job of the manifest lists its input csv files, its statements and its outputs, as csvsqlcli
+    options do. csvsqlbatch imports every input just once in a shared sqlite3 database, and runs the
+    jobs concurrently on their own connections. When a job uses as input the output of another job,
+    it waits for that job to finish.
+
+    Jobs never modify the shared database: the changes performed by their statements are rolled back
+    once their outputs are written.
+
+    The manifest can be a JSON file:
+
+        {
+            "workers": 4,
+            "jobs": [
+                {
+                    "name": "averages",
+                    "input": ["students.csv", "scores.csv"],
+                    "statement": ["select id, avg(score) as score from students, scores ..."],
+                    "output": "averages.csv"
+                }
+            ]
+        }
+
+    or an INI file, with a section [job name] per job, and an optional [batch] section with the
+    general settings. List values contain one item per line.
+
+    Job keys are: input, unheaded, statement, file, output and unheadedOutput. As in csvsqlcli, output
+    and unheadedOutput receive the results of the last statement, and -- @output directives in files
+    bind the following statement to an output.
+    Relative paths are considered from the folder containing the manifest.
+
+    Run it with -h  (or check get_argparse() method) to see available options
+
+"""
+
+
+import sys
+import os
+import argparse
+import pathlib
+import json
+import configparser
+import collections
+import concurrent.futures
+import tempfile
+import time
+import csv
+import sqlite3
+import contextlib
+try:
+    from . import csvsql, csvsqlcli
+except ImportError:
+    import csvsql
+    import csvsqlcli
+
+# Current version of this cli
+_VERSION = "1.0.0"
+
+# Seconds a connection waits for a lock on the shared database
+_LOCK_TIMEOUT = 600
+
+# Keys of a job that contain lists of values
+_JOB_LIST_KEYS = ('input', 'unheaded', 'statement', 'file')
+
+# Keys of a job that contain a single value
+_JOB_VALUE_KEYS = ('name', 'output', 'unheadedOutput')
+
+# A job as ready to be run. inputs is a list of pairs (option_string, path), statements the list of
+# statements, and destinations a dict {statement index: list of (option_string, path)}
+Job = collections.namedtuple('Job', 'name inputs statements destinations')
+
+
+def csvsqlbatch_process_cml_args(clargs):
+    """ This method interprets the commandline arguments in clargs (typically the contents of sys.args),
+    runs the jobs in the manifest and writes out the timing report.
+    It exits with an error status when any job fails.
+    """
+    parser = get_argparse(program_name=clargs[0])
+    args = parser.parse_args(clargs[1:])
+    if not args.manifest.is_file():
+        csvsqlcli.print_error_and_exit("File %s not found"%args.manifest)
+    manifest = load_manifest(args.manifest)
+    jobs = get_jobs(manifest, args.manifest.parent, args.force)
+    workers = args.jobs or manifest.get('workers') or os.cpu_count()
+    database = args.database or (args.manifest.parent / manifest['database'] if 'database' in manifest else None)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        report = run_jobs(jobs, database or pathlib.Path(tmpdir) / 'batch.sqlite3', int(workers), args.timeout)
+    write_report(report, args.report)
+    if any(status != 'ok' for _, status, _, _ in report):
+        sys.exit(1)
+
+
+def get_argparse(program_name):
+    """ constructs an argument parser for this CLI and returns it.
+        program_name: a str containing the name of this CLI
+    """
+    parser = csvsqlcli.CsvSqlArgParser(prog=program_name,
+                                       description="This program runs the csvsqlcli jobs described in a manifest.")
+    parser.add_argument('-v', '--version', action='version', version='%s version %s'%(program_name, _VERSION))
+    parser.add_argument("manifest",
+            action="collect_path",
+            help="JSON or INI file describing the jobs.")
+    parser.add_argument("-d", "--database",
+            action="collect_path",
+            help="Use the specified sqlite file as the shared storage for the inputs. By default, a "
+                 "temporary database is used.")
+    parser.add_argument("-j", "--jobs",
+            type=int,
+            metavar="N",
+            help="Run up to N jobs at the same time. By default, the number of processors.")
+    parser.add_argument("-r", "--report",
+            action="collect_path",
+            help="Write the timing report to this csv file instead of the standard output.")
+    parser.add_argument("--timeout",
+            type=float,
+            metavar="SECONDS",
+            help="Interrupt the statements of any job lasting more than SECONDS. The job fails then.")
+    parser.add_argument("--force",
+            default=False,
+            action='store_true',
+            help="Allows to override the outputs of the jobs if already present.")
+    return parser
+
+
+def load_manifest(path):
+    """ given the path of a manifest, it returns its contents as a dict with the general settings
+        and the key 'jobs' containing a list of dicts, one per job.
+        Files with extension .json are considered JSON. Otherwise, they are considered INI.
+    """
+    try:
+        if path.suffix.lower() == '.json':
+            manifest = json.loads(path.read_text())
+        else:
+            manifest = load_ini_manifest(path.read_text())
+    except (ValueError, configparser.Error) as err:
+        csvsqlcli.print_error_and_exit("Problems found with %s: %s"%(path, err))
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('jobs'), list):
+        csvsqlcli.print_error_and_exit("Problems found with %s: no jobs defined"%path)
+    return manifest
+
+
+def load_ini_manifest(contents):
+    """ given the contents of an INI manifest, it returns the corresponding dict as load_manifest() """
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str
+    config.read_string(contents)
+    manifest = dict(config['batch']) if config.has_section('batch') else {}
+    manifest['jobs'] = []
+    for section in config.sections():
+        if not section.startswith('job '):
+            continue
+        job = { 'name': section[len('job '):].strip() }
+        for key, value in config[section].items():
+            if key in _JOB_LIST_KEYS and key != 'statement':
+                value = [ line.strip() for line in value.splitlines() if line.strip() ]
+            job[key] = value
+        manifest['jobs'].append(job)
+    return manifest
+
+
+def get_jobs(manifest, folder, force=False):
+    """ given the manifest contents and the folder relative paths refer to, it returns the list of Job.
+
+        In case a job is not valid, or any of its inputs neither exists nor is the output of a job, it
+        displays an error and stops execution.
+    """
+    jobs = []
+    names = set()
+    for number, spec in enumerate(manifest['jobs'], 1):
+        unknown = set(spec) - set(_JOB_LIST_KEYS) - set(_JOB_VALUE_KEYS)
+        if unknown:
+            csvsqlcli.print_error_and_exit("Unknown keys for job %d: %s"%(number, ', '.join(sorted(unknown))))
+        name = str(spec.get('name', 'job%d'%number))
+        if name in names:
+            csvsqlcli.print_error_and_exit("Job %s defined twice"%name)
+        names.add(name)
+        values = { key: spec.get(key, []) for key in _JOB_LIST_KEYS }
+        for key in _JOB_LIST_KEYS:
+            if isinstance(values[key], str):
+                values[key] = [ values[key] ]
+        inputs = [ ('-i', folder / path) for path in values['input'] ] + \
+                 [ ('-u', folder / path) for path in values['unheaded'] ]
+        outputs = [ (option, folder / spec[key], 0)
+                    for option, key in (('-o', 'output'), ('-O', 'unheadedOutput')) if key in spec ]
+        statements = [ ('-s', statement) for statement in values['statement'] ] + \
+                     [ ('-f', folder / path) for path in values['file'] ]
+        for option, path in [ pair for pair in statements if pair[0] == '-f' ]:
+            if not path.is_file():
+                csvsqlcli.print_error_and_exit("File %s not found"%path)
+        csvsqlcli.check_outputs([ path for _, path, _ in outputs ], force)
+        args = argparse.Namespace(statements=statements, outputs=outputs, force=force, format='csv')
+        plan_statements, destinations = csvsqlcli.get_plan(args)
+        if any(path is None for dests in destinations.values() for _, path in dests):
+            csvsqlcli.print_error_and_exit("Job %s has no output"%name)
+        jobs.append(Job(name, inputs, plan_statements, destinations))
+    produced = set().union(*(get_job_outputs(job) for job in jobs))
+    for job in jobs:
+        for _, path in job.inputs:
+            if not path.is_file() and path.resolve() not in produced:
+                csvsqlcli.print_error_and_exit("File %s not found (input of job %s)"%(path, job.name))
+    return jobs
+
+
+def get_dependencies(jobs):
+    """ given a list of Job, it returns a dict {job name: set of names of the jobs producing its inputs}
+
+        In case the jobs depend on each other circularly, or two of them produce the same output, it
+        displays an error and stops execution.
+    """
+    producers = {}
+    for job in jobs:
+        for path in get_job_outputs(job):
+            if path in producers:
+                csvsqlcli.print_error_and_exit("Output %s produced by jobs %s and %s"%(path, producers[path], job.name))
+            producers[path] = job.name
+    dependencies = { job.name: { producers[path.resolve()] for _, path in job.inputs if path.resolve() in producers }
+                     for job in jobs }
+    visited = set()
+    def visit(name, chain):
+        if name in chain:
+            csvsqlcli.print_error_and_exit("Circular dependency among jobs %s"%', '.join(chain))
+        if name not in visited:
+            for dependency in dependencies[name]:
+                visit(dependency, chain + [ name ])
+            visited.add(name)
+    for name in dependencies:
+        visit(name, [])
+    return dependencies
+
+
+def get_job_outputs(job):
+    """ returns the set of resolved paths of the outputs of the job """
+    return { path.resolve() for dests in job.destinations.values() for _, path in dests }
+
+
+def get_imports(jobs):
+    """ given a list of Job, it returns a dict {table name: (option_string, path)} with the distinct
+        inputs of the jobs. Paths are resolved.
+
+        In case two different inputs would be stored in the same table, it displays an error and stops
+        execution.
+    """
+    imports = {}
+    for job in jobs:
+        for option_string, path in job.inputs:
+            pair = (option_string, path.resolve())
+            table_name = path.stem
+            if imports.setdefault(table_name, pair) != pair:
+                csvsqlcli.print_error_and_exit("Inputs %s and %s can't share table %s"%(imports[table_name][1], path, table_name))
+    return imports
+
+
+def run_jobs(jobs, database, workers, timeout=None):
+    """ runs the jobs on database and returns the timing report as a list of tuples
+        (job name, status, start, seconds) in the order the jobs finished. Jobs lasting more than
+        timeout seconds are interrupted and fail.
+        status is one of 'ok', 'failed' or 'skipped' (when a job producing its inputs has failed).
+        start and seconds are measured from the beginning of the run.
+
+        The inputs not produced by any job are imported at the beginning. The rest of them just before
+        the first job that requires them. A job whose inputs can't be imported fails too.
+    """
+    begin = time.perf_counter()
+    dependencies = get_dependencies(jobs)
+    imports = get_imports(jobs)
+    produced = set().union(*(get_job_outputs(job) for job in jobs))
+    jobs_by_name = { job.name: job for job in jobs }
+    db = sqlite3.connect(str(database), timeout=_LOCK_TIMEOUT)
+    db.execute('pragma journal_mode=wal')
+    imported = set()
+    import_errors = {}
+
+    def import_inputs(pairs):
+        """ imports the pairs not imported yet, and returns the error of the first one that can't be
+            imported, or None """
+        for pair in pairs:
+            if pair not in imported and pair not in import_errors:
+                try:
+                    csvsql.import_csv_list(db, [ pair ])
+                    imported.add(pair)
+                except (OSError, sqlite3.Error, csv.Error, ValueError) as err:
+                    import_errors[pair] = err
+        return next((import_errors[pair] for pair in pairs if pair in import_errors), None)
+
+    import_inputs([ pair for pair in imports.values() if pair[1] not in produced ])
+
+    report = []
+    finished = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while dependencies or running:
+            for name in [ name for name, deps in dependencies.items() if deps <= finished ]:
+                del dependencies[name]
+                error = import_inputs([ (option_string, path.resolve())
+                                        for option_string, path in jobs_by_name[name].inputs ])
+                if error is not None:
+                    print("Job %s failed importing its inputs: %s"%(name, error), file=sys.stderr)
+                    report.append((name, 'failed', time.perf_counter() - begin, 0.0))
+                    report.extend(skip_dependents(name, dependencies, time.perf_counter() - begin))
+                    continue
+                future = executor.submit(run_job, database, jobs_by_name[name], timeout)
+                running[future] = (name, time.perf_counter() - begin)
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name, start = running.pop(future)
+                error = future.exception()
+                seconds = time.perf_counter() - begin - start
+                if error is None:
+                    finished.add(name)
+                    report.append((name, 'ok', start, seconds))
+                    continue
+                print("Job %s failed: %s"%(name, error), file=sys.stderr)
+                report.append((name, 'failed', start, seconds))
+                report.extend(skip_dependents(name, dependencies, time.perf_counter() - begin))
+    db.close()
+    return report
+
+
+def skip_dependents(name, dependencies, now):
+    """ removes from dependencies every job depending, directly or not, on the job name.
+        It returns the corresponding timing report entries """
+    skipped = []
+    failed = [ name ]
+    while failed:
+        current = failed.pop()
+        for dependent in [ dependent for dependent, deps in dependencies.items() if current in deps ]:
+            del dependencies[dependent]
+            skipped.append((dependent, 'skipped', now, 0.0))
+            failed.append(dependent)
+    return skipped
+
+
+def run_job(database, job, timeout=None):
+    """ executes the statements of the job on its own connection to database and writes the results
+        of the statements bound to a destination. The changes performed by the statements are rolled
+        back at the end.
+        Jobs containing statements that are not read only lock the database for writing on start, so
+        they don't interfere with other jobs.
+        When the statements last more than timeout seconds, they are interrupted raising
+        csvsql.BudgetExceeded.
+    """
+    db = sqlite3.connect(str(database), timeout=_LOCK_TIMEOUT, isolation_level=None)
+    budget = csvsql.StatementBudget(run_timeout=timeout) if timeout is not None else None
+    try:
+        read_only = all(csvsqlcli.is_read_only(statement) for statement in job.statements)
+        db.execute('begin' if read_only else 'begin immediate')
+        with budget.applied(db) if budget else contextlib.nullcontext():
+            for index, statement in enumerate(job.statements):
+                results = csvsql.iterate_statement(db, statement, budget)
+                if index in job.destinations:
+                    csvsqlcli.write_output(results, job.destinations[index])
+    finally:
+        if db.in_transaction:
+            db.execute('rollback')
+        db.close()
+
+
+def write_report(report, path=None):
+    """ writes the timing report as csv on path, or the standard output when path is None """
+    rows = [ ('job', 'status', 'start', 'seconds') ] + \
+           [ (name, status, '%.3f'%start, '%.3f'%seconds) for name, status, start, seconds in report ]
+    if path is None:
+        csv.writer(sys.stdout).writerows(rows)
+        return
+    with path.open('w') as fs:
+        csv.writer(fs).writerows(rows)
+
+
+def main():
+    """ entry point of the csvsqlbatch command """
+    csvsqlbatch_process_cml_args(sys.argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,19 +23,170 @@
 
 import sys
 import os
-import argparse
-import pathlib
 import re
-import itertools
-import io
-import tempfile
-import csv
-import sqlite3
-import csvsql
+import time
+import argparse
+import importlib.util
+
+
+def _lazy_import(name):
+    """ imports the module name as the statement 'import name' does, but the module is actually
+        loaded on the first access to any of its attributes. It allows to avoid loading the modules
+        not required (e.g. on -h). As 'import name', it returns the top level package of name """
+    if name not in sys.modules:
+        spec = importlib.util.find_spec(name)
+        spec.loader = importlib.util.LazyLoader(spec.loader)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        parent, _, child = name.rpartition('.')
+        if parent:
+            setattr(sys.modules[parent], child, module)
+    return sys.modules[name.partition('.')[0]]
+
+
+pathlib = _lazy_import('pathlib')
+itertools = _lazy_import('itertools')
+io = _lazy_import('io')
+tempfile = _lazy_import('tempfile')
+csv = _lazy_import('csv')
+sqlite3 = _lazy_import('sqlite3')
+contextlib = _lazy_import('contextlib')
+collections = _lazy_import('collections')
+concurrent = _lazy_import('concurrent.futures')
+glob = _lazy_import('glob')
+queue = _lazy_import('queue')
+json = _lazy_import('json')
+codecs = _lazy_import('codecs')
+threading = _lazy_import('threading')
+if __package__:
+    csvsql = getattr(_lazy_import(__package__ + '.csvsql'), 'csvsql')
+else:
+    csvsql = _lazy_import('csvsql')
 
 # Current version of this cli
 _VERSION = "1.0.0"
 
+# Lines in statement files that bind the results of the next statement to an output
+_OUTPUT_DIRECTIVE = re.compile(r'^\s*--\s*@(output|unheadedOutput)\s+(\S.*)$')
+
+# Levels of database checks, from the cheapest to the most thorough
+_CHECK_LEVELS = ('none', 'header', 'quick', 'full')
+
+# Pairs (size limit, level) choosing the check level of a database smaller than limit on --check auto
+_AUTO_CHECK_LEVELS = ((256 * 1024 ** 2, 'full'), (4 * 1024 ** 3, 'quick'), (None, 'header'))
+
+# Name of the cache of passed database checks
+_CHECK_CACHE = 'checks'
+
+# Header of the sqlite3 database files and position of the change counter in it
+_SQLITE_MAGIC = b'SQLite format 3\x00'
+_CHANGE_COUNTER_OFFSET = 24
+
+# Pages copied on each step when copying databases
+_BACKUP_STEP_PAGES = 4096
+
+# Rows fetched at once, number of fetched chunks waiting to be written, and buffer size of the output files
+_OUTPUT_CHUNK_ROWS = 1024
+_OUTPUT_QUEUE_CHUNKS = 16
+_OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Seconds between checks of the writer thread while waiting to queue a chunk
+_OUTPUT_QUEUE_TIMEOUT = 0.5
+
+# Formats of the outputs
+_OUTPUT_FORMATS = ('csv', 'tsv', 'jsonl', 'sqlite')
+
+# Prefix of the names of the databases attached to receive the results on --format sqlite
+_OUTPUT_SCHEMA = '__csvsql_output'
+
+# Names of tables and other sql objects accepted in the options
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Statements that can't be run within the transaction of the statements
+_TRANSACTION_STATEMENT = re.compile(r'^\s*(begin|commit|end|rollback|vacuum|attach|detach)\b', re.IGNORECASE)
+
+# Statements that can be run on a read only connection
+_READ_ONLY_STATEMENT = re.compile(r'^\s*(select|values)\b', re.IGNORECASE)
+
+
+class StatementMonitor:
+    """ Reports how the statements are executed:
+
+        explain: when True, the query plan of each statement is printed to the standard error output
+                 before executing it, marking the steps that usually make it slow and suggesting
+                 indexes to avoid them
+        threshold: when not None, the statements lasting at least threshold milliseconds are
+                   recorded as a JSON object per line with the keys statement, ms, rows (rows returned
+                   or changed), plan and executed (the statements run by sqlite3, as reported by the
+                   trace callback of the connection, e.g. triggers)
+        slow_log: the path of the file where the slow statements are appended to. By default, the
+                  standard error output
+    """
+
+    def __init__(self, explain=False, threshold=None, slow_log=None):
+        self.explain = explain
+        self.threshold = threshold
+        self.slow_log = slow_log
+
+    def iterate(self, db, statement, budget=None):
+        """ executes the statement on db as csvsql.iterate_statement() and returns an iterator on
+            its results. When logging slow statements, the statement is recorded once its results
+            are exhausted """
+        if self.explain:
+            self.print_plan(db, statement)
+        if self.threshold is None:
+            return csvsql.iterate_statement(db, statement, budget)
+        executed = []
+        changes = db.total_changes
+        start = time.perf_counter()
+        db.set_trace_callback(executed.append)
+        try:
+            results = csvsql.iterate_statement(db, statement, budget)
+        except sqlite3.Error:
+            db.set_trace_callback(None)
+            raise
+        return self._log(db, statement, results, start, changes, executed)
+
+    def _log(self, db, statement, results, start, changes, executed):
+        """ yields the results, and records the statement when slow once exhausted """
+        count = -1
+        try:
+            for row in results:
+                count += 1
+                yield row
+        finally:
+            db.set_trace_callback(None)
+            milliseconds = (time.perf_counter() - start) * 1000
+            if milliseconds >= self.threshold:
+                try:
+                    plan = [ detail for _, detail in csvsql.get_query_plan(db, statement) ]
+                except sqlite3.Error:
+                    plan = None
+                record = { 'statement': statement, 'ms': round(milliseconds, 3),
+                           'rows': count if count >= 0 else db.total_changes - changes,
+                           'plan': plan, 'executed': executed }
+                if self.slow_log is None:
+                    print(json.dumps(record), file=sys.stderr)
+                else:
+                    with self.slow_log.open('a') as fo:
+                        fo.write(json.dumps(record) + '\n')
+
+    def print_plan(self, db, statement):
+        """ prints the query plan of statement and the suggested indexes to the standard error output """
+        try:
+            plan = csvsql.get_query_plan(db, statement)
+            suggestions = csvsql.suggest_indexes(db, statement)
+        except sqlite3.Error as err:
+            print("Query plan of %s unavailable: %s"%(statement, err), file=sys.stderr)
+            return
+        lines = [ "Query plan of %s"%statement ]
+        for depth, detail in plan:
+            warnings = csvsql.get_plan_warnings(detail)
+            lines.append('  %s%s%s'%('  ' * depth, detail, '  <-- %s'%', '.join(warnings) if warnings else ''))
+        lines.extend('  Suggested: %s'%index for index in suggestions)
+        print('\n'.join(lines), file=sys.stderr)
+
 
 class CsvSqlArgParser(argparse.ArgumentParser):
     """ This class defines the parsing of the arguments for the csvsqlcli
@@ -69,6 +220,22 @@ class CsvSqlArgParser(argparse.ArgumentParser):
             items.extend( (option, pathlib.Path(v)) for v in values if (option, v) not in items)
             setattr(namespace, self.dest, items)
 
+    class OutputCollector(argparse.Action):
+        """ This class defines an action that composes a list of tuples (option_string, path, anchor)
+        in the received order. anchor is the number of statement sources (-s and -f values) found
+        before the option in the command line, so the output can be bound to the statement
+        preceding it.
+        Values are converted to pathlib.Path
+        """
+
+
+        def __call__(self, parser, namespace, values, option_string=None):
+            option = min(self.option_strings, key=len)
+            items = getattr(namespace, self.dest) or []
+            anchor = len(getattr(namespace, 'statements', None) or [])
+            items.append((option, pathlib.Path(values), anchor))
+            setattr(namespace, self.dest, items)
+
     class PathCollector(argparse.Action):
         """ This class defines an action, that considers the value as a string containing a path
             and stores the value as a pathlib.Path
@@ -85,6 +252,7 @@ class CsvSqlArgParser(argparse.ArgumentParser):
         self.register('action', 'collect_path', CsvSqlArgParser.PathCollector)
         self.register('action', 'collect_statements', CsvSqlArgParser.StatementCollector)
         self.register('action', 'collect_inputs', CsvSqlArgParser.InputCollector)
+        self.register('action', 'collect_outputs', CsvSqlArgParser.OutputCollector)
 
 
     def error(self, message):
@@ -95,26 +263,375 @@ class CsvSqlArgParser(argparse.ArgumentParser):
 def csvsql_process_cml_args(clargs):
     """ This method interprets the commandline arguments in clargs (typically the contents of sys.args) and
     executes the required statements on the required data.
-    Finally, it writes out the results of the last statement to the required output destination.
+    Finally, it writes out the results of the statements bound to an output destination (by default,
+    the last one) to the required output destinations.
     """
     parser = get_argparse(program_name=clargs[0])
     args = get_args(parser, clargs[1:])
-    statements = get_statements(args.statements)
+    statements, destinations = get_plan(args)
+    if args.engine == 'columnar' and run_columnar(statements, destinations, args):
+        return
     db = get_db(args)
-    load_input(db, args.input)
-    results = execute_statements(db, statements)
-    write_output(results, args)
+    cleaner = get_cleaner(args)
+    db = load_input(db, args.input, args.incremental, args.memory_limit, args.stats, args.reader, cleaner,
+                    dict(args.keys), args.duplicates, args.sniff, args.delimiter, args.encoding, args.dictionary)
+    tables = [ (table_name, paths) for table_name, paths, _ in args.tables ]
+    if args.stats and not args.incremental and all(is_read_only(statement) for statement in statements):
+        tables = [ (table_name, csvsql.prune_shards(paths, statements, table_name,
+                                                    csvsql.get_csv_format(paths[0], args.sniff, args.delimiter,
+                                                                          args.encoding)[0]) or paths[:1])
+                   for table_name, paths in tables ]
+    load_shards(db, tables, args.source_column, args.parallel, args.incremental, args.stats,
+                args.sniff, args.delimiter, args.encoding)
+    update_materialized(db, args.materialize, args.drop_materialized)
+    if args.watch:
+        watch_inputs(db, args.input, statements, destinations, args.watch_interval, incremental=args.incremental,
+                     output_format=args.format, monitor=get_monitor(args), cleaner=cleaner,
+                     keys=dict(args.keys), duplicates=args.duplicates, sniff=args.sniff,
+                     delimiter=args.delimiter, encoding=args.encoding, dictionary=args.dictionary,
+                     tables=[ (table_name, pattern) for table_name, _, pattern in args.tables ],
+                     source_column=args.source_column, workers=args.parallel)
+    elif args.sync:
+        tracker = csvsql.ChangeTracker(db)
+        execute_statements(db, statements, destinations, args)
+        sync_tables(db, args.input, tracker, args.sync_dir or pathlib.Path('.'), args.force)
+    else:
+        execute_statements(db, statements, destinations, args)
+    if args.save_to:
+        copy_db(db, args.save_to, args.progress)
     db.close()
+    if args.database:
+        remember_db_check(args.database, args.checked)
+
+
+def execute_statements(db, statements, destinations, args):
+    """ tries to execute the statements and writes the results of those bound to a destination.
+
+        destinations: a dict {statement index: list of (option_string, path)} as returned by get_plan()
+
+        When args.database and args.parallel > 1, the trailing read only statements are exported
+        concurrently, each one on its own read connection, once the rest of the statements are
+        committed.
 
+        The statements are executed in a transaction, so that when any of them fails the changes of
+        all of them are rolled back, tables created included. Statements that control transactions
+        themselves, or can't run within one (e.g. vacuum), are executed as they come instead.
 
-def execute_statements(db, statements):
-    """ tries to execute the statements and returns the results """
+        When a budget is set (--timeout, --run-timeout or --max-steps) and a statement exceeds it,
+        the changes are rolled back and the timings of the statements executed are reported.
+    """
+    deferred = get_parallel_exports(statements, destinations, args)
+    budget = get_budget(args)
     try:
-        return csvsql.execute_statements(db, statements)[-1] # just results for the last statement
+        if args.format == 'sqlite':
+            attach_outputs(db, destinations)
+        if not db.in_transaction and not any(_TRANSACTION_STATEMENT.match(statement) for statement in statements):
+            db.execute('begin')
+        with budget.applied(db) if budget else contextlib.nullcontext():
+            run_statements(db, statements[:len(statements) - len(deferred)], destinations, args.format, budget,
+                           get_monitor(args))
+        db.commit()
+        if deferred:
+            export_in_parallel(args.database, deferred, args.parallel, args.format)
+    except csvsql.BudgetExceeded as err:
+        db.rollback()
+        timings = ''.join('\n  %.3fs %s'%(seconds, statement) for statement, seconds in budget.timings)
+        print_error_and_exit("Statement interrupted: %s. Changes rolled back. Timings:%s"%(err.reason, timings))
     except sqlite3.OperationalError as err:
+        db.rollback()
         print_error_and_exit("Problems with the statements %s Error: %s"%(statements, err))
 
 
+def run_statements(db, statements, destinations, output_format='csv', budget=None, monitor=None):
+    """ executes the statements on db and writes the results of those bound to a destination in
+        output_format. It doesn't commit the changes.
+        On 'sqlite' output_format, the databases of the destinations must be already attached (see
+        attach_outputs()).
+        budget: when not None, the csvsql.StatementBudget applied to db the statements must keep
+        monitor: when not None, the StatementMonitor reporting the execution of the statements. The
+                 results of the statements not bound to a destination are fetched then, so they can
+                 be timed """
+    for index, statement in enumerate(statements):
+        if output_format == 'sqlite' and index in destinations:
+            write_tables(db, statement, destinations[index], budget, monitor)
+            continue
+        results = (monitor.iterate if monitor else csvsql.iterate_statement)(db, statement, budget)
+        if index in destinations:
+            write_output(results, destinations[index], output_format=output_format)
+        elif monitor:
+            collections.deque(results, maxlen=0)
+
+
+def attach_outputs(db, destinations):
+    """ attaches to db the databases of the destinations for --format sqlite that are not attached yet.
+
+        destinations: a dict {statement index: list of (option_string, path)} as returned by get_plan()
+    """
+    attached = { row[2] for row in db.execute('pragma database_list') }
+    for path in sorted({ str(parse_sqlite_output(path)[0].resolve())
+                         for statement_destinations in destinations.values()
+                         for _, path in statement_destinations }):
+        if path not in attached:
+            db.execute('attach database ? as %s%d' % (_OUTPUT_SCHEMA, len(attached)), (path,))
+            attached.add(path)
+
+
+def write_tables(db, statement, destinations, budget=None, monitor=None):
+    """ writes the results of the select statement into the tables of the destinations, replacing
+        them. The rows are copied by sqlite3 (create table ... as select), so they don't go through
+        python. The databases of the destinations must be already attached (see attach_outputs()).
+        budget, monitor: as in run_statements() """
+    schemas = { row[2]: row[1] for row in db.execute('pragma database_list') }
+    for _, path in destinations:
+        database, table_name = parse_sqlite_output(path)
+        schema = schemas[str(database.resolve())]
+        db.execute('drop table if exists %s.%s' % (schema, table_name))
+        create = 'create table %s.%s as %s' % (schema, table_name, statement.rstrip().rstrip(';'))
+        collections.deque((monitor.iterate if monitor else csvsql.iterate_statement)(db, create, budget), maxlen=0)
+
+
+def parse_sqlite_output(path):
+    """ given the path of an output for --format sqlite, with the form database[#table], it returns the
+        pair (database path, table name). The table name defaults to the stem of the database.
+        It raises ValueError when the table name is not a valid identifier """
+    database, separator, table_name = str(path).rpartition('#')
+    database, table_name = (pathlib.Path(database), table_name) if separator else (path, path.stem)
+    if not _IDENTIFIER.match(table_name):
+        raise ValueError("invalid table name %r for output %s"%(table_name, path))
+    return database, table_name
+
+
+def sync_tables(db, files, tracker, folder, force=False):
+    """ writes back to the filesystem the tables changed by the statements.
+
+        files: the list of pairs (option_string, path) imported on db
+        tracker: the csvsql.ChangeTracker created before executing the statements
+        folder: the folder where the tables not imported from files are written to
+        force: when True, files for new tables are written even if they already exist
+
+        Changed tables imported from files are written back to their file (without headers for -u
+        files). New tables are written as folder/table_name.csv. The files of the removed tables are
+        deleted. The rest of files are not touched.
+    """
+    changed, removed = tracker.close()
+    sources = { path.stem: (option_string, path) for option_string, path in files }
+    targets = { table_name: sources.get(table_name, ('-i', folder / (table_name + '.csv')))
+                for table_name in sorted(changed) }
+    check_outputs([ path for table_name, (_, path) in targets.items() if table_name not in sources ], force)
+    for table_name, (option_string, path) in targets.items():
+        csvsql.export_table(db, table_name, path, header=option_string == '-i')
+    for table_name in removed:
+        if table_name in sources:
+            sources[table_name][1].unlink()
+
+
+def watch_inputs(db, files, statements, destinations, interval, sleep=time.sleep, polls=None, incremental=False,
+                 output_format='csv', monitor=None, cleaner=None, keys=None, duplicates='error', sniff=False,
+                 delimiter=None, encoding=None, dictionary=False, tables=(), source_column=None, workers=None):
+    """ executes the statements and writes their outputs every time any of the input files changes,
+        until the user interrupts the program.
+
+        files: the list of pairs (option_string, path) already imported on db
+        interval: seconds between two consecutive checks of the files
+        sleep: the function to wait for the next check
+        polls: when not None, the maximum number of checks
+        incremental: when True, just the rows appended to the changed files are imported, as in
+                     csvsql.import_csv_incrementally()
+        output_format: the format of the outputs, as in write_output(). 'sqlite' is not supported,
+                       since the changes are discarded after each execution
+        monitor: when not None, the StatementMonitor reporting the execution of the statements
+        cleaner: when not None, the csvsql.RowCleaner filtering the rows of the changed files
+        keys, duplicates: the primary keys of the tables and the policy on duplicated keys, as in
+                          csvsql.import_csv_list()
+        sniff, delimiter, encoding: how to read the files, as in csvsql.import_csv_list()
+        dictionary: when True, the columns with few distinct values are dictionary encoded, as in
+                    csvsql.import_csv_list()
+        tables: the list of pairs (table_name, glob) of the tables already loaded on db from shards
+        source_column, workers: how to load the shards of the tables, as in load_shards()
+
+        A file is considered changed when its modification time or size changes. Changes are considered
+        once the file has not changed during a whole interval. Then, just the changed files are imported
+        again. The glob of each table is expanded on every check, and the table is loaded again from its
+        current shards when any of them changes, or when shards are added or removed.
+        The statements are executed in a transaction that is rolled back once the outputs are written,
+        so the imported tables remain as in the files. Errors are reported and the watch goes on; the
+        files that failed to import are imported again on the next check.
+    """
+    def signatures():
+        result = {}
+        for pair in files:
+            try:
+                stat = pair[1].stat()
+                result[pair] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                result[pair] = None
+        for table_name, pattern in tables:
+            shards = []
+            for path in sorted(glob.glob(pattern)):
+                try:
+                    stat = os.stat(path)
+                    shards.append((path, stat.st_mtime_ns, stat.st_size))
+                except OSError:
+                    pass                # removed since the glob was expanded
+            result[('-t', table_name)] = tuple(shards)
+        return result
+
+    def run():
+        try:
+            db.execute('begin')
+            run_statements(db, statements, destinations, output_format, monitor=monitor)
+        except sqlite3.Error as err:
+            print("Problems with the statements %s Error: %s"%(statements, err), file=sys.stderr)
+        except OSError as err:
+            print("Problems writing the outputs of the statements %s Error: %s"%(statements, err),
+                  file=sys.stderr)
+        finally:
+            db.rollback()
+
+    loaded = previous = signatures()
+    run()
+    try:
+        while polls is None or polls > 0:
+            sleep(interval)
+            polls = None if polls is None else polls - 1
+            current = signatures()
+            stable = current == previous
+            previous = current
+            if not stable or current == loaded:
+                continue
+            changed = [ pair for pair in files if current[pair] != loaded[pair] and current[pair] is not None ]
+            changed_tables = [ (table_name, [ pathlib.Path(shard[0]) for shard in current[('-t', table_name)] ])
+                               for table_name, _ in tables
+                               if current[('-t', table_name)] != loaded[('-t', table_name)] ]
+            try:
+                csvsql.import_csv_list(db, changed, incremental=incremental, cleaner=cleaner,
+                                       keys=keys, duplicates=duplicates, sniff=sniff, delimiter=delimiter,
+                                       encoding=encoding, dictionary=dictionary)
+                for table_name, paths in changed_tables:
+                    import_shards(db, table_name, paths, source_column, workers, incremental, sniff=sniff,
+                                  delimiter=delimiter, encoding=encoding)
+            except (OSError, sqlite3.Error, csv.Error, ValueError) as err:
+                print("Problems loading %s Error: %s"%([ str(path) for _, path in changed ] +
+                                                       [ table_name for table_name, _ in changed_tables ], err),
+                      file=sys.stderr)
+                continue                # loaded is kept, so the import is tried again on the next check
+            loaded = current
+            try:
+                csvsql.refresh_materialized(db)
+            except sqlite3.Error as err:
+                print("Problems refreshing the materialized aggregates Error: %s"%err, file=sys.stderr)
+            run()
+    except KeyboardInterrupt:
+        pass
+
+
+def update_materialized(db, materialize=(), drop=()):
+    """ drops the materialized aggregates named in drop, refreshes the remaining ones kept in db from the
+        rows just imported and creates the ones in materialize, a list of pairs (name, statement), as
+        csvsql.create_materialized(). In case of problems, it displays an error and stops execution """
+    try:
+        for name in drop:
+            csvsql.drop_materialized(db, name)
+        csvsql.refresh_materialized(db)
+        for name, statement in materialize:
+            csvsql.create_materialized(db, name, statement)
+    except sqlite3.Error as err:
+        print_error_and_exit("Problems with the materialized aggregates: %s"%err)
+
+
+def run_columnar(statements, destinations, args):
+    """ when all the statements are read only, and the ones bound to a destination can be computed by
+        csvsql.query_csv() straight from the -i and -u inputs, it writes their results and returns True.
+        Otherwise, it returns False without writing anything, and the statements must be executed by
+        sqlite3. The options requiring the inputs to be imported (e.g. --database or --key) prevent
+        computing the statements this way """
+    if (args.database or args.load_from or args.save_to or args.tables or args.sync or args.watch
+            or args.stats or args.keys or args.format == 'sqlite' or get_cleaner(args) or get_budget(args)
+            or args.sniff or args.delimiter or args.encoding
+            or get_monitor(args) or not all(is_read_only(statement) for statement in statements)):
+        return False
+    tables = { path.stem: (path, '' if option_string == '-u' else None) for option_string, path in args.input }
+    results = {}
+    for index in sorted(destinations):
+        results[index] = csvsql.query_csv(statements[index], tables)
+        if results[index] is None:
+            return False
+    for index, statement_results in results.items():
+        write_output(iter(statement_results), destinations[index], output_format=args.format)
+    return True
+
+
+def get_cleaner(args):
+    """ returns the csvsql.RowCleaner set by --dedupe, --required, --headed-only and --strict, or None
+        when none of them is set """
+    if not (args.dedupe or args.required or args.headed_only or args.strict):
+        return None
+    return csvsql.RowCleaner(dedupe=args.dedupe, required=args.required or (),
+                             headed_only=args.headed_only, strict=args.strict)
+
+
+def get_monitor(args):
+    """ returns the StatementMonitor set by --explain, --slow-log and --slow-log-file, or None when
+        they are not set """
+    if not args.explain and args.slow_log is None:
+        return None
+    return StatementMonitor(args.explain, args.slow_log, args.slow_log_file)
+
+
+def get_budget(args):
+    """ returns the csvsql.StatementBudget set by --timeout, --run-timeout and --max-steps, or None
+        when none of them is set """
+    if args.timeout is None and args.run_timeout is None and args.max_steps is None:
+        return None
+    return csvsql.StatementBudget(statement_timeout=args.timeout, run_timeout=args.run_timeout,
+                                  max_steps=args.max_steps)
+
+
+def get_parallel_exports(statements, destinations, args):
+    """ returns the list of pairs (statement, destinations) that can be exported in parallel.
+        They are the read only statements bound to a destination found at the end of statements.
+        Only file databases can be shared among connections, so the list is empty without
+        args.database. Read only connections can't write tables, so it is empty on --format sqlite.
+        It is also empty when a budget is set, since it applies to a single connection """
+    deferred = []
+    if not args.database or (args.parallel or 1) < 2 or args.format == 'sqlite' or get_budget(args):
+        return deferred
+    for index in range(len(statements) - 1, -1, -1):
+        if not is_read_only(statements[index]):
+            break
+        deferred.insert(0, (statements[index], destinations.get(index, [])))
+    return deferred
+
+
+def is_read_only(statement):
+    """ returns True when statement can be run on a read only connection.
+        Note: this method just checks the kind of the statement (SELECT or VALUES) """
+    return _READ_ONLY_STATEMENT.match(statement) is not None
+
+
+def export_in_parallel(database, exports, workers, output_format='csv'):
+    """ executes each statement in exports on its own read only connection to database and
+        writes the results to the corresponding destinations in output_format. At most workers
+        statements are run at the same time.
+
+        exports: a list of pairs (statement, list of (option_string, path))
+    """
+    uri = database.resolve().as_uri() + '?mode=ro'
+
+    def export(statement, statement_destinations):
+        db = sqlite3.connect(uri, uri=True)
+        try:
+            write_output(csvsql.iterate_statement(db, statement), statement_destinations, output_format=output_format)
+        finally:
+            db.close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [ executor.submit(export, statement, statement_destinations)
+                    for statement, statement_destinations in exports if statement_destinations ]
+        for future in futures:
+            future.result()
+
+
 def get_argparse(program_name):
     """ constructs an argument parser for this CLI and returns it.
         program_name: a str containing the name of this CLI
@@ -125,6 +642,25 @@ def get_argparse(program_name):
     parser.add_argument("-d", "--database",
             action="collect_path",
             help="Use the specified sqlite file as intermediate storage. If the file does not exist, it will be created.")
+    parser.add_argument("--check",
+            choices=('auto',) + _CHECK_LEVELS,
+            default='auto',
+            help="How to check the soundness of the --database file before using it: none, header (file "
+                 "header and schema), quick (pragma quick_check) or full (pragma integrity_check). Once "
+                 "a check passes, it is not repeated while the file doesn't change. By default, auto "
+                 "chooses full for files up to 256MB, quick up to 4GB and header for larger ones.")
+    parser.add_argument("--load-from",
+            action="collect_path",
+            help="Copy the contents of the specified sqlite file into memory before importing the inputs. "
+                 "It allows querying data previously saved with --save-to at in memory speed.")
+    parser.add_argument("--save-to",
+            action="collect_path",
+            help="Copy the resulting database into the specified sqlite file once the statements are "
+                 "executed. Former contents of the file are replaced.")
+    parser.add_argument("--progress",
+            default=False,
+            action='store_true',
+            help="Report the progress of --load-from and --save-to copies, in pages, on the standard error.")
     parser.add_argument("-i", "--input",
             action="collect_inputs", 
             dest="input",
@@ -147,15 +683,124 @@ def get_argparse(program_name):
                  "-u files will be stored in the database, as tables named after the file name"
                  ". On pre-existing tables, the previous contents will be overriden (not merged) "
                  "without warning.")
+    parser.add_argument("-t", "--table",
+            type=parse_table,
+            action="append",
+            dest="tables",
+            default=[],
+            metavar="NAME=GLOB",
+            help="Load all the csv files matching GLOB (e.g. 'scores_2026-*.csv') into a single table NAME. "
+                 "Files are expected to contain headers, and the table gets the columns of all of them. "
+                 "Files are parsed in parallel (see --parallel). Multiple -t options can be used to "
+                 "specify more than one table.")
+    parser.add_argument("--source-column",
+            metavar="NAME",
+            help="Add to the tables loaded with -t a column NAME containing the name of the file of each "
+                 "row. With --incremental, it allows skipping the files not changed since the last load.")
+    parser.add_argument("--stats",
+            default=False,
+            action='store_true',
+            help="Record the statistics (rows, and minimum and maximum values of each column) of the "
+                 "imported files. When all the statements are SELECT statements, the files of -t tables "
+                 "that can't match the conditions on text values of their WHERE clauses, according to "
+                 "the statistics recorded on previous executions, are not loaded.")
+    parser.add_argument("--reader",
+            choices=('csv', 'mmap'),
+            default='csv',
+            help="How the -i and -u inputs are read: 'csv' (default) reads them as text, while 'mmap' maps "
+                 "them in memory and keeps an index of the offset of each row, so that counting or reaching "
+                 "the rows of the same contents later doesn't require to scan them again. 'mmap' requires "
+                 "utf-8 files.")
+    parser.add_argument("--sniff",
+            default=False,
+            action='store_true',
+            help="Detect the encoding (utf-8, cp1252 or latin-1), the delimiter (',', ';', tab or '|'), the "
+                 "quote character and whether the first row is a header of each input from its first 64KB. "
+                 "-i inputs without a header are imported as -u ones. The detected format is cached until "
+                 "the file changes.")
+    parser.add_argument("--delimiter",
+            type=parse_delimiter,
+            metavar="CHAR",
+            help="Delimiter of the fields of the inputs, overriding --sniff. 'tab' stands for a tab.")
+    parser.add_argument("--encoding",
+            type=parse_encoding,
+            help="Encoding of the inputs (e.g. latin-1), overriding --sniff. By default, the one of the system.")
+    parser.add_argument("--engine",
+            choices=('sqlite', 'columnar'),
+            default='sqlite',
+            help="How the statements are executed. By default, 'sqlite' imports the inputs into sqlite3. "
+                 "With 'columnar', the SELECT statements on a single -i or -u input with just columns or "
+                 "aggregates (count, sum, avg, total, min, max), conditions comparing columns with text "
+                 "literals, and group by columns, are computed straight from the csv file, without importing "
+                 "it. When any statement is not supported, all of them are executed by sqlite3.")
+    parser.add_argument("--key",
+            type=parse_key,
+            action="append",
+            dest="keys",
+            default=[],
+            metavar="TABLE:COLUMNS",
+            help="Create the table TABLE of the -i and -u inputs with the primary key formed by the comma "
+                 "separated COLUMNS (e.g. 'scores:course,student'), stored WITHOUT ROWID. Lookups and joins "
+                 "on the key don't need a full scan nor an additional index. Inputs already sorted by the "
+                 "key are imported faster. It can be repeated for several tables.")
+    parser.add_argument("--duplicates",
+            choices=('error', 'first', 'last'),
+            default='error',
+            help="What to do with the rows with a repeated --key: stop with an 'error' (default), or keep "
+                 "the 'first' or the 'last' row with the key.")
+    parser.add_argument("--dictionary",
+            default=False,
+            action='store_true',
+            help="Store the text columns of the -i and -u inputs with few distinct values (e.g. codes or "
+                 "statuses) as integer codes, with the values kept once in a dictionary table per column. "
+                 "The table becomes a view with the original columns, so it can't be modified by the "
+                 "statements. Not applied to the tables with --key.")
+    parser.add_argument("--dedupe",
+            default=False,
+            action='store_true',
+            help="Import just the first occurrence of each row of the -i and -u inputs. The rows already "
+                 "seen are remembered by a digest, kept in memory up to a limit and in a temporary table "
+                 "beyond it.")
+    parser.add_argument("--required",
+            action='append',
+            metavar="COLUMN",
+            help="Don't import the rows of the -i and -u inputs with no value on the column COLUMN. "
+                 "Unheaded columns are named __COL1, __COL2... It can be repeated.")
+    parser.add_argument("--headed-only",
+            default=False,
+            action='store_true',
+            help="Ignore the values of the -i inputs beyond their headed columns, instead of adding "
+                 "columns for them.")
+    parser.add_argument("--strict",
+            default=False,
+            action='store_true',
+            help="Stop when a row of the -i and -u inputs has a number of values different to the "
+                 "number of columns (or to the first row, when unheaded).")
     parser.add_argument("-o", "--output",
-            action="collect_path",
-            help="Send output to this csv file. The file must not exist unleast --force is specified.")
+            action="collect_outputs",
+            dest="outputs",
+            default=[],
+            help="Send output to this csv file. The file must not exist unleast --force is specified. "
+                 "When it follows a -s or -f option, it receives the results of the last statement "
+                 "of that option. Otherwise, it receives the results of the last statement. "
+                 "Multiple -o options can be used to send results of different statements to "
+                 "different files.")
     parser.add_argument("-O", "--unheadedOutput",
-            action="collect_path",
-            help="Send output to this csv file. The file must not exist unleast --force is specified.")
+            action="collect_outputs",
+            dest="outputs",
+            default=[],
+            help="Send output to this csv file without the headers. The file must not exist "
+                 "unleast --force is specified. It is bound to statements as -o.")
+    parser.add_argument("--format",
+            choices=_OUTPUT_FORMATS,
+            default='csv',
+            help="Format of all the outputs: csv (default), tsv, jsonl (a JSON object per row, or a JSON "
+                 "array on -O outputs) or sqlite. On sqlite, each output has the form DATABASE[#TABLE] "
+                 "and the results are written into the table TABLE (by default, the name of the "
+                 "database file without extension) of the sqlite3 database DATABASE, replacing it.")
     parser.add_argument("--force", 
                         default=False,
-                        action='store_false',
+                        action='store_true',
                         help="Allows to override --output filename if already present.")
     parser.add_argument("-f", "--file",
             action = "collect_statements",
@@ -164,7 +809,8 @@ def get_argparse(program_name):
             default = [],
             help="Execute SQL statements stored in the given file. Multiple -f options can be used to "
                  "specify more than one statement sources. Each statement will be executed sequentially in the "
-                 "specified order.")
+                 "specified order. A line '-- @output path' (or '-- @unheadedOutput path') in the file "
+                 "sends the results of the following statement to path.")
     parser.add_argument("-s", "--statement",
             action = "collect_statements",
             dest = 'statements',
@@ -173,6 +819,91 @@ def get_argparse(program_name):
             help="Execute one or more SQL statements. Multiple -s options can be used to specify "
                  "more than one statement. Each statement will be executed sequentially in the "
                  "specified order.")
+    parser.add_argument("--memory-limit",
+            type=parse_size,
+            metavar="SIZE",
+            help="When --database is not specified, limit the memory used to keep the data to SIZE bytes "
+                 "(suffixes K, M and G allowed). When the inputs are estimated to require more, or they "
+                 "actually do while importing, a temporary database on disk is used instead.")
+    parser.add_argument("--parallel",
+            type=int,
+            metavar="N",
+            help="Use up to N workers at the same time: processes parsing the files of -t tables and, when "
+                 "--database is specified, read connections exporting the results of the trailing SELECT "
+                 "statements bound to an output. By default, files are parsed by as many processes as "
+                 "processors, and results are exported one after the other.")
+    parser.add_argument("--timeout",
+            type=float,
+            metavar="SECONDS",
+            help="Interrupt any statement lasting more than SECONDS, writing of its results included. "
+                 "Then, the changes are rolled back and the timings of the statements are reported.")
+    parser.add_argument("--run-timeout",
+            type=float,
+            metavar="SECONDS",
+            help="Interrupt the statements when they last more than SECONDS altogether, as --timeout.")
+    parser.add_argument("--max-steps",
+            type=int,
+            metavar="N",
+            help="Interrupt any statement executing more than N sqlite3 virtual machine instructions, "
+                 "as --timeout.")
+    parser.add_argument("--explain",
+            default=False,
+            action='store_true',
+            help="Print to the standard error output the query plan of each statement before executing "
+                 "it, marking full scans, automatic indexes and temporary b-trees, and suggesting "
+                 "indexes that would avoid them.")
+    parser.add_argument("--slow-log",
+            type=float,
+            metavar="MS",
+            help="Record the statements lasting MS milliseconds or more, with their query plans and row "
+                 "counts, as JSON lines on the standard error output (or --slow-log-file).")
+    parser.add_argument("--slow-log-file",
+            action="collect_path",
+            help="Append the records of --slow-log to this file.")
+    parser.add_argument("--materialize",
+            action="append",
+            nargs=2,
+            default=[],
+            metavar=("NAME", "STATEMENT"),
+            help="Keep in --database the results of the select STATEMENT, queryable as the view NAME, and "
+                 "refresh them on each execution before running the statements. When STATEMENT selects "
+                 "from a single table with sum, count, total, min, max or avg, optionally with where and "
+                 "group by clauses, just the rows appended since the last refresh (e.g. with "
+                 "--incremental) are aggregated. Otherwise, it is computed from scratch.")
+    parser.add_argument("--drop-materialized",
+            action="append",
+            default=[],
+            metavar="NAME",
+            help="Remove the materialized aggregate NAME from --database.")
+    parser.add_argument("--incremental",
+            default=False,
+            action='store_true',
+            help="Import just the rows appended to the input files since their last import. Mainly "
+                 "useful with --database or --watch: when a file has only grown, just its new rows are "
+                 "inserted into the existing table; when it hasn't changed, it is not read at all. "
+                 "Otherwise, it is imported from scratch.")
+    parser.add_argument("--sync",
+            default=False,
+            action='store_true',
+            help="Write back to the filesystem the tables changed by the statements. Changed tables "
+                 "are written to their input file, new tables to a file named after them in --sync-dir, "
+                 "and the input files of removed tables are deleted. Unchanged tables are not written.")
+    parser.add_argument("--sync-dir",
+            action="collect_path",
+            help="Folder where --sync writes the tables not imported from an input file. By default, "
+                 "the current folder.")
+    parser.add_argument("--watch",
+            default=False,
+            action='store_true',
+            help="Keep running and execute the statements again each time an input file changes. Just "
+                 "the changed files are imported again. The changes performed by the statements are "
+                 "discarded after each execution. Stop it with Ctrl+C.")
+    parser.add_argument("--watch-interval",
+            type=float,
+            default=1.0,
+            metavar="SECONDS",
+            help="Seconds between two checks of the input files on --watch. Changes are considered once "
+                 "the file remains unchanged during this time. By default, 1 second.")
 
     return parser
 
@@ -194,15 +925,37 @@ def get_args(parser, clargs):
     if not (args.statements):
         print_error_run_function_and_exit("Nothing to do", parser.print_help)
 
-    if args.output:
-        if pathlib.Path(args.output).is_file() and not args.force:
-            print_error_and_exit("File %s already exists. Remove it or use --force option"%args.output)
+    if args.format != 'sqlite':
+        check_outputs([ path for _, path, _ in args.outputs ], args.force)
+    elif args.watch:
+        print_error_run_function_and_exit("Options --format sqlite and --watch can't be combined", parser.print_help)
+
+    if args.load_from and args.database:
+        print_error_run_function_and_exit("Options --load-from and --database can't be combined", parser.print_help)
+
+    if args.incremental and (args.dedupe or args.required or args.headed_only or args.strict):
+        print_error_run_function_and_exit("Option --incremental can't be combined with --dedupe, --required, "
+                                          "--headed-only or --strict", parser.print_help)
+
+    if args.incremental and args.keys:
+        print_error_run_function_and_exit("Options --incremental and --key can't be combined", parser.print_help)
+
+    if (args.materialize or args.drop_materialized) and not args.database:
+        print_error_run_function_and_exit("Options --materialize and --drop-materialized require --database",
+                                          parser.print_help)
 
-    if args.unheadedOutput:
-        if pathlib.Path(args.unheadedOutput).is_file() and not args.force:
-            print_error_and_exit("File %s already exists. Remove it or use --force option"%args.unheadedOutput)
+    for name in [ name for name, _ in args.materialize ] + args.drop_materialized:
+        if not _IDENTIFIER.match(name) or name.lower().startswith('__csvsql'):
+            print_error_run_function_and_exit("Invalid materialized aggregate name: %s"%name, parser.print_help)
+
+    if args.sync and args.dictionary:
+        print_error_run_function_and_exit("Options --sync and --dictionary can't be combined", parser.print_help)
+
+    if args.sync and args.watch:
+        print_error_run_function_and_exit("Options --sync and --watch can't be combined", parser.print_help)
 
     paths = [ path for _, path in args.input ] +    \
+            ([ args.load_from ] if args.load_from else []) +    \
             [ path for option, path in args.statements if option == '-f']
     for path in paths:
         if not path.is_file():
@@ -211,22 +964,103 @@ def get_args(parser, clargs):
     return args
 
 
-def get_statements(pairs):
-    """ given the arguments already validated, it returns a list with the statements to be executed.
+def get_plan(args):
+    """ given the arguments already validated, it returns a tuple (statements, destinations) where
+        statements is the list of statements to be executed and destinations is a dict
+        {statement index: list of (option_string, path)} with the outputs of each statement.
 
-        pairs: a list of tuples (option_string, value) where option_string can be -f to indicate the value
-              is a path, or -s to indicate the value is a statement.
+        Outputs are bound to statements as follows:
+        - an output option placed after a -s or -f option is bound to the last statement of that option
+        - output options placed before any -s or -f option are bound to the last statement
+        - a '-- @output path' or '-- @unheadedOutput path' line in a -f file is bound to the following
+          statement in the file
+        When no output is specified at all, the last statement is bound to the standard output (path None)
 
-        In case, there are no statements it displays an error and stops execution.
-
-        Note: this method doesn't check for sintactically nor semantically valid SQL statements.
+        In case an output can't be bound to any statement, or it already exists without --force, it
+        displays an error and stops execution.
     """
     statements = []
-    for option_string, value in pairs:
+    destinations = {}
+    last_statement_per_source = []
+    for option_string, value in args.statements:
         assert option_string in [ '-s', '-f' ]
-        raw_statement = value if option_string == '-s' else pathlib.Path(value).read_text()
-        statements.extend(split_statements(raw_statement))
-    return statements
+        if option_string == '-s':
+            statements.extend(split_statements(value))
+        else:
+            for statement, directives in split_annotated_statements(pathlib.Path(value).read_text()):
+                statements.append(statement)
+                if directives:
+                    if args.format != 'sqlite':
+                        check_outputs([ path for _, path in directives ], args.force)
+                    destinations[len(statements) - 1] = directives
+        last_statement_per_source.append(len(statements) - 1)
+    if not statements:
+        print_error_and_exit("Nothing to do")
+    for option_string, path, anchor in args.outputs:
+        index = last_statement_per_source[anchor - 1] if anchor > 0 else len(statements) - 1
+        if index < 0:
+            print_error_and_exit("No statement found for output %s"%path)
+        destinations.setdefault(index, []).append((option_string, path))
+    if not destinations:
+        destinations[len(statements) - 1] = [ ('-o', None) ]
+    if args.format == 'sqlite':
+        check_sqlite_outputs(statements, destinations)
+    return statements, destinations
+
+
+def check_sqlite_outputs(statements, destinations):
+    """ checks the destinations can be written on --format sqlite: they must be headed outputs to a
+        file, bound to select statements. Otherwise, it displays an error and stops execution """
+    for index, statement_destinations in destinations.items():
+        for option_string, path in statement_destinations:
+            if path is None:
+                print_error_and_exit("Option --format sqlite requires an output database (-o)")
+            if option_string != '-o':
+                print_error_and_exit("Option --format sqlite doesn't support unheaded output %s"%path)
+            if not is_read_only(statements[index]):
+                print_error_and_exit("Output %s is bound to a non SELECT statement"%path)
+            try:
+                parse_sqlite_output(path)
+            except ValueError as err:
+                print_error_and_exit("Output %s: %s (use database#table)"%(path, err))
+
+
+def check_outputs(paths, force):
+    """ checks the output paths can be written. In case any of them is an already existing file and
+        force is not set, it displays an error and stops execution """
+    for path in paths:
+        if path.is_file() and not force:
+            print_error_and_exit("File %s already exists. Remove it or use --force option"%path)
+
+
+def split_annotated_statements(contents):
+    """ given a string containing zero or more SQL statements, it returns a list of pairs (statement,
+        directives) where directives is the list of (option_string, path) found in output directive
+        lines ('-- @output path' or '-- @unheadedOutput path') just before the statement.
+
+        Statements are splitted as in split_statements(). Directives not followed by any statement
+        display an error and stop execution.
+    """
+    annotated = []
+    pending = []
+    chunk = []
+    for line in contents.split(os.linesep) + [ '' ]:
+        match = _OUTPUT_DIRECTIVE.match(line)
+        if match is None:
+            chunk.append(line)
+            continue
+        for statement in split_statements(os.linesep.join(chunk)):
+            annotated.append((statement, pending))
+            pending = []
+        chunk = []
+        option_string = '-o' if match.group(1) == 'output' else '-O'
+        pending.append((option_string, pathlib.Path(match.group(2).strip())))
+    for statement in split_statements(os.linesep.join(chunk)):
+        annotated.append((statement, pending))
+        pending = []
+    if pending:
+        print_error_and_exit("No statement found for output %s"%pending[0][1])
+    return annotated
 
 
 def split_statements(contents):
@@ -246,48 +1080,361 @@ def split_statements(contents):
 def get_db(args):
     """  given the arguments namespace, it returns the corresponding db connection.
          In case db_spec doesn't correspond to a valid sqlite3 database, it issues an error and stops execution
-         In case db_spec == None, the connection is on memory """
+         In case db_spec == None, the connection is on memory, unless args.memory_limit is set and the inputs
+         are estimated to require more memory. Then, a temporary database on disk is used instead """
     if args.database:
         db_name = str(args.database)
-        db = sqlite3.connect(db_name)
         try:
-            result = csvsql.execute_statement(db, 'pragma integrity_check;')
+            args.checked = check_db(args.database, args.check)
         except sqlite3.DatabaseError as err:
             print_error_and_exit("Problems found with %s: %s"%(db_name, err))
+        db = sqlite3.connect(db_name)
+    elif args.memory_limit and get_estimated_size(args) > args.memory_limit:
+        db = get_spill_db(args.memory_limit)
     else:
         db_name = ':memory:'
         db = sqlite3.connect(db_name)
+    if args.load_from:
+        source = sqlite3.connect(args.load_from.resolve().as_uri() + '?mode=ro', uri=True)
+        try:
+            copy_db(source, db, args.progress)
+        except sqlite3.DatabaseError as err:
+            print_error_and_exit("Problems found with %s: %s"%(args.load_from, err))
+        finally:
+            source.close()
+    return db
+
+
+def check_db(path, level='auto'):
+    """ checks the sqlite3 database file at path is sound, and returns the level of the check performed.
+        In case it isn't, it raises sqlite3.DatabaseError.
+
+        level: one of _CHECK_LEVELS, from the cheapest to the most thorough:
+               - 'none' doesn't check anything
+               - 'header' checks the header of the file and the schema can be read
+               - 'quick' performs a pragma quick_check
+               - 'full' performs a pragma integrity_check
+               'auto' chooses the level from the size of the file as in _AUTO_CHECK_LEVELS
+
+        Missing and empty files are considered sound, since sqlite3 creates a new database on them.
+        Once a check passes, it is not performed again while the file doesn't change (see
+        remember_db_check())
+    """
+    size = path.stat().st_size if path.is_file() else 0
+    if level == 'auto':
+        level = next(level for limit, level in _AUTO_CHECK_LEVELS if limit is None or size < limit)
+    if level == 'none' or size == 0:
+        return level
+    signature = get_db_signature(path)
+    cached = csvsql.load_cache(_CHECK_CACHE).get(str(path.resolve()))
+    if cached and cached[0] == signature and _CHECK_LEVELS.index(cached[1]) >= _CHECK_LEVELS.index(level):
+        return level
+    with path.open('rb') as fb:
+        if fb.read(len(_SQLITE_MAGIC)) != _SQLITE_MAGIC:
+            raise sqlite3.DatabaseError("file is not a database")
+    db = sqlite3.connect(path.resolve().as_uri() + '?mode=ro', uri=True)
+    try:
+        db.execute('select count(*) from sqlite_master').fetchall()
+        if level != 'header':
+            pragma = 'quick_check' if level == 'quick' else 'integrity_check'
+            problems = [ row[0] for row in db.execute('pragma %s'%pragma) if row[0] != 'ok' ]
+            if problems:
+                raise sqlite3.DatabaseError('; '.join(problems))
+    finally:
+        db.close()
+    remember_db_check(path, level)
+    return level
+
+
+def remember_db_check(path, level):
+    """ registers that the sqlite3 database file at path, as it is now, has passed the check of level """
+    if level == 'none' or not path.is_file():
+        return
+    cache = csvsql.load_cache(_CHECK_CACHE)
+    cache[str(path.resolve())] = [ get_db_signature(path), level ]
+    csvsql.save_cache(_CHECK_CACHE, cache)
+
+
+def get_db_signature(path):
+    """ returns a list identifying the current contents of the sqlite3 database file at path: its change
+        counter, its size and modification time, and the size and modification time of its write ahead
+        log (if any) """
+    with path.open('rb') as fb:
+        header = fb.read(_CHANGE_COUNTER_OFFSET + 4)
+    stat = path.stat()
+    signature = [ int.from_bytes(header[_CHANGE_COUNTER_OFFSET:], 'big'), stat.st_size, stat.st_mtime_ns ]
+    wal = path.with_name(path.name + '-wal')
+    if wal.is_file():
+        wal_stat = wal.stat()
+        signature += [ wal_stat.st_size, wal_stat.st_mtime_ns ]
+    return signature
+
+
+def get_estimated_size(args):
+    """ returns the estimated bytes required to keep in a database the data of args.load_from,
+        args.input and args.tables """
+    size = args.load_from.stat().st_size if args.load_from else 0
+    paths = [ path for _, path in args.input ] + [ path for _, paths, _ in args.tables for path in paths ]
+    return size + sum(csvsql.estimate_import_size(path) for path in paths)
+
+
+def copy_db(source, target, progress=False):
+    """ copies the contents of the main database of source into target, replacing its previous contents.
+
+        source: a connection
+        target: a connection or the path of a sqlite3 database file
+        progress: when True, the number of pages copied is reported on the standard error output as the
+                  copy goes on
+    """
+    def report(status, remaining, total):
+        print("\rCopied %d of %d pages"%(total - remaining, total), end='' if remaining else '\n',
+              file=sys.stderr, flush=True)
+
+    connection = sqlite3.connect(str(target)) if isinstance(target, pathlib.Path) else target
+    try:
+        source.backup(connection, pages=_BACKUP_STEP_PAGES, progress=report if progress else None)
+    finally:
+        if connection is not target:
+            connection.close()
+
+
+def get_spill_db(memory_limit):
+    """ returns a connection to a temporary database on disk, removed once closed, tuned to be used as
+        a replacement of an in memory database using at most memory_limit bytes of cache """
+    db = sqlite3.connect('')
+    db.execute('pragma journal_mode=off')
+    db.execute('pragma synchronous=off')
+    db.execute('pragma temp_store=file')
+    db.execute('pragma cache_size=%d'%-max(memory_limit // 1024, 1))
     return db
 
 
-def load_input(db, files=None):
+def get_db_size(db):
+    """ returns the bytes used by the main database of db """
+    page_count = db.execute('pragma page_count').fetchone()[0]
+    page_size = db.execute('pragma page_size').fetchone()[0]
+    return page_count * page_size
+
+
+def load_input(db, files=None, incremental=False, memory_limit=None, stats=False, reader='csv', cleaner=None,
+               keys=None, duplicates='error', sniff=False, delimiter=None, encoding=None, dictionary=False):
     """ given an open connection to a database and a list of input files (pairs
     option_string, pathlib.Path), it loads the data contained in the files onto
-    the database """
-    if files:
-        csvsql.import_csv_list(db, files)
+    the database. When incremental, the rows already imported on a previous
+    execution are not imported again. When stats, the statistics of the files
+    are recorded. The files are read with the reader 'csv' or 'mmap', as in
+    csvsql.import_csv_list(), filtering their rows with cleaner when not None. The tables in keys
+    get the primary key there defined, with duplicated keys handled by duplicates.
+    The format of the files is detected when sniff, and delimiter and encoding
+    override it, as in csvsql.import_csv_list(). When dictionary, the columns
+    with few distinct values are dictionary encoded.
+    When memory_limit is set and an in memory db grows beyond it, checked while each file is imported,
+    its contents are moved to a temporary database on disk, where the file being imported is imported
+    again.
+    It returns the connection to the database containing the data """
+    def check_size(db):
+        if get_db_size(db) > memory_limit:
+            raise _MemoryLimitExceeded()
+
+    for pair in files or []:
+        while True:
+            counts = (cleaner.duplicates, cleaner.incomplete) if cleaner is not None else None
+            try:
+                csvsql.import_csv_list(db, [ pair ], incremental=incremental, stats=stats, reader=reader,
+                                       cleaner=cleaner, keys=keys, duplicates=duplicates, sniff=sniff,
+                                       delimiter=delimiter, encoding=encoding, dictionary=dictionary,
+                                       monitor=check_size if memory_limit and is_memory_db(db) else None)
+            except _MemoryLimitExceeded:
+                db.rollback()
+                if cleaner is not None:
+                    cleaner.duplicates, cleaner.incomplete = counts
+                db = move_to_spill_db(db, memory_limit)
+                continue
+            except (csv.Error, ValueError, sqlite3.IntegrityError) as err:
+                print_error_and_exit("Problems loading %s: %s"%(pair[1], err))
+            break
+        if memory_limit and is_memory_db(db) and get_db_size(db) > memory_limit:
+            db = move_to_spill_db(db, memory_limit)
     return db
 
 
-def write_output(results, args, dialect=csv.excel):
-    """ Writes results to output file.
+class _MemoryLimitExceeded(Exception):
+    """ Raised when an in memory database grows beyond the memory limit while importing a file """
+
+
+def move_to_spill_db(db, memory_limit):
+    """ copies the contents of the in memory db to a database from get_spill_db(memory_limit), closes
+        db and returns the connection to the new database """
+    spill_db = get_spill_db(memory_limit)
+    db.backup(spill_db)
+    db.close()
+    return spill_db
+
+
+def load_shards(db, tables, source_column=None, workers=None, incremental=False, stats=False, sniff=False,
+                delimiter=None, encoding=None):
+    """ given an open connection to a database and a list of pairs (table_name, paths), it loads the
+    data contained in the paths of each pair into the table table_name, as csvsql.import_csv_shards().
+    All the paths of a table are read with the format of the first one, as csvsql.get_csv_format() gets it
+    with sniff, delimiter and encoding """
+    for table_name, paths in tables:
+        try:
+            import_shards(db, table_name, paths, source_column, workers, incremental, stats, sniff, delimiter,
+                          encoding)
+        except ValueError as err:
+            print_error_and_exit("Problems loading table %s: %s"%(table_name, err))
+
+
+def import_shards(db, table_name, paths, source_column=None, workers=None, incremental=False, stats=False,
+                  sniff=False, delimiter=None, encoding=None):
+    """ loads the data contained in paths into the table table_name as load_shards() does, but raising
+        ValueError on problems """
+    if not paths:
+        raise ValueError("no files to load into %s"%table_name)
+    dialect, shard_encoding, _ = csvsql.get_csv_format(paths[0], sniff, delimiter, encoding)
+    csvsql.import_csv_shards(db, table_name, paths, dialect=dialect, source_column=source_column,
+                             workers=workers, incremental=incremental, stats=stats, encoding=shard_encoding)
+
+
+def parse_table(value):
+    """ given a str with the form name=glob, it returns the tuple (name, list of paths matching glob, glob).
+        It is intended to be used as an argparse type """
+    name, separator, pattern = value.partition('=')
+    if not separator or not _IDENTIFIER.match(name):
+        raise argparse.ArgumentTypeError("invalid table: %s (expected name=glob)"%value)
+    paths = [ pathlib.Path(path) for path in sorted(glob.glob(pattern)) ]
+    if not paths:
+        raise argparse.ArgumentTypeError("no files match %s"%pattern)
+    return name, paths, pattern
+
+
+def parse_key(value):
+    """ given a str with the form table:column[,column...], it returns the pair (table, list of columns).
+        It is intended to be used as an argparse type """
+    name, separator, columns = value.partition(':')
+    if not separator or not _IDENTIFIER.match(name) or \
+            not all(_IDENTIFIER.match(column) for column in columns.split(',')):
+        raise argparse.ArgumentTypeError("invalid key: %s (expected table:column[,column])"%value)
+    return name, columns.split(',')
+
+
+def parse_delimiter(value):
+    """ given a str with a single character, or 'tab' or '\\t' for a tab, it returns the character. It is
+        intended to be used as an argparse type """
+    value = '\t' if value in ('tab', '\\t') else value
+    if len(value) != 1 or value in '"\r\n':
+        raise argparse.ArgumentTypeError("invalid delimiter: %r (expected a single character)"%value)
+    return value
+
+
+def parse_encoding(value):
+    """ given a str with the name of an encoding, it returns its canonical name. It is intended to be used
+        as an argparse type """
+    try:
+        return codecs.lookup(value).name
+    except LookupError:
+        raise argparse.ArgumentTypeError("unknown encoding: %s"%value)
+
+
+def is_memory_db(db):
+    """ returns True when the main database of db is kept in memory """
+    return db.execute('pragma journal_mode').fetchone()[0] == 'memory'
+
+
+def parse_size(value):
+    """ given a str containing a number of bytes, optionally followed by a K, M or G multiplier, it
+        returns the corresponding number of bytes. It is intended to be used as an argparse type """
+    match = re.match(r'^\s*(\d+)\s*([KMG]?)B?\s*$', value, re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError("invalid size: %s"%value)
+    return int(match.group(1)) * 1024 ** ' KMG'.index(match.group(2).upper() or ' ')
+
 
-        results: is a list of csv rows
-        args is the parsed arguments potentially containing output and unheadedOutput (even both!)
+def write_output(results, destinations, dialect=None, output_format='csv'):
+    """ Writes results to the output destinations.
 
-        In case output and unheadedOutput are both None, it writes to the standard output
-        In case output is specified, it writes in the results
-        In case unheadedOutput is specified, it writes the results except for the first row (the headers)
+        results: is an iterable of csv rows, being the first one the headers
+        destinations: a list of pairs (option_string, path). option_string is -o for headed outputs
+                      and -O for unheaded ones (the results except for the first row). A None path
+                      stands for the standard output.
+        output_format: 'csv' writes the rows with dialect (by default csv.excel), 'tsv' with
+                       csv.excel_tab and 'jsonl' as a JSON value per line: an object with the headers
+                       as keys on headed outputs and an array on unheaded ones. For 'sqlite', see
+                       write_tables()
+
+        The results are iterated just once, so all the destinations are written at the same time.
+        The rows are fetched in chunks by the calling thread while a writer thread formats and
+        writes the previous ones. At most _OUTPUT_QUEUE_CHUNKS chunks wait to be written, so a slow
+        destination (e.g. a pipe) slows down the fetching instead of filling the memory.
     """
-    if not(args.output or args.unheadedOutput):
-        csv.writer(sys.stdout, dialect=dialect).writerows(results)
-        return
-    if args.output:
-        with args.output.open('w') as fs:
-            csv.writer(fs, dialect=dialect).writerows(results)
-    if args.unheadedOutput:
-        with args.unheadedOutput.open('w') as fs:
-            csv.writer(fs, dialect=dialect).writerows(results[1:])
+    dialect = csv.excel_tab if output_format == 'tsv' else dialect or csv.excel
+    with contextlib.ExitStack() as stack:
+        outputs = []
+        for option_string, path in destinations:
+            fs = sys.stdout if path is None else stack.enter_context(path.open('w', buffering=_OUTPUT_BUFFER_SIZE))
+            outputs.append((option_string == '-o', fs))
+        rows = iter(results)
+        headers = next(rows, None)
+        if headers is None:
+            return
+        writers = []
+        for headed, fs in outputs:
+            if output_format == 'jsonl':
+                writers.append(_JsonLinesWriter(fs, headers if headed else None))
+                continue
+            writers.append(csv.writer(fs, dialect=dialect))
+            if headed:
+                writers[-1].writerow(headers)
+        chunks = queue.Queue(_OUTPUT_QUEUE_CHUNKS)
+        errors = []
+        thread = threading.Thread(target=_write_chunks, args=(chunks, writers, errors), daemon=True)
+        thread.start()
+        try:
+            for chunk in iter(lambda: list(itertools.islice(rows, _OUTPUT_CHUNK_ROWS)), []):
+                if not _put_chunk(chunks, chunk, thread):
+                    break
+        finally:
+            _put_chunk(chunks, None, thread)
+            thread.join()
+        if errors:
+            raise errors[0]
+
+
+def _write_chunks(chunks, writers, errors):
+    """ writes the chunks of rows got from the queue chunks with the writers until getting None.
+        When writing fails, the exception is appended to errors and the thread ends """
+    try:
+        for chunk in iter(chunks.get, None):
+            for writer in writers:
+                writer.writerows(chunk)
+    except Exception as err:
+        errors.append(err)
+
+
+class _JsonLinesWriter:
+    """ Writer of rows as JSON lines: objects with the headers as keys or, without headers, arrays.
+        Values not supported by JSON (blobs) are written as their str() """
+
+    def __init__(self, fs, headers=None):
+        self._fs = fs
+        self._headers = headers
+
+    def writerows(self, rows):
+        if self._headers is not None:
+            rows = (dict(zip(self._headers, row)) for row in rows)
+        self._fs.write(''.join(json.dumps(row, ensure_ascii=False, default=str) + '\n' for row in rows))
+
+
+def _put_chunk(chunks, chunk, thread):
+    """ puts the chunk into the queue chunks, waiting for room while thread is alive.
+        It returns False when thread ended without getting it """
+    while thread.is_alive():
+        try:
+            chunks.put(chunk, timeout=_OUTPUT_QUEUE_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
 
 
 def print_error_and_exit(msg):
@@ -303,7 +1450,12 @@ def print_error_run_function_and_exit(msg, function):
     sys.exit(1)
 
 
-if __name__ == '__main__':
+def main():
+    """ entry point of the csvsqlcli command """
     csvsql_process_cml_args(sys.argv)
 
 
+if __name__ == '__main__':
+    main()
+
+
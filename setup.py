@@ -13,8 +13,23 @@ setuptools.setup(
         long_description_content_type = "text/markdown",
         url = "https://github.com/moiatgit/csvsql",
         packages = setuptools.find_packages(),
+        python_requires = ">=3.8",
+        extras_require = {
+            "numpy": [ "numpy" ],
+            },
+        entry_points = {
+            "console_scripts": [
+                "csvsqlcli = csvsql.csvsqlcli:main",
+                "csvsqlbatch = csvsql.csvsqlbatch:main",
+                ],
+            },
         classifiers = (
-            "Programming Language :: Python :: 3.5",
+            "Programming Language :: Python :: 3",
+            "Programming Language :: Python :: 3 :: Only",
+            "Programming Language :: Python :: 3.8",
+            "Programming Language :: Python :: 3.9",
+            "Programming Language :: Python :: 3.10",
+            "Programming Language :: Python :: 3.11",
             "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
             "Operating System :: POSIX :: Linux",
             "Natural Language :: English",
@@ -3,6 +3,9 @@ import io
 import sqlite3
 import csv
 import pathlib
+import itertools
+import threading
+import array
 import csvsql
 
 
@@ -39,7 +42,7 @@ def test_import_csv_list(monkeypatch):
             'f2.csv': 'one,two,three\na,b,c\nd,e,f',
             'f3.csv': 'un,dos,tres\na,2,3\nb,2,3'
             }
-    monkeypatch.setattr(pathlib.Path, 'open', lambda self_: io.StringIO(files[self_.name]))
+    monkeypatch.setattr(pathlib.Path, 'open', lambda self_, **kwargs: io.StringIO(files[self_.name]))
     db = sqlite3.connect(':memory:')
     dialect = csv.excel
     csvsql.import_csv_list(db, [ ('-i', pathlib.Path(f)) for f in files.keys() ])
@@ -47,6 +50,139 @@ def test_import_csv_list(monkeypatch):
         assert_table_contains_csv_contents(db, filename[:-4], files[filename])
 
 
+def test_sniff_csv_and_import_csv_list(tmpdir, monkeypatch):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    (folder / 'towns.csv').write_bytes('town;area\nGirona;"39,1"\nLleida;212,3\n'.encode('cp1252'))
+    (folder / 'visits.csv').write_bytes(b'1\t2026-10-01\n2\t2026-10-02\n')
+    (folder / 'names.csv').write_bytes('\ufeffid|name\n1|\u00c0nna\n'.encode('utf-8'))
+    assert csvsql.sniff_csv(folder / 'towns.csv') == { 'encoding': 'utf-8', 'delimiter': ';', 'quotechar': '"',
+                                                       'skipinitialspace': False, 'header': True }
+    (folder / 'towns.csv').write_bytes('town;area\nGirona;"39,1"\nL\u00e9rida;212,3\n'.encode('cp1252'))
+    assert csvsql.sniff_csv(folder / 'towns.csv')['encoding'] == 'cp1252'
+    assert csvsql.sniff_csv(folder / 'visits.csv')['header'] is False
+    assert csvsql.sniff_csv(folder / 'names.csv')['encoding'] == 'utf-8-sig'
+    (folder / 'late.csv').write_bytes('id,town\n'.encode() + b'1,Girona\n' * 10000 + 'L\u00e9rida,2\n'.encode('latin-1'))
+    assert csvsql.sniff_csv(folder / 'late.csv')['encoding'] == 'cp1252'
+    (folder / 'late.csv').write_bytes('id,town\n'.encode() + b'1,Girona\n' * 10000 + 'L\u00e9rida,2\n'.encode('utf-8'))
+    assert csvsql.sniff_csv(folder / 'late.csv')['encoding'] == 'utf-8'
+    monkeypatch.setattr(csvsql, '_sniff_sample', None)
+    assert csvsql.sniff_csv(folder / 'names.csv')['delimiter'] == '|'
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv_list(db, [ ('-i', folder / name) for name in ('towns.csv', 'visits.csv', 'names.csv') ],
+                           sniff=True)
+    assert csvsql.execute_statement(db, 'select * from towns') == [ ('town', 'area'), ('Girona', '39,1'),
+                                                                    ('L\u00e9rida', '212,3') ]
+    assert csvsql.execute_statement(db, 'select * from visits') == [ ('__COL1', '__COL2'), ('1', '2026-10-01'),
+                                                                     ('2', '2026-10-02') ]
+    assert csvsql.execute_statement(db, 'select * from names') == [ ('id', 'name'), ('1', '\u00c0nna') ]
+    csvsql.import_csv_list(db, [ ('-i', folder / 'towns.csv') ], delimiter=';', encoding='latin-1')
+    assert db.execute('select area from towns').fetchall() == [ ('39,1',), ('212,3',) ]
+
+
+def test_append_csv_adding_columns():
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv(db, io.StringIO('un,dos\n1,2\n'), 'my_table')
+    csvsql.append_csv(db, io.StringIO('3,4,5\n6\n'), 'my_table')
+    results = csvsql.execute_statement(db, 'select * from my_table')
+    assert results == [ ('un', 'dos', '__COL3'), ('1', '2', None), ('3', '4', '5'), ('6', '', '') ]
+
+
+def test_import_csv_incrementally_reads_just_appended_rows(tmpdir, monkeypatch):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'my_log.csv'
+    path.write_text('un,dos\n1,2\n')
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv_incrementally(db, path, 'my_log')
+    db.execute("update my_log set dos = 'modified'")
+    with path.open('a') as fo:
+        fo.write('3,4\n')
+    csvsql.import_csv_incrementally(db, path, 'my_log')
+    assert_table_contains_csv_contents(db, 'my_log', 'un,dos\n1,modified\n3,4')
+    csvsql.import_csv_incrementally(db, path, 'my_log')
+    assert_table_contains_csv_contents(db, 'my_log', 'un,dos\n1,modified\n3,4')
+
+
+def test_import_csv_incrementally_when_prefix_changes(tmpdir):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'my_log.csv'
+    path.write_text('un,dos\n1,2\n')
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv_incrementally(db, path, 'my_log')
+    db.execute("update my_log set dos = 'modified'")
+    path.write_text('un,dos\n5,6\n7,8\n')
+    csvsql.import_csv_incrementally(db, path, 'my_log')
+    assert_table_contains_csv_contents(db, 'my_log', 'un,dos\n5,6\n7,8')
+
+
+def test_import_csv_incrementally_when_head_of_long_file_changes(tmpdir):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'my_log.csv'
+    rows = ''.join('%d,ok\n' % i for i in range(20000))
+    path.write_text('id,status\n' + rows)
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv_incrementally(db, path, 'my_log')
+    path.write_text('id,status\n0,NO\n' + rows[len('0,ok\n'):] + '20000,ok\n')
+    csvsql.import_csv_incrementally(db, path, 'my_log')
+    assert db.execute("select id from my_log where status = 'NO'").fetchall() == [('0',)]
+    assert db.execute('select count(*) from my_log').fetchone() == (20001,)
+
+
+def test_import_csv_incrementally_appends_to_dictionary_encoded_table(tmpdir, monkeypatch):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'enrolments.csv'
+    rows = [ '%d,%s' % (number, ('course-a', 'course-b')[number % 2]) for number in range(8) ]
+    path.write_text('id,course\n' + '\n'.join(rows) + '\n')
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv_incrementally(db, path, 'enrolments', dictionary=True)
+    with path.open('a') as fo:
+        fo.write('8,course-c\n9,course-a\n')
+    monkeypatch.setattr(csvsql, 'import_csv', None)
+    csvsql.import_csv_incrementally(db, path, 'enrolments', dictionary=True)
+    assert csvsql.execute_statement(db, 'select * from enrolments') == \
+           [ ('id', 'course'), *( tuple(row.split(',')) for row in rows ), ('8', 'course-c'), ('9', 'course-a') ]
+    assert db.execute('select * from enrolments__values_2').fetchall() == [ (1, 'course-a'), (2, 'course-b'),
+                                                                             (3, 'course-c') ]
+    assert db.execute('select course from enrolments__encoded where id = ?', ('9',)).fetchall() == [ (1,) ]
+
+
+def test_import_csv_incrementally_appends_to_wide_table(tmpdir, monkeypatch):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'wide.csv'
+    path.write_text('a,b,c,d,e,f,g\n1,2,3,4,5,6,7\n')
+    db = sqlite3.connect(':memory:')
+    db.setlimit(sqlite3.SQLITE_LIMIT_COLUMN, 6)
+    csvsql.import_csv_incrementally(db, path, 'wide')
+    with path.open('a') as fo:
+        fo.write('8,9,10,11,12,13,14\n')
+    monkeypatch.setattr(csvsql, 'import_csv', None)
+    csvsql.import_csv_incrementally(db, path, 'wide')
+    assert db.execute('select __row, a, g from wide__1 join wide__2 using (__row)').fetchall() == [ (1, '1', '7'),
+                                                                                                 (2, '8', '14') ]
+
+
+def test_export_table_replaces_file(tmpdir):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'my_table.csv'
+    path.write_text('old contents')
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv(db, io.StringIO('un,dos\n1,2\n'), 'my_table')
+    csvsql.export_table(db, 'my_table', path)
+    assert path.read_text() == 'un,dos\n1,2\n'
+    csvsql.export_table(db, 'my_table', path, header=False)
+    assert path.read_text() == '1,2\n'
+    assert [ p.name for p in path.parent.iterdir() ] == [ 'my_table.csv' ]
+
+
+def test_change_tracker_reports_actual_changes():
+    db = sqlite3.connect(':memory:')
+    for table_name in ('updated', 'untouched', 'dropped', 'renamed'):
+        csvsql.import_csv(db, io.StringIO('un,dos\n1,2\n'), table_name)
+    tracker = csvsql.ChangeTracker(db)
+    csvsql.execute_statements(db, [ 'update updated set dos = 3',
+                                    'update untouched set dos = 3 where un = 5',
+                                    'drop table dropped',
+                                    'alter table renamed rename to moved',
+                                    'create table created (un)' ])
+    changed, removed = tracker.close()
+    assert changed == { 'updated', 'moved', 'created' }
+    assert removed == { 'dropped', 'renamed' }
+    assert db.execute("select count(*) from sqlite_temp_master").fetchone() == (0,)
+
+
 def test_execute_statement_basic():
     db = sqlite3.connect(':memory:')
     db.execute('create table my_table (un, dos)')
@@ -57,6 +193,16 @@ def test_execute_statement_basic():
     assert results == [ ('un', 'dos'), (1, 2), (3, 4) ]
 
 
+def test_iterate_statement_basic():
+    db = sqlite3.connect(':memory:')
+    db.execute('create table my_table (un, dos)')
+    db.execute('insert into my_table values (1, 2)')
+    results = csvsql.iterate_statement(db, 'select * from my_table')
+    assert next(results) == ('un', 'dos')
+    assert list(results) == [ (1, 2) ]
+    assert list(csvsql.iterate_statement(db, 'delete from my_table')) == []
+
+
 def test_execute_statements_basic():
     db = sqlite3.connect(':memory:')
     statements = [
@@ -70,6 +216,453 @@ def test_execute_statements_basic():
 
 
 
+def test_csv_database_imports_tables_lazily(tmpdir):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    (folder / 'students.csv').write_text('id,name\n1,Anna\n')
+    (folder / 'scores.csv').write_text('student_id,score\n1,5\n')
+    with csvsql.CsvDatabase() as db:
+        assert db.add_csv(folder / 'students.csv') == 'students'
+        db.add_csv(folder / 'scores.csv', table_name='Marks')
+        assert db.query('select name from Students') == [ ('name',), ('Anna',) ]
+        assert csvsql.get_table_names(db.connection) == [ 'students' ]
+        results = db.iterate('select name, score from students, marks where id = student_id')
+        assert next(results) == ('name', 'score')
+        assert list(results) == [ ('Anna', '5') ]
+
+
+def test_csv_database_imports_again_changed_files(tmpdir):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'students.csv'
+    path.write_text('id,name\n1,Anna\n')
+    with csvsql.CsvDatabase(pathlib.Path(str(tmpdir.realpath())) / 'db.sqlite3') as db:
+        db.add_csv(path)
+        db.execute("update students set name = 'Bernat'")
+        assert db.query('select name from students') == [ ('name',), ('Bernat',) ]
+        path.write_text('id,name\n1,Anna\n2,Carla\n')
+        assert db.query('select name from students') == [ ('name',), ('Anna',), ('Carla',) ]
+
+
+def test_import_csv_shards_reconciling_headers(tmpdir):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    (folder / 'scores_01.csv').write_text('id,score\n1,5\n2,6\n')
+    (folder / 'scores_02.csv').write_text('id,comment,score\n3,late,7\n4,,8,extra\n')
+    db = sqlite3.connect(':memory:')
+    paths = [ folder / 'scores_01.csv', folder / 'scores_02.csv' ]
+    csvsql.import_csv_shards(db, 'scores', paths, source_column='shard', workers=2)
+    results = csvsql.execute_statement(db, 'select * from scores')
+    assert results == [ ('id', 'score', 'comment', 'shard', '__COL4'),
+                        ('1', '5', '', 'scores_01.csv', None),
+                        ('2', '6', '', 'scores_01.csv', None),
+                        ('3', '7', 'late', 'scores_02.csv', None),
+                        ('4', '8', '', 'scores_02.csv', 'extra') ]
+
+
+def test_import_csv_shards_incrementally_skips_unchanged_shards(tmpdir, monkeypatch):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    for day in ('01', '02', '03'):
+        (folder / ('scores_%s.csv' % day)).write_text('id,score\n%s,5\n' % day)
+    db = sqlite3.connect(':memory:')
+    paths = sorted(folder.glob('scores_*.csv'))
+    csvsql.import_csv_shards(db, 'scores', paths, source_column='shard', workers=1, incremental=True)
+    (folder / 'scores_02.csv').write_text('id,score\n02,6\n02,7\n')
+    (folder / 'scores_03.csv').unlink()
+    (folder / 'scores_04.csv').write_text('id,score\n04,8\n')
+    read = []
+    read_shard = csvsql._read_shard
+    monkeypatch.setattr(csvsql, '_read_shard',
+                        lambda path, dialect, encoding=None: read.append(path.name) or read_shard(path, dialect, encoding))
+    paths = sorted(folder.glob('scores_*.csv'))
+    csvsql.import_csv_shards(db, 'scores', paths, source_column='shard', workers=1, incremental=True)
+    assert read == [ 'scores_02.csv', 'scores_04.csv' ]
+    results = csvsql.execute_statement(db, 'select id, score from scores order by id, score')
+    assert results == [ ('id', 'score'), ('01', '5'), ('02', '6'), ('02', '7'), ('04', '8') ]
+
+
+def test_import_csv_shards_reads_shards_as_imported(tmpdir, monkeypatch):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    for day in ('01', '02', '03'):
+        (folder / ('scores_%s.csv' % day)).write_text('id,score\n%s,5\n%s,6\n' % (day, day))
+    db = sqlite3.connect(':memory:')
+    imported = []
+    read_shard = csvsql._read_shard
+    monkeypatch.setattr(csvsql, '_read_shard', lambda path, dialect, encoding=None: imported.append(
+        db.execute('select count(*) from scores').fetchone()[0]) or read_shard(path, dialect, encoding))
+    csvsql.import_csv_shards(db, 'scores', sorted(folder.glob('scores_*.csv')), workers=1)
+    assert imported == [ 0, 0, 2 ]
+
+
+def test_import_csv_with_stats():
+    contents = 'un,dos\n1,b\n3,\n2,a,extra\n'
+    stats = {}
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv(db, io.StringIO(contents), 'my_table', stats=stats)
+    assert stats == { 'rows': 3,
+                      'columns': [ 'un', 'dos', '__COL3' ],
+                      'min': [ '1', '', 'extra' ],
+                      'max': [ '3', 'b', 'extra' ],
+                      'empty': [ 0, 1, 0 ],
+                      'nulls': [ 0, 0, 2 ] }
+
+
+def test_get_range_predicates():
+    statement = "select * from scores where day >= '2026-10-01' and score > 5 and s.day between 'a' and 'b''c' order by day"
+    assert csvsql.get_range_predicates(statement, 'scores') == [ ('day', '>=', '2026-10-01'),
+                                                                 ('day', '>=', 'a'), ('day', '<=', "b'c") ]
+    assert csvsql.get_range_predicates("select count(*) from scores", 'scores') == []
+    assert csvsql.get_range_predicates("select * from scores where day = 'a' or day = 'b'", 'scores') is None
+    assert csvsql.get_range_predicates("select * from scores, days where day = 'a'", 'scores') is None
+    assert csvsql.get_range_predicates("select * from other where day = 'a'", 'scores') is None
+    for where in ("day = 'a' collate nocase", "day = 'a' || suffix", "day = 'a' and score is null",
+                  "day <> 'a'", "day in ('a')", "day = 'a' and (score > '5')"):
+        assert csvsql.get_range_predicates("select * from scores where " + where, 'scores') is None
+
+
+def test_prune_shards(tmpdir):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    for day in ('01', '02', '03'):
+        (folder / ('scores_%s.csv' % day)).write_text('day,score\n2026-10-%s,5\n' % day)
+    (folder / 'scores_04.csv').write_text('day,score\n2026-10-04,5\n')
+    paths = sorted(folder.glob('scores_*.csv'))
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv_shards(db, 'scores', paths[:3], stats=True)
+    statements = [ "select * from scores where day >= '2026-10-02' and day < '2026-10-03'" ]
+    assert [ path.name for path in csvsql.prune_shards(paths, statements, 'scores') ] == [ 'scores_02.csv', 'scores_04.csv' ]
+    statements.append("select count(*) from scores")
+    assert csvsql.prune_shards(paths, statements, 'scores') == paths
+
+
+def test_csv_database_answers_from_stats(tmpdir, monkeypatch):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'scores.csv'
+    path.write_text('id,score\n1,5\n2,7\n')
+    with csvsql.CsvDatabase(stats=True) as db:
+        db.add_csv(path)
+        expected = db.query('select count(*), min(score), max(id) as last from scores')
+    assert expected == [ ('count(*)', 'min(score)', 'last'), (2, '5', '2') ]
+    monkeypatch.setattr(csvsql, 'import_csv', None)
+    with csvsql.CsvDatabase(stats=True) as db:
+        db.add_csv(path)
+        assert db.query('select count(*), min(score), max(id) as last from scores') == expected
+    assert csvsql.get_csv_stats(path, header='') is None
+    assert csvsql.get_csv_stats(path, dialect=csvsql.get_csv_dialect({ 'delimiter': ';', 'quotechar': '"',
+                                                                       'skipinitialspace': False })) is None
+
+
+def test_csv_database_answers_from_stats_of_ragged_rows(tmpdir, monkeypatch):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'ragged.csv'
+    path.write_text('un,dos\n1,b\n3\n2,a,extra\n4,c,,more\n')
+    statement = 'select count(*), min(dos), max(dos), min(__COL3), max(__COL3), min(__COL4), max(__COL4) from ragged'
+    db = sqlite3.connect(':memory:')
+    with path.open() as fi:
+        csvsql.import_csv(db, fi, 'ragged')
+    curs = db.execute(statement)
+    expected = [ tuple(item[0] for item in curs.description) ] + curs.fetchall()
+    with csvsql.CsvDatabase(stats=True) as db:
+        db.add_csv(path)
+        db.query('select count(*) from ragged')
+    monkeypatch.setattr(csvsql, 'import_csv', None)
+    with csvsql.CsvDatabase(stats=True) as db:
+        db.add_csv(path)
+        assert db.query(statement) == expected
+
+
+def test_mapped_csv(tmpdir, monkeypatch):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'quoted.csv'
+    contents = 'id,"na,me"\r\n1,"multi\nline ""q"""\n2,ab"c,x\n\n3, "sp, lit"\n4'
+    path.write_bytes(contents.encode())
+    expected = list(csv.reader(io.StringIO(contents, newline='')))
+    with csvsql.MappedCsv(path) as rows:
+        assert len(rows) == 6
+        assert list(rows) == expected
+        assert [ rows[index] for index in range(len(rows)) ] == expected
+        assert list(rows.rows(2, 4)) == expected[2:4]
+        assert rows[-1] == [ '4' ]
+    monkeypatch.setattr(csvsql.MappedCsv, '_build_index', None)
+    with csvsql.MappedCsv(path) as rows:
+        assert list(rows) == expected
+    monkeypatch.undo()
+    contents = 'a;b\n"x;\n""y""";  "z\n";w\n  "1";"2"\n3;"unclosed\n4;5\n'
+    path.write_bytes(contents.encode())
+    dialect = csvsql.get_csv_dialect({ 'delimiter': ';', 'quotechar': '"', 'skipinitialspace': True })
+    with csvsql.MappedCsv(path, dialect) as rows:
+        assert list(rows) == list(csv.reader(io.StringIO(contents, newline=''), dialect))
+        assert len(rows) == 4
+
+
+def test_import_csv_mapped(tmpdir):
+    path = pathlib.Path(str(tmpdir.realpath())) / 'my_table.csv'
+    path.write_text('un,,tres\n1,"dos, 2"\n4,5,6,7\n')
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv_list(db, [ ('-i', path) ], reader='mmap')
+    assert db.execute('select * from my_table').fetchall() == [ ('1', 'dos, 2', '', None), ('4', '5', '6', '7') ]
+
+
+def test_import_csv_wide_table():
+    db = sqlite3.connect(':memory:')
+    db.setlimit(sqlite3.SQLITE_LIMIT_COLUMN, 6)
+    csvsql.import_csv(db, io.StringIO('a,b,c,d,e,f,g\n1,2,3,4,5,6,7\n8,9\n'), 'wide')
+    assert csvsql.get_column_names(db, 'wide') == [ 'a', 'b', 'c', 'd', 'e', 'f', 'g' ]
+    assert db.execute('select * from wide').fetchall() == [ ('1', '2', '3', '4', '5', '6'),
+                                                            ('8', '9', '', '', '', '') ]
+    assert db.execute('select __row, f, g from wide__2').fetchall() == [ (1, '6', '7'), (2, '', '') ]
+    csvsql.append_csv(db, io.StringIO('1,2,3,4,5,6,7,8,9,10,11,12,13\n'), 'wide')
+    assert csvsql.get_column_names(db, 'wide')[-3:] == [ '__COL11', '__COL12', '__COL13' ]
+    assert db.execute('select * from wide__3').fetchall() == [ (3, '11', '12', '13') ]
+    assert db.execute('select a, __COL12 from wide__1 join wide__3 using (__row)').fetchall() == [ ('1', '12') ]
+    assert db.execute('select * from wide__columns_2 where __row = 3').fetchall() == [ (3, '7', '8', '9', '10', '11') ]
+    assert db.execute('select * from wide__columns_3').fetchall() == [ (1, None, None), (2, None, None),
+                                                                       (3, '12', '13') ]
+    db.execute('create table other (a)')
+    assert csvsql.get_table_names(db) == [ 'other' ]
+    db.execute('drop table other')
+    csvsql.import_csv(db, io.StringIO('a\n1\n'), 'wide')
+    assert [ row[0] for row in db.execute('select type || name from sqlite_master') ] == [ 'tablewide' ]
+
+
+_RUNAWAY_STATEMENT = 'with recursive c(x) as (select 1 union all select x + 1 from c) select count(*) from c'
+
+
+def test_import_csv_with_row_cleaner():
+    db = sqlite3.connect(':memory:')
+    contents = 'id,name\n1,a,x\n2,b\n1,a,x\n ,c\n2,b\n3,d\n1,a\n'
+    cleaner = csvsql.RowCleaner(dedupe=True, required=[ 'id' ], headed_only=True, max_digests=2)
+    csvsql.import_csv(db, io.StringIO(contents), 'clean', cleaner=cleaner)
+    assert db.execute('select * from clean').fetchall() == [ ('1', 'a'), ('2', 'b'), ('3', 'd') ]
+    assert (cleaner.duplicates, cleaner.incomplete) == (3, 1)
+    assert db.execute("select count(*) from sqlite_temp_master").fetchone() == (0,)
+    cleaner = csvsql.RowCleaner(required=[ '__COL2' ])
+    csvsql.import_csv(db, io.StringIO('1,a\n2\n3,c\n'), 'unheaded', header='', cleaner=cleaner)
+    assert db.execute('select * from unheaded').fetchall() == [ ('1', 'a'), ('3', 'c') ]
+    with pytest.raises(ValueError):
+        csvsql.import_csv(db, io.StringIO(contents), 'clean', cleaner=csvsql.RowCleaner(required=[ 'nope' ]))
+    with pytest.raises(csv.Error, match='row 1 has 3 values instead of 2'):
+        csvsql.import_csv(db, io.StringIO(contents), 'clean', cleaner=csvsql.RowCleaner(strict=True))
+    assert db.execute('select * from clean').fetchall() == [ ('1', 'a'), ('2', 'b'), ('3', 'd') ]
+    cleaner = csvsql.RowCleaner(dedupe=True)
+    csvsql.import_csv(db, io.StringIO('id,name,team\n1,a\n1,a,\n1,a,x\n'), 'padded', cleaner=cleaner)
+    assert db.execute('select * from padded').fetchall() == [ ('1', 'a', ''), ('1', 'a', 'x') ]
+    assert cleaner.duplicates == 1
+
+
+def test_import_csv_with_key():
+    db = sqlite3.connect(':memory:')
+    contents = 'course,student,score\nc1,s1,5\nc1,s2,6\nc2,s1,7\nc1,s2,8\nc0,s9,1,extra\nc2,s1,9\n'
+    with pytest.raises(sqlite3.IntegrityError):
+        csvsql.import_csv(db, io.StringIO(contents), 'scores', key=[ 'course', 'student' ])
+    db.rollback()
+    csvsql.import_csv(db, io.StringIO(contents), 'scores', key=[ 'course', 'student' ], duplicates='first')
+    assert 'without rowid' in db.execute("select sql from sqlite_master where name = 'scores'").fetchone()[0]
+    assert db.execute('select * from scores').fetchall() == [ ('c0', 's9', '1', 'extra'), ('c1', 's1', '5', None),
+                                                              ('c1', 's2', '6', None), ('c2', 's1', '7', None) ]
+    csvsql.import_csv(db, io.StringIO(contents), 'scores', key=[ 'course', 'student' ], duplicates='last')
+    assert db.execute('select score from scores').fetchall() == [ ('1',), ('5',), ('8',), ('9',) ]
+    assert db.execute("select count(*) from sqlite_temp_master").fetchone() == (0,)
+    with pytest.raises(ValueError):
+        csvsql.import_csv(db, io.StringIO(contents), 'scores', key=[ 'nope' ])
+
+
+def test_import_csv_with_dictionary():
+    db = sqlite3.connect(':memory:')
+    rows = [ '%d,%s,%s' % (number, ('course-a', 'course-b')[number % 2], 'x%d' % (number % 3)) for number in range(12) ]
+    contents = 'id,course,team\n' + '\n'.join(rows) + '\n'
+    stats = {}
+    csvsql.import_csv(db, io.StringIO(contents), 'enrolments', stats=stats, dictionary=True)
+    assert csvsql.execute_statement(db, 'select * from enrolments') == \
+           [ ('id', 'course', 'team'), *( tuple(row.split(',')) for row in rows ) ]
+    assert db.execute('select * from enrolments__values_2').fetchall() == [ (1, 'course-a'), (2, 'course-b') ]
+    assert [ row[0] for row in db.execute("select name from sqlite_master where name like 'enrolments%'") ] == \
+           [ 'enrolments__encoded', 'enrolments__values_2', 'enrolments' ]
+    assert stats['max'] == [ '9', 'course-b', 'x2' ]
+    assert csvsql.get_table_names(db) == []
+    csvsql.append_csv(db, io.StringIO('12,course-c,x0,extra\n13\n'), 'enrolments')
+    assert db.execute('select * from enrolments where cast(id as integer) >= 12').fetchall() == [ ('12', 'course-c', 'x0', 'extra'),
+                                                                                ('13', '', '', '') ]
+    assert db.execute('select count(*) from enrolments__values_2').fetchone() == (4,)
+    csvsql.import_csv(db, io.StringIO('id\n1\n'), 'enrolments')
+    assert [ row[0] for row in db.execute("select name from sqlite_master") ] == [ 'enrolments' ]
+
+
+def test_statement_budget_max_steps():
+    db = sqlite3.connect(':memory:')
+    budget = csvsql.StatementBudget(max_steps=100000)
+    with budget.applied(db):
+        assert csvsql.execute_statement(db, 'select 1 as one', budget) == [ ('one',), (1,) ]
+        with pytest.raises(csvsql.BudgetExceeded) as err:
+            csvsql.execute_statement(db, _RUNAWAY_STATEMENT, budget)
+    assert err.value.reason == 'exceeded 100000 steps'
+    assert [ statement for statement, seconds in budget.timings ] == [ 'select 1 as one', _RUNAWAY_STATEMENT ]
+    assert csvsql.execute_statement(db, 'select 2 as two') == [ ('two',), (2,) ]
+
+
+def test_statement_budget_timeouts():
+    db = sqlite3.connect(':memory:')
+    ticks = itertools.count()
+    budget = csvsql.StatementBudget(statement_timeout=50, clock=lambda: next(ticks))
+    with budget.applied(db):
+        rows = csvsql.iterate_statement(db, 'with recursive c(x) as (select 1 union all '
+                                            'select x + 1 from c limit 1000000) select x from c', budget)
+        with pytest.raises(csvsql.BudgetExceeded) as err:
+            for row in rows:
+                pass
+    assert err.value.reason == 'exceeded 50 seconds per statement'
+    budget = csvsql.StatementBudget(run_timeout=50, clock=lambda: next(ticks))
+    with budget.applied(db), pytest.raises(csvsql.BudgetExceeded) as err:
+        csvsql.execute_statement(db, _RUNAWAY_STATEMENT, budget)
+    assert err.value.reason == 'exceeded 50 seconds'
+
+
+def test_cancel_token():
+    db = sqlite3.connect(':memory:')
+    token = csvsql.CancelToken()
+    budget = csvsql.StatementBudget(token=token)
+    threading.Timer(0.05, token.cancel).start()
+    with budget.applied(db), pytest.raises(csvsql.BudgetExceeded) as err:
+        csvsql.execute_statement(db, _RUNAWAY_STATEMENT, budget)
+    assert err.value.reason == 'cancelled'
+    assert token.cancelled
+
+
+def test_execute_columnar_without_numpy(monkeypatch):
+    monkeypatch.setattr(csvsql, '_get_numpy', lambda: None)
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv(db, io.StringIO('id,score,name\n1,5,a\n2,,b\n3,7.5,c\n'), 'scores')
+    results = csvsql.execute_columnar(db, 'select id, cast(nullif(score, \'\') as real) as score, name, id * 2 as twice from scores',
+                                      chunk_rows=2)
+    assert list(results) == [ 'id', 'score', 'name', 'twice' ]
+    assert results['id'] == [ '1', '2', '3' ]
+    assert results['score'].typecode == 'd' and results['score'][1] != results['score'][1]
+    assert list(results['score'][::2]) == [ 5.0, 7.5 ]
+    assert results['name'] == [ 'a', 'b', 'c' ]
+    assert results['twice'] == array.array('q', [ 2, 4, 6 ])
+    db.execute('create table t (a)')
+    db.executemany('insert into t values (?)', [ ('007',), ('8',), ('x',), ('009',), (1,), (None,), (2.5,), (2 ** 60,) ])
+    assert csvsql.execute_columnar(db, 'select a from t', chunk_rows=2)['a'] == [ '007', '8', 'x', '009', 1, None, 2.5, 2 ** 60 ]
+    assert csvsql.execute_columnar(db, 'select a from t where rowid > 4', chunk_rows=1)['a'] == [ 1, None, 2.5, 2 ** 60 ]
+    assert list(csvsql.execute_columnar(db, 'select a from t where rowid between 5 and 7', chunk_rows=1)['a'])[::2] == [ 1.0, 2.5 ]
+    assert csvsql.execute_columnar(db, 'select id from scores', dtypes={ 'id': 'float64' })['id'].typecode == 'd'
+    with pytest.raises(ImportError):
+        csvsql.execute_columnar(db, 'select id from scores', records=True)
+
+
+def test_execute_columnar_with_numpy():
+    numpy = pytest.importorskip('numpy')
+    db = sqlite3.connect(':memory:')
+    db.execute('create table t (a, b, c)')
+    db.executemany('insert into t values (?, ?, ?)', ((i, i / 2, str(i)) for i in range(10000)))
+    results = csvsql.execute_columnar(db, 'select a, b, c from t', dtypes={ 'c': 'int32' }, chunk_rows=1000)
+    assert [ results[name].dtype for name in 'abc' ] == [ numpy.int64, numpy.float64, numpy.int32 ]
+    assert (results['a'] == numpy.arange(10000)).all() and (results['c'] == numpy.arange(10000)).all()
+    assert (results['b'] == numpy.arange(10000) / 2).all()
+    records = csvsql.execute_columnar(db, 'select a, c from t where a < 2', records=True)
+    assert records.tolist() == [ (0, '0'), (1, '1') ] and records.dtype.names == ('a', 'c')
+
+
+_COLUMNAR_CONTENTS = ('day,Shop,qty,price\n'
+                      '2026-10-01,a,1,2.5\n'
+                      '2026-10-02,b, 4 ,abc\n'
+                      '2026-10-01,,10,\n'
+                      '2026-09-30,a,-3,1e2\n'
+                      '2026-10-02,"b, c",2,.5\n'
+                      '2026-10-01,a,1,12abc\n'
+                      '2026-10-03\n')
+
+_COLUMNAR_STATEMENTS = [ "select * from sales",
+                         "select day, qty from sales where day >= '2026-10-01' and shop <> 'a'",
+                         "select COUNT( * ) as n, sum(qty), avg(qty), total(price), min(price), max(Price) from sales",
+                         "select day, count(*), sum(qty) as s, avg(price), min(shop), max(qty) from sales group by day",
+                         "select day, shop, count(price), sum(price) from sales where qty = '1' group by day, shop;",
+                         "select sum(qty), min(qty), count(*) from sales where day = 'nope'",
+                         "select shop from sales where shop == 'it''s' group by shop" ]
+
+
+@pytest.mark.parametrize('with_numpy', [ True, False ])
+def test_query_csv_gets_the_results_of_sqlite3(tmpdir, monkeypatch, with_numpy):
+    if with_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(csvsql, '_get_numpy', lambda: None)
+    path = pathlib.Path(str(tmpdir.join('sales.csv')))
+    path.write_text(_COLUMNAR_CONTENTS)
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv(db, io.StringIO(_COLUMNAR_CONTENTS), 'sales')
+    for statement in _COLUMNAR_STATEMENTS:
+        assert repr(csvsql.query_csv(statement, { 'sales': (path, None) })) == \
+               repr(csvsql.execute_statement(db, statement))
+    for statement in [ "select qty from sales order by qty", "select sum(qty) from sales where qty > 1",
+                       "select day, sum(qty) from sales", "select day from sales where day = 'x' or shop = 'y'",
+                       "select day from other" ]:
+        assert csvsql.query_csv(statement, { 'sales': (path, None) }) is None
+    path.write_text('a,b\n1,2,3\n')
+    assert csvsql.query_csv('select count(*) from sales', { 'sales': (path, None) }) is None
+
+
+def test_csv_database_with_columnar_engine(tmpdir):
+    path = pathlib.Path(str(tmpdir.join('sales.csv')))
+    path.write_text(_COLUMNAR_CONTENTS)
+    with csvsql.CsvDatabase(columnar=True) as db:
+        db.add_csv(path)
+        assert db.query('select day, count(*) from sales group by day') == \
+               [ ('day', 'count(*)'), ('2026-09-30', 1), ('2026-10-01', 3), ('2026-10-02', 2), ('2026-10-03', 1) ]
+        assert db.connection.execute('select count(*) from sqlite_master').fetchone() == (0,)
+        assert db.query('select count(*) from sales order by 1') == [ ('count(*)',), (7,) ]
+        assert db.connection.execute('select count(*) from sqlite_master').fetchone() == (1,)
+
+
+def test_materialized_aggregates():
+    db = sqlite3.connect(':memory:')
+    csvsql.import_csv(db, io.StringIO('day,product,units\nd1,p1,3\nd1,p2,x\nd2,p1,4\n'), 'sales')
+    statement = ('select product, sum(units) as units, count(*), min(day), max(units), avg(units) '
+                 "from sales where day > 'd0' group by product")
+    csvsql.create_materialized(db, 'by_product', statement)
+    assert db.execute('select * from by_product').fetchall() == db.execute(statement).fetchall()
+    csvsql.append_csv(db, io.StringIO('d3,p2,2.5\nd3,p3,1\nd0,p1,9\n'), 'sales')
+    assert csvsql.refresh_materialized(db) == 2
+    assert db.execute('select * from by_product').fetchall() == db.execute(statement).fetchall()
+    assert [ column[0] for column in db.execute('select * from by_product').description ] == \
+           [ 'product', 'units', 'count(*)', 'min(day)', 'max(units)', 'avg(units)' ]
+    db.execute("update sales set units = '10' where product = 'p3'")
+    csvsql.append_csv(db, io.StringIO('d4,,1\n'), 'sales')
+    assert csvsql.refresh_materialized(db, 'by_product') == 6
+    assert db.execute('select * from by_product').fetchall() == db.execute(statement + ' order by 1').fetchall()
+    csvsql.import_csv(db, io.StringIO('day,product,units\nd1,p1,3\n'), 'sales')
+    assert csvsql.refresh_materialized(db) == 1
+    assert db.execute('select * from by_product').fetchall() == [ ('p1', 3, 1, 'd1', '3', 3.0) ]
+    csvsql.create_materialized(db, 'bare', 'select product p, sum(units) s, count(*) n from sales group by product')
+    csvsql.append_csv(db, io.StringIO('d2,p1,2\n'), 'sales')
+    assert csvsql.refresh_materialized(db, 'bare') == 1
+    assert db.execute('select * from bare').fetchall() == [ ('p1', 5, 2) ]
+    csvsql.drop_materialized(db, 'bare')
+    csvsql.create_materialized(db, 'top', 'select product from sales group by product having count(*) > 1')
+    csvsql.append_csv(db, io.StringIO('d2,p1,1\n'), 'sales')
+    csvsql.refresh_materialized(db)
+    assert db.execute('select * from top').fetchall() == [ ('p1',) ]
+    for name in ('by_product', 'top'):
+        csvsql.drop_materialized(db, name)
+    assert csvsql.get_table_names(db) == [ 'sales' ]
+    assert db.execute("select count(*) from sqlite_master where type in ('view', 'trigger')").fetchone() == (0,)
+
+
+def test_query_plan_and_suggested_indexes():
+    db = sqlite3.connect(':memory:')
+    db.execute('create table students (id, name)')
+    db.execute('create table scores (student_id, score)')
+    statement = 'select * from scores where score > 5'
+    assert csvsql.get_query_plan(db, statement) == [ (0, 'SCAN scores') ]
+    assert csvsql.get_plan_warnings('SCAN scores') == [ 'full scan' ]
+    assert csvsql.get_plan_warnings('SEARCH scores USING INDEX scores_score_idx (score>?)') == []
+    assert csvsql.suggest_indexes(db, statement) == [ 'create index scores_score_idx on scores (score)' ]
+    statement = 'select name from students s, scores c where s.id = c.student_id'
+    assert 'create index scores_student_id_idx on scores (student_id)' in csvsql.suggest_indexes(db, statement)
+    assert csvsql.suggest_indexes(db, 'select * from scores') == []
+    assert db.execute("select count(*) from sqlite_master where type = 'index'").fetchone() == (0,)
+    assert not db.in_transaction
+    db.execute('create index scores_score_idx on scores (score)')
+    db.execute('analyze')
+    assert csvsql.suggest_indexes(db, 'select * from scores where score > 5') == []
+    db.set_authorizer(lambda action, *args: sqlite3.SQLITE_DENY if action == sqlite3.SQLITE_CREATE_INDEX else
+                      sqlite3.SQLITE_OK)
+    assert csvsql.suggest_indexes(db, 'select * from scores where student_id = 1') == [
+        'create index scores_student_id_idx on scores (student_id)' ]
+
+
 # Helping functions
 
 
@@ -0,0 +1,146 @@
+import pytest
+import json
+import pathlib
+import csvsqlbatch
+
+
+def test_load_ini_manifest():
+    contents = ("[batch]\n"
+                "workers = 2\n"
+                "\n"
+                "[job averages]\n"
+                "input = students.csv\n"
+                "        scores.csv\n"
+                "statement = select id, avg(score) from students, scores where id = student_id group by id\n"
+                "output = averages.csv\n")
+    expected = { 'workers': '2',
+                 'jobs': [ { 'name': 'averages',
+                             'input': [ 'students.csv', 'scores.csv' ],
+                             'statement': 'select id, avg(score) from students, scores where id = student_id group by id',
+                             'output': 'averages.csv' } ] }
+    assert csvsqlbatch.load_ini_manifest(contents) == expected
+
+
+def test_get_dependencies_when_circular(tmpdir, capsys):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    manifest = { 'jobs': [ { 'name': 'one', 'input': 'two.csv', 'statement': 'select 1', 'output': 'one.csv' },
+                           { 'name': 'two', 'input': 'one.csv', 'statement': 'select 2', 'output': 'two.csv' } ] }
+    jobs = csvsqlbatch.get_jobs(manifest, folder)
+    with pytest.raises(SystemExit):
+        csvsqlbatch.get_dependencies(jobs)
+    assert 'circular' in capsys.readouterr()[1].lower()
+
+
+def test_get_jobs_when_input_is_missing(tmpdir, capsys):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    manifest = { 'jobs': [ { 'name': 'one', 'input': 'missing.csv', 'statement': 'select 1', 'output': 'one.csv' },
+                           { 'name': 'two', 'input': 'one.csv', 'statement': 'select 2', 'output': 'two.csv' } ] }
+    with pytest.raises(SystemExit):
+        csvsqlbatch.get_jobs(manifest, folder)
+    error = capsys.readouterr()[1]
+    assert 'missing.csv not found' in error and 'one.csv' not in error
+
+
+def test_process_cml_args_with_dependent_jobs(tmpdir, capsys):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    (folder / 'students.csv').write_text('id,name\n1,Anna\n2,Bernat\n')
+    (folder / 'scores.csv').write_text('student_id,score\n1,5\n1,7\n2,9\n')
+    manifest = { 'workers': 2,
+                 'jobs': [ { 'name': 'averages',
+                             'input': [ 'students.csv', 'scores.csv' ],
+                             'statement': 'select name, avg(score) as score from students, scores '
+                                          'where id = student_id group by name order by name',
+                             'output': 'averages.csv' },
+                           { 'name': 'best',
+                             'input': [ 'averages.csv' ],
+                             'statement': 'select name from averages order by score desc limit 1',
+                             'output': 'best.csv' },
+                           { 'name': 'names',
+                             'input': [ 'students.csv' ],
+                             'statement': [ 'update students set name = upper(name)',
+                                            'select name from students order by name' ],
+                             'unheadedOutput': 'names.csv' } ] }
+    manifest_path = folder / 'manifest.json'
+    manifest_path.write_text(json.dumps(manifest))
+    csvsqlbatch.csvsqlbatch_process_cml_args([ 'csvsqlbatch.py', str(manifest_path) ])
+    assert (folder / 'averages.csv').read_text() == 'name,score\nAnna,6.0\nBernat,9.0\n'
+    assert (folder / 'best.csv').read_text() == 'name\nBernat\n'
+    assert (folder / 'names.csv').read_text() == 'ANNA\nBERNAT\n'
+    report = capsys.readouterr()[0].replace('\r', '').splitlines()
+    assert report[0] == 'job,status,start,seconds'
+    assert sorted(line.split(',')[0] for line in report[1:]) == [ 'averages', 'best', 'names' ]
+    assert all(line.split(',')[1] == 'ok' for line in report[1:])
+
+
+def test_process_cml_args_when_job_fails(tmpdir, capsys):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    (folder / 'students.csv').write_text('id,name\n1,Anna\n')
+    manifest = ("[job broken]\n"
+                "input = students.csv\n"
+                "statement = select surname from students\n"
+                "output = surnames.csv\n"
+                "\n"
+                "[job dependent]\n"
+                "input = surnames.csv\n"
+                "statement = select * from surnames\n"
+                "output = copy.csv\n")
+    manifest_path = folder / 'manifest.ini'
+    manifest_path.write_text(manifest)
+    report_path = folder / 'report.csv'
+    with pytest.raises(SystemExit):
+        csvsqlbatch.csvsqlbatch_process_cml_args([ 'csvsqlbatch.py', str(manifest_path), '-r', str(report_path) ])
+    statuses = { line.split(',')[0]: line.split(',')[1] for line in report_path.read_text().splitlines()[1:] }
+    assert statuses == { 'broken': 'failed', 'dependent': 'skipped' }
+    assert 'broken' in capsys.readouterr()[1]
+
+
+def test_process_cml_args_when_input_is_unreadable(tmpdir, capsys):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    (folder / 'students.csv').write_text('id,name\n1,Anna\n')
+    (folder / 'scores.csv').write_bytes(b'id,score\n1,\xff\xfe5\n')
+    manifest = ("[job broken]\n"
+                "input = scores.csv\n"
+                "statement = select * from scores\n"
+                "output = copy.csv\n"
+                "\n"
+                "[job dependent]\n"
+                "input = copy.csv\n"
+                "statement = select * from copy\n"
+                "output = copy2.csv\n"
+                "\n"
+                "[job names]\n"
+                "input = students.csv\n"
+                "statement = select name from students\n"
+                "output = names.csv\n")
+    manifest_path = folder / 'manifest.ini'
+    manifest_path.write_text(manifest)
+    report_path = folder / 'report.csv'
+    with pytest.raises(SystemExit):
+        csvsqlbatch.csvsqlbatch_process_cml_args([ 'csvsqlbatch.py', str(manifest_path), '-r', str(report_path) ])
+    statuses = { line.split(',')[0]: line.split(',')[1] for line in report_path.read_text().splitlines()[1:] }
+    assert statuses == { 'broken': 'failed', 'dependent': 'skipped', 'names': 'ok' }
+    assert (folder / 'names.csv').read_text() == 'name\nAnna\n'
+    assert 'broken' in capsys.readouterr()[1]
+
+
+def test_process_cml_args_when_job_times_out(tmpdir, capsys):
+    folder = pathlib.Path(str(tmpdir.realpath()))
+    (folder / 'students.csv').write_text('id,name\n1,Anna\n')
+    manifest = ("[job runaway]\n"
+                "input = students.csv\n"
+                "statement = with recursive c(x) as (select 1 union all select x + 1 from c) select count(*) from c\n"
+                "output = count.csv\n"
+                "\n"
+                "[job quick]\n"
+                "input = students.csv\n"
+                "statement = select * from students\n"
+                "output = copy.csv\n")
+    manifest_path = folder / 'manifest.ini'
+    manifest_path.write_text(manifest)
+    report_path = folder / 'report.csv'
+    with pytest.raises(SystemExit):
+        csvsqlbatch.csvsqlbatch_process_cml_args([ 'csvsqlbatch.py', str(manifest_path), '-r', str(report_path),
+                                                   '--timeout', '0.2' ])
+    statuses = { line.split(',')[0]: line.split(',')[1] for line in report_path.read_text().splitlines()[1:] }
+    assert statuses == { 'runaway': 'failed', 'quick': 'ok' }
+    assert 'exceeded 0.2 seconds' in capsys.readouterr()[1]
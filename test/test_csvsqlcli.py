@@ -4,7 +4,9 @@ import io
 import sqlite3
 import csv
 import pathlib
+import json
 import csvsqlcli
+import csvsql
 
 
 def test_split_statements_when_theres_just_one():
@@ -451,3 +453,598 @@ def test_process_cml_args_for_mixed_headed_and_unheaded_inputs(tmpdir):
     assert output_file_path.read_text() == expected_output
 
 
+
+
+def test_split_annotated_statements_with_output_directives():
+    contents = ("create table mytable (one);\n"
+                "-- @output first.csv\n"
+                "select one from mytable;\n"
+                "-- @unheadedOutput second.csv\n"
+                "-- @output third.csv\n"
+                "select one\nfrom mytable;")
+    expected = [ ("create table mytable (one);", []),
+                 ("select one from mytable;", [ ('-o', pathlib.Path('first.csv')) ]),
+                 ("select one from mytable;", [ ('-O', pathlib.Path('second.csv')),
+                                                ('-o', pathlib.Path('third.csv')) ]) ]
+    result = csvsqlcli.split_annotated_statements(contents)
+    assert result == expected
+
+
+def test_split_annotated_statements_when_directive_without_statement(capsys):
+    contents = "select 1;\n-- @output first.csv\n"
+    with pytest.raises(SystemExit):
+        csvsqlcli.split_annotated_statements(contents)
+    captured = capsys.readouterr()
+    assert 'first.csv' in captured[1]
+
+
+def test_process_cml_args_with_an_output_per_statement(tmpdir):
+    contents = 'one,two,three\n1,2,3\n4,5,6\n'
+    fin = tmpdir.join('myfile.csv')
+    fin.write(contents)
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    clargs = [ 'csvsqlcli.py',
+               '-i', str(fin.realpath()),
+               '-s', 'select one from myfile', '-o', str(tmppath / 'one.csv'),
+               '-s', 'update myfile set two = two * 10',
+               '-s', 'select two from myfile', '-O', str(tmppath / 'two.csv'),
+               '-s', 'select three from myfile', '-o', str(tmppath / 'three.csv') ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert (tmppath / 'one.csv').read_text() == 'one\n1\n4\n'
+    assert (tmppath / 'two.csv').read_text() == '20\n50\n'
+    assert (tmppath / 'three.csv').read_text() == 'three\n3\n6\n'
+
+
+def test_process_cml_args_with_output_directives_in_file(tmpdir):
+    contents = 'one,two,three\n1,2,3\n4,5,6\n'
+    fin = tmpdir.join('myfile.csv')
+    fin.write(contents)
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    fstatements = tmpdir.join('reports.sql')
+    fstatements.write("-- @output %s\n"
+                      "select one from myfile;\n"
+                      "-- @output %s\n"
+                      "select two from myfile;\n"%(tmppath / 'one.csv', tmppath / 'two.csv'))
+    clargs = [ 'csvsqlcli.py',
+               '-i', str(fin.realpath()),
+               '-f', str(fstatements.realpath()) ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert (tmppath / 'one.csv').read_text() == 'one\n1\n4\n'
+    assert (tmppath / 'two.csv').read_text() == 'two\n2\n5\n'
+
+
+def test_process_cml_args_with_parallel_exports(tmpdir):
+    contents = 'one,two,three\n1,2,3\n4,5,6\n'
+    fin = tmpdir.join('myfile.csv')
+    fin.write(contents)
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    clargs = [ 'csvsqlcli.py',
+               '-d', str(tmppath / 'mydb.sqlite3'),
+               '-i', str(fin.realpath()),
+               '--parallel', '2',
+               '-s', 'insert into myfile values (7, 8, 9)',
+               '-s', 'select one from myfile', '-o', str(tmppath / 'one.csv'),
+               '-s', 'select two from myfile', '-o', str(tmppath / 'two.csv'),
+               '-s', 'select three from myfile', '-o', str(tmppath / 'three.csv') ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert (tmppath / 'one.csv').read_text() == 'one\n1\n4\n7\n'
+    assert (tmppath / 'two.csv').read_text() == 'two\n2\n5\n8\n'
+    assert (tmppath / 'three.csv').read_text() == 'three\n3\n6\n9\n'
+
+
+def test_watch_inputs_imports_just_changed_files(tmpdir, monkeypatch):
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    fin_changing = tmppath / 'changing.csv'
+    fin_changing.write_text('one\n1\n')
+    fin_constant = tmppath / 'constant.csv'
+    fin_constant.write_text('two\n2\n')
+    out_path = tmppath / 'outputfile.csv'
+    files = [ ('-i', fin_changing), ('-i', fin_constant) ]
+    db = sqlite3.connect(':memory:')
+    csvsqlcli.load_input(db, files)
+    imported = []
+    import_csv_list = csvsqlcli.csvsql.import_csv_list
+    def spy_import_csv_list(db, pairs, **kwargs):
+        imported.extend(pairs)
+        import_csv_list(db, pairs, **kwargs)
+    monkeypatch.setattr(csvsqlcli.csvsql, 'import_csv_list', spy_import_csv_list)
+    statements = [ 'update changing set one = one * 10;', 'select one, two from changing, constant;' ]
+    destinations = { 1: [ ('-o', out_path) ] }
+    outputs = []
+    def fake_sleep(seconds):
+        outputs.append(out_path.read_text())
+        if len(outputs) == 1:
+            fin_changing.write_text('one\n1\n3\n')
+            os.utime(str(fin_changing), ns=(0, 0))
+    csvsqlcli.watch_inputs(db, files, statements, destinations, 0.1, sleep=fake_sleep, polls=3)
+    assert outputs == [ 'one,two\n10,2\n', 'one,two\n10,2\n', 'one,two\n10,2\n30,2\n' ]
+    assert imported == [ ('-i', fin_changing) ]
+
+
+def test_watch_inputs_retries_failed_imports_and_survives_output_errors(tmpdir, monkeypatch, capsys):
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    fin = tmppath / 'changing.csv'
+    fin.write_text('one\n1\n')
+    out_path = tmppath / 'outputfile.csv'
+    files = [ ('-i', fin) ]
+    db = sqlite3.connect(':memory:')
+    csvsqlcli.load_input(db, files)
+    attempts = []
+    import_csv_list = csvsqlcli.csvsql.import_csv_list
+    def failing_import_csv_list(db, pairs, **kwargs):
+        attempts.append(pairs)
+        if len(attempts) == 1:
+            raise ValueError('transient failure')
+        import_csv_list(db, pairs, **kwargs)
+    monkeypatch.setattr(csvsqlcli.csvsql, 'import_csv_list', failing_import_csv_list)
+    write_output = csvsqlcli.write_output
+    def failing_write_output(results, destinations, **kwargs):
+        if not out_path.exists():
+            out_path.write_text('')
+            raise OSError('disk full')
+        write_output(results, destinations, **kwargs)
+    monkeypatch.setattr(csvsqlcli, 'write_output', failing_write_output)
+    def fake_sleep(seconds):
+        if fin.read_text() == 'one\n1\n':
+            fin.write_text('one\n1\n2\n')
+    csvsqlcli.watch_inputs(db, files, [ 'select * from changing' ], { 0: [ ('-o', out_path) ] }, 0.1,
+                           sleep=fake_sleep, polls=4)
+    assert attempts == [ files, files ]
+    assert out_path.read_text() == 'one\n1\n2\n'
+    assert 'disk full' in capsys.readouterr()[1]
+
+
+def test_watch_inputs_reloads_tables_of_shards(tmpdir):
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    (tmppath / 'scores_01.csv').write_text('day,score\n01,5\n')
+    out_path = tmppath / 'outputfile.csv'
+    pattern = str(tmppath / 'scores_*.csv')
+    db = sqlite3.connect(':memory:')
+    csvsqlcli.load_shards(db, [ ('scores', sorted(tmppath.glob('scores_*.csv'))) ])
+    outputs = []
+    def fake_sleep(seconds):
+        outputs.append(out_path.read_text())
+        if len(outputs) == 1:
+            (tmppath / 'scores_02.csv').write_text('day,score\n02,7\n')
+        elif len(outputs) == 3:
+            (tmppath / 'scores_01.csv').write_text('day,score\n01,6\n')
+            os.utime(str(tmppath / 'scores_01.csv'), ns=(0, 0))
+    csvsqlcli.watch_inputs(db, [], [ 'select sum(score) as total from scores' ], { 0: [ ('-o', out_path) ] }, 0.1,
+                           sleep=fake_sleep, polls=5, tables=[ ('scores', pattern) ])
+    assert outputs == [ 'total\n5\n', 'total\n5\n', 'total\n12\n', 'total\n12\n', 'total\n13\n' ]
+
+
+def test_process_cml_args_with_incremental_database(tmpdir):
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    fin = tmppath / 'mylog.csv'
+    fin.write_text('one,two\n1,2\n')
+    db_path = tmppath / 'mydb.sqlite3'
+    out_path = tmppath / 'outputfile.csv'
+    clargs = [ 'csvsqlcli.py',
+               '-d', str(db_path),
+               '--incremental',
+               '-i', str(fin),
+               '-o', str(out_path),
+               '--force',
+               '-s', 'select * from mylog' ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    with fin.open('a') as fo:
+        fo.write('3,4\n')
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert out_path.read_text() == 'one,two\n1,2\n3,4\n'
+
+
+def test_process_cml_args_with_sync(tmpdir):
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    fin_updated = tmppath / 'updated.csv'
+    fin_updated.write_text('one,two\n1,2\n')
+    fin_untouched = tmppath / 'untouched.csv'
+    fin_untouched.write_text('one,two\n1,2\n')
+    fin_dropped = tmppath / 'dropped.csv'
+    fin_dropped.write_text('1,2\n')
+    os.utime(str(fin_untouched), ns=(0, 0))
+    clargs = [ 'csvsqlcli.py',
+               '-i', str(fin_updated), str(fin_untouched),
+               '-u', str(fin_dropped),
+               '--sync', '--sync-dir', str(tmppath),
+               '-s', 'update updated set two = 3; update untouched set two = 3 where one = 5',
+               '-s', 'create table created as select one from updated; drop table dropped' ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert fin_updated.read_text() == 'one,two\n1,3\n'
+    assert fin_untouched.stat().st_mtime_ns == 0
+    assert not fin_dropped.exists()
+    assert (tmppath / 'created.csv').read_text() == 'one\n1\n'
+
+
+def test_parse_size():
+    assert csvsqlcli.parse_size('1024') == 1024
+    assert csvsqlcli.parse_size('64K') == 64 * 1024
+    assert csvsqlcli.parse_size('2gb') == 2 * 1024 ** 3
+    with pytest.raises(Exception):
+        csvsqlcli.parse_size('lots')
+
+
+def test_get_db_when_inputs_exceed_memory_limit(tmpdir):
+    fin = tmpdir.join('myfile.csv')
+    fin.write('one,two,three\n' + '1,2,3\n' * 1000)
+    parser = csvsqlcli.get_argparse('csvsqlcli.py')
+    args = csvsqlcli.get_args(parser, [ '-i', str(fin.realpath()), '--memory-limit', '1K', '-s', 'select 1' ])
+    db = csvsqlcli.get_db(args)
+    assert not csvsqlcli.is_memory_db(db)
+    args = csvsqlcli.get_args(parser, [ '-i', str(fin.realpath()), '--memory-limit', '1M', '-s', 'select 1' ])
+    db = csvsqlcli.get_db(args)
+    assert csvsqlcli.is_memory_db(db)
+
+
+def test_load_input_moves_to_disk_when_exceeding_memory_limit(tmpdir):
+    fin = tmpdir.join('myfile.csv')
+    fin.write('one,two,three\n' + '1,2,3\n' * 1000)
+    db = sqlite3.connect(':memory:')
+    db = csvsqlcli.load_input(db, [ ('-i', pathlib.Path(str(fin.realpath()))) ], memory_limit=1024)
+    assert not csvsqlcli.is_memory_db(db)
+    assert db.execute('select count(*) from myfile').fetchone() == (1000,)
+
+
+def test_load_input_moves_to_disk_while_importing_a_file(tmpdir, monkeypatch):
+    fin = tmpdir.join('myfile.csv')
+    fin.write('one,two,three\n' + ''.join('%d,2,3\n%d,2,3\n' % (i, i) for i in range(30000)))
+    checks = []
+    get_db_size = csvsqlcli.get_db_size
+    monkeypatch.setattr(csvsqlcli, 'get_db_size', lambda db: checks.append(
+        (csvsqlcli.is_memory_db(db), db.execute('select count(*) from myfile').fetchone()[0])) or get_db_size(db))
+    cleaner = csvsql.RowCleaner(dedupe=True)
+    db = csvsqlcli.load_input(sqlite3.connect(':memory:'), [ ('-i', pathlib.Path(str(fin.realpath()))) ],
+                              memory_limit=64 * 1024, cleaner=cleaner)
+    assert not csvsqlcli.is_memory_db(db)
+    assert checks[0][0] and checks[0][1] < 30000
+    assert db.execute('select count(*) from myfile').fetchone() == (30000,)
+    assert cleaner.duplicates == 30000
+
+
+def test_process_cml_args_saving_to_and_loading_from_a_database(tmpdir, capsys):
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    fin = tmppath / 'myfile.csv'
+    fin.write_text('one,two\n1,2\n')
+    db_path = tmppath / 'snapshot.sqlite3'
+    clargs = [ 'csvsqlcli.py',
+               '-i', str(fin),
+               '--save-to', str(db_path),
+               '-s', 'insert into myfile values (3, 4)' ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    fin.unlink()
+    clargs = [ 'csvsqlcli.py',
+               '--load-from', str(db_path),
+               '--progress',
+               '-s', 'select * from myfile' ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    captured = capsys.readouterr()
+    assert captured[0].replace('\r', '') == 'one,two\n1,2\n3,4\n'
+    assert 'pages' in captured[1]
+
+
+def test_process_cml_args_when_loading_from_a_non_database(tmpdir):
+    db_path = tmpdir.join('fake.sqlite3')
+    db_path.write("Some non sqlite3 contents")
+    clargs = [ 'csvsqlcli.py', '--load-from', str(db_path.realpath()), '-s', 'select 1' ]
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs)
+
+
+def test_check_db_is_not_repeated_while_unchanged(tmpdir, monkeypatch):
+    db_path = pathlib.Path(str(tmpdir.realpath())) / 'mydb.sqlite3'
+    db = sqlite3.connect(str(db_path))
+    db.execute('create table mytable (one)')
+    db.commit()
+    db.close()
+    assert csvsqlcli.check_db(db_path, 'auto') == 'full'
+    connect = sqlite3.connect
+    connections = []
+    monkeypatch.setattr(sqlite3, 'connect', lambda *args, **kwargs: connections.append(args) or connect(*args, **kwargs))
+    assert csvsqlcli.check_db(db_path, 'quick') == 'quick'
+    assert connections == []
+    db = connect(str(db_path))
+    db.execute('insert into mytable values (1)')
+    db.commit()
+    db.close()
+    assert csvsqlcli.check_db(db_path, 'quick') == 'quick'
+    assert len(connections) == 1
+
+
+def test_check_db_header_on_non_database(tmpdir):
+    db_path = tmpdir.join('fake.sqlite3')
+    db_path.write("Some non sqlite3 contents")
+    with pytest.raises(sqlite3.DatabaseError):
+        csvsqlcli.check_db(pathlib.Path(str(db_path.realpath())), 'header')
+
+
+def test_process_cml_args_with_mmap_reader(tmpdir, capsys):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write('id,score\n1,"5"\n2,6\n')
+    clargs = [ 'csvsqlcli.py', '--reader', 'mmap',
+               '-i', str(input_path.realpath()),
+               '-s', 'select * from scores order by id desc' ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert capsys.readouterr()[0].replace('\r', '') == 'id,score\n2,6\n1,5\n'
+
+
+def test_process_cml_args_with_table_of_shards(tmpdir, capsys):
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    (tmppath / 'scores_01.csv').write_text('id,score\n1,5\n')
+    (tmppath / 'scores_02.csv').write_text('id,score\n2,6\n')
+    clargs = [ 'csvsqlcli.py',
+               '--table', 'scores=%s'%(tmppath / 'scores_*.csv'),
+               '--source-column', 'shard',
+               '-s', 'select * from scores order by id' ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    captured = capsys.readouterr()
+    assert captured[0].replace('\r', '') == 'id,score,shard\n1,5,scores_01.csv\n2,6,scores_02.csv\n'
+
+
+def test_process_cml_args_with_stats_prunes_shards(tmpdir, capsys):
+    tmppath = pathlib.Path(str(tmpdir.realpath()))
+    (tmppath / 'scores_01.csv').write_text('id,score\n1,5\n')
+    (tmppath / 'scores_02.csv').write_text('id,score\n2,6\n')
+    clargs = [ 'csvsqlcli.py', '--stats',
+               '--table', 'scores=%s'%(tmppath / 'scores_*.csv'),
+               '--source-column', 'shard',
+               '-s', "select * from scores where id >= '2'" ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert capsys.readouterr()[0].replace('\r', '') == 'id,score,shard\n2,6,scores_02.csv\n'
+    (tmppath / 'scores_01.csv').write_text('id,score\n1,5\n3,7\n')
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert capsys.readouterr()[0].replace('\r', '') == 'id,score,shard\n3,7,scores_01.csv\n2,6,scores_02.csv\n'
+
+
+def test_process_cml_args_with_table_without_shards(tmpdir, capsys):
+    clargs = [ 'csvsqlcli.py',
+               '--table', 'scores=%s'%(tmpdir.join('missing_*.csv')),
+               '-s', 'select * from scores' ]
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs)
+    assert 'no files match' in capsys.readouterr()[1]
+
+
+def test_write_output_in_chunks(tmpdir, monkeypatch):
+    monkeypatch.setattr(csvsqlcli, '_OUTPUT_CHUNK_ROWS', 2)
+    monkeypatch.setattr(csvsqlcli, '_OUTPUT_QUEUE_CHUNKS', 1)
+    headed = pathlib.Path(str(tmpdir.realpath())) / 'headed.csv'
+    unheaded = pathlib.Path(str(tmpdir.realpath())) / 'unheaded.csv'
+    results = [ ('n',) ] + [ (number,) for number in range(7) ]
+    csvsqlcli.write_output(iter(results), [ ('-o', headed), ('-O', unheaded) ])
+    assert headed.read_text() == 'n\n0\n1\n2\n3\n4\n5\n6\n'
+    assert unheaded.read_text() == '0\n1\n2\n3\n4\n5\n6\n'
+
+
+def test_write_output_when_destination_fails(monkeypatch):
+    class ClosedPipe(io.StringIO):
+        def write(self, text):
+            if self.tell() > 0:
+                raise BrokenPipeError()
+            return super().write(text)
+    monkeypatch.setattr(csvsqlcli, '_OUTPUT_CHUNK_ROWS', 2)
+    monkeypatch.setattr(csvsqlcli, '_OUTPUT_QUEUE_CHUNKS', 1)
+    monkeypatch.setattr(csvsqlcli, '_OUTPUT_QUEUE_TIMEOUT', 0.01)
+    monkeypatch.setattr(csvsqlcli.sys, 'stdout', ClosedPipe())
+    fetched = []
+    def results():
+        yield ('n',)
+        for number in range(1000):
+            fetched.append(number)
+            yield (number,)
+    with pytest.raises(BrokenPipeError):
+        csvsqlcli.write_output(results(), [ ('-o', None) ])
+    assert len(fetched) < 1000
+
+
+def test_process_cml_args_with_jsonl_and_tsv_formats(tmpdir, capsys):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write('id,name\n1,"Funny, Gerard"\n2,Anna\n')
+    headed = pathlib.Path(str(tmpdir.realpath())) / 'headed.jsonl'
+    unheaded = pathlib.Path(str(tmpdir.realpath())) / 'unheaded.jsonl'
+    clargs = [ 'csvsqlcli.py', '--format', 'jsonl',
+               '-i', str(input_path.realpath()),
+               '-s', 'select id, name, null as score from scores order by id',
+               '-o', str(headed), '-O', str(unheaded) ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert headed.read_text() == \
+        '{"id": "1", "name": "Funny, Gerard", "score": null}\n{"id": "2", "name": "Anna", "score": null}\n'
+    assert unheaded.read_text() == '["1", "Funny, Gerard", null]\n["2", "Anna", null]\n'
+    csvsqlcli.csvsql_process_cml_args([ 'csvsqlcli.py', '--format', 'tsv',
+                                        '-i', str(input_path.realpath()),
+                                        '-s', 'select * from scores order by id' ])
+    assert capsys.readouterr()[0].replace('\r', '') == 'id\tname\n1\tFunny, Gerard\n2\tAnna\n'
+
+
+def test_process_cml_args_with_sqlite_format(tmpdir, capsys):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write('id,score\n1,5\n2,7\n')
+    target = pathlib.Path(str(tmpdir.realpath())) / 'results.sqlite3'
+    clargs = [ 'csvsqlcli.py', '--format', 'sqlite',
+               '-i', str(input_path.realpath()),
+               '-s', "insert into scores values ('3', '9'); select * from scores where score > '6'",
+               '-o', '%s#high' % target,
+               '-s', 'select count(*) as total from scores',
+               '-o', str(target) ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    db = sqlite3.connect(str(target))
+    assert db.execute('select * from high').fetchall() == [ ('2', '7'), ('3', '9') ]
+    assert db.execute('select * from results').fetchall() == [ (3,) ]
+    db.close()
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs[:5] + [ '-s', 'select * from scores' ])
+    assert 'requires an output database' in capsys.readouterr()[1]
+    statements_path = tmpdir.join('statements.sql')
+    statements_path.write('-- @output %s#low\nselect * from scores where score < \'6\';\n' % target)
+    csvsqlcli.csvsql_process_cml_args(clargs[:5] + [ '-f', str(statements_path.realpath()) ])
+    db = sqlite3.connect(str(target))
+    assert db.execute('select * from low').fetchall() == [ ('1', '5') ]
+    db.close()
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs[:5] + [ '-s', 'select 1', '-o', '%s#x; drop table high' % target ])
+    assert 'invalid table name' in capsys.readouterr()[1]
+
+
+def test_process_cml_args_rolls_back_tables_when_a_statement_fails(tmpdir, capsys):
+    input_path = tmpdir.join('docs.csv')
+    input_path.write('id,doc\n1,[]\n2,[1]\n')
+    database = str(tmpdir.join('docs.sqlite3'))
+    target = pathlib.Path(str(tmpdir.realpath())) / 'results.sqlite3'
+    clargs = [ 'csvsqlcli.py', '-d', database, '--format', 'sqlite', '-i', str(input_path.realpath()),
+               '-s', 'create table kept as select id from docs',
+               '-s', 'select id, json(doc) as doc from docs', '-o', '%s#parsed' % target ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    input_path.write('id,doc\n1,[]\n2,[1]\n3,[x\n')
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs[:7] + [ '-s', 'create table created as select id from docs' ] +
+                                          clargs[9:])
+    assert 'malformed JSON' in capsys.readouterr()[1]
+    db = sqlite3.connect(database)
+    assert sorted(csvsql.get_table_names(db)) == [ 'docs', 'kept' ]
+    db.close()
+    db = sqlite3.connect(str(target))
+    assert db.execute('select * from parsed').fetchall() == [ ('1', '[]'), ('2', '[1]') ]
+    db.close()
+
+
+def test_process_cml_args_when_exceeding_max_steps(tmpdir, capsys):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write('id,score\n1,5\n')
+    database = str(tmpdir.join('scores.sqlite3'))
+    clargs = [ 'csvsqlcli.py', '--max-steps', '100000', '-d', database,
+               '-i', str(input_path.realpath()),
+               '-s', "insert into scores values ('2', '6')",
+               '-s', 'with recursive c(x) as (select 1 union all select x + 1 from c) select count(*) from c' ]
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs)
+    error = capsys.readouterr()[1]
+    assert 'exceeded 100000 steps' in error and 'rolled back' in error
+    assert 'insert into scores' in error
+    db = sqlite3.connect(database)
+    assert db.execute('select count(*) from scores').fetchone() == (1,)
+    db.close()
+
+
+def test_process_cml_args_with_explain_and_slow_log(tmpdir, capsys):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write('id,score\n1,5\n2,7\n')
+    log_path = pathlib.Path(str(tmpdir.realpath())) / 'slow.jsonl'
+    clargs = [ 'csvsqlcli.py', '--explain', '--slow-log', '0', '--slow-log-file', str(log_path),
+               '-i', str(input_path.realpath()),
+               '-s', "update scores set score = '6' where id = '1'",
+               '-s', "select * from scores where score > '5'" ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    captured = capsys.readouterr()
+    assert captured[0].replace('\r', '') == 'id,score\n1,6\n2,7\n'
+    assert '  SCAN scores  <-- full scan\n' in captured[1]
+    assert 'Suggested: create index scores_score_idx on scores (score)' in captured[1]
+    records = [ json.loads(line) for line in log_path.read_text().splitlines() ]
+    assert [ (record['rows'], record['plan']) for record in records ] == [ (1, [ 'SCAN scores' ]),
+                                                                          (2, [ 'SCAN scores' ]) ]
+    assert records[1]['executed'] == [ "select * from scores where score > '5';" ]
+
+
+def test_process_cml_args_with_cleaning_options(tmpdir, capsys):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write('id,score\n1,5,extra\n,6\n1,5\n2,7\n')
+    clargs = [ 'csvsqlcli.py', '--dedupe', '--required', 'id', '--headed-only',
+               '-i', str(input_path.realpath()),
+               '-s', 'select * from scores' ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert capsys.readouterr()[0].replace('\r', '') == 'id,score\n1,5\n2,7\n'
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args([ 'csvsqlcli.py', '--strict' ] + clargs[5:])
+    assert 'row 1 has 3 values instead of 2' in capsys.readouterr()[1]
+
+
+def test_process_cml_args_with_key(tmpdir, capsys):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write('id,score\n2,5\n1,6\n2,7\n')
+    clargs = [ 'csvsqlcli.py', '--key', 'scores:id', '--duplicates', 'last',
+               '-i', str(input_path.realpath()),
+               '-s', "select * from scores where id = '2'" ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert capsys.readouterr()[0].replace('\r', '') == 'id,score\n2,7\n'
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs[:3] + clargs[5:])
+    assert 'UNIQUE constraint failed: scores.id' in capsys.readouterr()[1]
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args([ 'csvsqlcli.py', '--key', 'scores' ] + clargs[5:])
+
+
+def test_process_cml_args_with_dictionary(tmpdir, capsys):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write('id,status\n' + ''.join('%d,%s\n'%(i, ('passed', 'failed')[i % 2]) for i in range(8)))
+    db_path = str(tmpdir.join('db.sqlite3').realpath())
+    clargs = [ 'csvsqlcli.py', '-d', db_path, '--dictionary', '-i', str(input_path.realpath()),
+               '-s', 'select status, count(*) from scores group by status' ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert capsys.readouterr()[0].replace('\r', '') == 'status,count(*)\nfailed,4\npassed,4\n'
+    db = sqlite3.connect(db_path)
+    assert db.execute('select distinct typeof(status) from scores__encoded').fetchall() == [ ('integer',) ]
+    db.close()
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs + [ '--sync' ])
+
+
+def test_process_cml_args_with_sniff(tmpdir, capsys):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write_binary('id;name;score\n1;J\u00falia;5\n2;"Pau; Jr";7\n'.encode('latin-1'))
+    clargs = [ 'csvsqlcli.py', '-i', str(input_path.realpath()), '-s', 'select name, score from scores' ]
+    csvsqlcli.csvsql_process_cml_args(clargs + [ '--sniff' ])
+    assert capsys.readouterr()[0].replace('\r', '') == 'name,score\nJ\u00falia,5\nPau; Jr,7\n'
+    csvsqlcli.csvsql_process_cml_args(clargs + [ '--delimiter', ';', '--encoding', 'latin-1' ])
+    assert capsys.readouterr()[0].replace('\r', '') == 'name,score\nJ\u00falia,5\nPau; Jr,7\n'
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs + [ '--encoding', 'klingon' ])
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs + [ '--delimiter', ';;' ])
+
+
+def test_process_cml_args_with_materialized_aggregates(tmpdir, capsys):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write('id,score\n1,5\n2,7\n')
+    db_path = str(tmpdir.join('db.sqlite3').realpath())
+    clargs = [ 'csvsqlcli.py', '-d', db_path, '--incremental', '-i', str(input_path.realpath()),
+               '-s', 'select * from by_id' ]
+    csvsqlcli.csvsql_process_cml_args(clargs + [ '--materialize', 'by_id',
+                                                 'select id, sum(score), count(*) from scores group by id' ])
+    assert capsys.readouterr()[0].replace('\r', '') == 'id,sum(score),count(*)\n1,5,1\n2,7,1\n'
+    input_path.write('1,4\n3,1\n', mode='a')
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    assert capsys.readouterr()[0].replace('\r', '') == 'id,sum(score),count(*)\n1,9,2\n2,7,1\n3,1,1\n'
+    csvsqlcli.csvsql_process_cml_args(clargs[:-1] + [ 'select count(*) from sqlite_master where type = "view"',
+                                                      '--drop-materialized', 'by_id' ])
+    assert capsys.readouterr()[0].replace('\r', '') == 'count(*)\n0\n'
+    with pytest.raises(SystemExit):
+        csvsqlcli.csvsql_process_cml_args(clargs[:1] + clargs[3:] + [ '--materialize', 'm', 'select 1' ])
+
+
+def test_process_cml_args_with_columnar_engine(tmpdir, capsys, monkeypatch):
+    input_path = tmpdir.join('scores.csv')
+    input_path.write('id,score\n1,5\n2,7\n1,6\n')
+    statement = "select id, count(*), sum(score) from scores where score > '5' group by id"
+    clargs = [ 'csvsqlcli.py', '-i', str(input_path.realpath()), '-s', statement ]
+    csvsqlcli.csvsql_process_cml_args(clargs)
+    expected = capsys.readouterr()[0]
+    assert expected.replace('\r', '') == 'id,count(*),sum(score)\n1,1,6\n2,1,7\n'
+    monkeypatch.setattr(csvsqlcli, 'get_db', None)
+    csvsqlcli.csvsql_process_cml_args(clargs[:1] + [ '--engine', 'columnar' ] + clargs[1:])
+    assert capsys.readouterr()[0] == expected
+    monkeypatch.undo()
+    csvsqlcli.csvsql_process_cml_args(clargs[:1] + [ '--engine', 'columnar' ] + clargs[1:3] +
+                                      [ '-s', 'select id from scores order by score' ])
+    assert capsys.readouterr()[0].replace('\r', '') == 'id\n1\n1\n2\n'
+
+
+def test_startup_does_not_load_the_heavy_modules():
+    import subprocess
+    import sys
+    cli_path = pathlib.Path(csvsqlcli.__file__)
+    result = subprocess.run([ sys.executable, '-X', 'importtime', str(cli_path), '-v' ],
+                            capture_output=True, text=True, check=True)
+    imported = { line.split('|')[-1].strip() for line in result.stderr.splitlines()[1:] }
+    assert 'argparse' in imported
+    for module in ('sqlite3', 'csvsql', 'csv', 'tempfile', 'urllib.request', 'concurrent.futures'):
+        assert module not in imported
+